@@ -5,11 +5,18 @@ import logging
 from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from collections import deque
+from bisect import bisect_left
+from functools import lru_cache
 import json
 
 import time
 import random
+import hashlib
+import re
+import uuid
+from urllib.parse import urlsplit
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
 
@@ -222,10 +229,249 @@ def manual_log_cleanup():
         app.logger.error(f"Error in manual log cleanup: {e}")
         return jsonify({"error": str(e)}), 500
 
+# --- 飞书HTTP客户端 ---
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+
+FEISHU_API_HOST = 'https://open.feishu.cn'
+
+class AdaptiveConcurrencyController:
+    """根据飞书限流反馈自适应调整并发数（AIMD）
+
+    - 收到 99991400 / HTTP 429 时按比例降低允许的并发数（乘性减），并遵守 Retry-After 暂停新请求
+    - 请求成功时缓慢探测更高的并发（加性增，每完成约 limit 个成功请求加 1）
+    爬取、搜索和代理等所有飞书请求共享同一个控制器。
+    """
+
+    def __init__(self, initial_limit=16, min_limit=1, max_limit=64, decrease_ratio=0.5, decrease_cooldown=1.0, max_pause=60.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.decrease_ratio = decrease_ratio
+        # 同一波限流通常会让多个并发请求同时失败，冷却期内只降一次
+        self.decrease_cooldown = decrease_cooldown
+        self.max_pause = max_pause
+        self.in_flight = 0
+        self.success_count = 0
+        self.throttled_count = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """等待直到当前并发数低于限制且不在暂停期内"""
+        with self._cond:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                    continue
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                self._cond.wait()
+
+    def release(self, outcome='success', retry_after=None):
+        """归还并发名额并根据结果调整限制
+
+        Args:
+            outcome: 'success'、'throttled' 或 'error'（网络错误等，不调整限制）
+            retry_after: 服务端要求的等待秒数
+        """
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if outcome == 'throttled':
+                self.throttled_count += 1
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    old_limit = self.limit
+                    self.limit = max(float(self.min_limit), self.limit * self.decrease_ratio)
+                    self._last_decrease = now
+                    app.logger.warning(f"Feishu throttling detected, concurrency limit {old_limit:.1f} -> {self.limit:.1f}")
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + min(retry_after, self.max_pause))
+            elif outcome == 'success':
+                self.success_count += 1
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "in_flight": self.in_flight,
+                "paused_seconds": round(max(self._paused_until - time.monotonic(), 0.0), 2),
+                "success_count": self.success_count,
+                "throttled_count": self.throttled_count
+            }
+
+def parse_retry_after(response):
+    """从响应头中解析服务端要求的等待秒数（Retry-After 或飞书的 x-ogw-ratelimit-reset）"""
+    for header in ('Retry-After', 'x-ogw-ratelimit-reset'):
+        value = response.headers.get(header)
+        if value:
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                continue
+    return None
+
+FEISHU_THROTTLE_BODY_LIMIT = 4096  # 成功响应体超过该大小时不解析错误码
+
+def is_feishu_throttled(response):
+    """判断响应是否为飞书限流（HTTP 429 或业务错误码 99991400）"""
+    if response.status_code == 429:
+        return True
+    # 限流错误体很短；成功的大响应（节点列表、文档内容）不可能是限流，避免为判断限流解析整个JSON
+    if 200 <= response.status_code < 300 and len(response.content) > FEISHU_THROTTLE_BODY_LIMIT:
+        return False
+    if 'json' not in response.headers.get('Content-Type', ''):
+        return False
+    try:
+        data = response.json()
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get('code') == 99991400
+
+class FeishuClient:
+    """共享的飞书HTTP客户端
+
+    所有访问飞书开放平台的请求都通过同一个 requests.Session 发送，
+    复用连接池中的 keep-alive 连接，避免每次请求重新进行 TCP+TLS 握手。
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=32, connect_timeout=5, read_timeout=60, host_pool_sizes=None, concurrency=None):
+        """
+        Args:
+            pool_connections: 缓存的主机连接池数量
+            pool_maxsize: 默认每个主机连接池的最大连接数
+            connect_timeout: 默认连接超时时间（秒）
+            read_timeout: 默认读取超时时间（秒）
+            host_pool_sizes: 按主机前缀单独配置的连接池大小，如 {'https://open.feishu.cn': 64}
+            concurrency: 可选的 AdaptiveConcurrencyController，限制并自适应调整同时进行的请求数
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.concurrency = concurrency
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        # 会话在所有用户之间共享，禁止保存任何Cookie，避免用户之间串数据
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+        # 失败重试由 request_with_backoff 统一处理，这里不做连接层重试
+        default_adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('https://', default_adapter)
+        self.session.mount('http://', default_adapter)
+        for host_prefix, host_pool_size in (host_pool_sizes or {}).items():
+            self.session.mount(host_prefix, HTTPAdapter(pool_connections=1, pool_maxsize=host_pool_size, max_retries=0))
+
+    def request(self, method, url, **kwargs):
+        """发送请求，未指定timeout时使用默认的连接/读取超时"""
+        kwargs.setdefault('timeout', self.timeout)
+        if self.concurrency is None:
+            return self.session.request(method, url, **kwargs)
+
+        self.concurrency.acquire()
+        outcome = 'error'
+        retry_after = None
+        try:
+            response = self.session.request(method, url, **kwargs)
+            if is_feishu_throttled(response):
+                outcome = 'throttled'
+                retry_after = parse_retry_after(response)
+            else:
+                outcome = 'success'
+            return response
+        finally:
+            self.concurrency.release(outcome, retry_after)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def pool_stats(self):
+        """汇总各主机连接池的使用情况
+
+        Returns:
+            dict: 包含每个连接池的请求数、新建连接数、复用率以及已借出/空闲连接数
+        """
+        pools = []
+        total_requests = 0
+        total_connections = 0
+        # 同一个适配器可能挂载在多个前缀上（如 http:// 和 https://），按适配器去重
+        adapter_prefixes = {}
+        for prefix, adapter in list(self.session.adapters.items()):
+            adapter_prefixes.setdefault(id(adapter), (adapter, []))[1].append(prefix)
+        for adapter, prefixes in adapter_prefixes.values():
+            pool_manager = adapter.poolmanager
+            for key in list(pool_manager.pools.keys()):
+                pool = pool_manager.pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                maxsize = pool.pool.maxsize
+                # 队列中的元素是空闲连接或占位的None，被取走的即为正在使用的连接
+                checked_out = maxsize - pool.pool.qsize()
+                idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                num_requests = pool.num_requests
+                num_connections = pool.num_connections
+                total_requests += num_requests
+                total_connections += num_connections
+                pools.append({
+                    "adapter": ','.join(prefixes),
+                    "host": pool.host,
+                    "port": pool.port,
+                    "maxsize": maxsize,
+                    "checked_out": checked_out,
+                    "idle": idle,
+                    "requests": num_requests,
+                    "connections_created": num_connections,
+                    "reuse_ratio": round((num_requests - num_connections) / num_requests, 4) if num_requests else 0.0
+                })
+
+        return {
+            "timeout": {"connect": self.timeout[0], "read": self.timeout[1]},
+            "total_requests": total_requests,
+            "total_connections_created": total_connections,
+            "reuse_ratio": round((total_requests - total_connections) / total_requests, 4) if total_requests else 0.0,
+            "checked_out": sum(p['checked_out'] for p in pools),
+            "pools": pools
+        }
+
+FEISHU_HTTP_POOL_MAXSIZE = int(os.getenv('FEISHU_HTTP_POOL_MAXSIZE', '32'))
+feishu_concurrency = None
+if os.getenv('FEISHU_ADAPTIVE_CONCURRENCY', 'true').lower() == 'true':
+    feishu_concurrency = AdaptiveConcurrencyController(
+        initial_limit=int(os.getenv('FEISHU_ADAPTIVE_INITIAL_LIMIT', '16')),
+        min_limit=int(os.getenv('FEISHU_ADAPTIVE_MIN_LIMIT', '1')),
+        max_limit=int(os.getenv('FEISHU_ADAPTIVE_MAX_LIMIT', str(FEISHU_HTTP_POOL_MAXSIZE)))
+    )
+feishu_client = FeishuClient(
+    pool_connections=int(os.getenv('FEISHU_HTTP_POOL_CONNECTIONS', '10')),
+    pool_maxsize=FEISHU_HTTP_POOL_MAXSIZE,
+    connect_timeout=float(os.getenv('FEISHU_HTTP_CONNECT_TIMEOUT', '5')),
+    read_timeout=float(os.getenv('FEISHU_HTTP_READ_TIMEOUT', '60')),
+    host_pool_sizes={FEISHU_API_HOST: int(os.getenv('FEISHU_HTTP_HOST_POOL_MAXSIZE', str(FEISHU_HTTP_POOL_MAXSIZE)))},
+    concurrency=feishu_concurrency
+)
+
 # 飞书API代理端点 - 解决CORS问题
 
 # 通用飞书API代理端点
-@app.route('/api/feishu/proxy', methods=['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+FEISHU_PROXY_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+@app.route('/api/feishu/proxy', methods=list(FEISHU_PROXY_METHODS))
 def feishu_api_proxy():
     """通用飞书API代理端点，处理所有飞书API请求"""
     try:
@@ -238,6 +484,9 @@ def feishu_api_proxy():
         
         # 获取请求方法、路径和查询参数
         method = request.method
+        if method not in FEISHU_PROXY_METHODS:
+            # Flask 会为 GET 路由自动接受 HEAD，这里只转发明确允许的方法
+            return jsonify({"error": f"Method {method} not allowed"}), 405
         path = request.args.get('path', '')
         query_params = {}
         for key in request.args:
@@ -270,16 +519,10 @@ def feishu_api_proxy():
             app.logger.info(f'[飞书API代理] 请求数据: {data}')
         
         # 调用飞书API
-        if method == 'GET':
-            response = requests.get(url, headers=headers)
-        elif method == 'POST':
-            response = requests.post(url, json=data, headers=headers)
-        elif method == 'PUT':
-            response = requests.put(url, json=data, headers=headers)
-        elif method == 'PATCH':
-            response = requests.patch(url, json=data, headers=headers)
-        elif method == 'DELETE':
-            response = requests.delete(url, headers=headers)
+        if method in ('POST', 'PUT', 'PATCH'):
+            response = feishu_client.request(method, url, json=data, headers=headers)
+        else:
+            response = feishu_client.request(method, url, headers=headers)
         
         # 使用通用函数记录请求响应信息
         log_request_response(url, headers, data, response, "通用代理")
@@ -328,7 +571,7 @@ def create_feishu_document_proxy():
         }
         
         request_data = {'title': title}
-        response = requests.post(url, json=request_data, headers=headers)
+        response = feishu_client.post(url, json=request_data, headers=headers)
         
         # 使用通用函数记录请求响应信息
         log_request_response(url, headers, request_data, response, "创建文档")
@@ -396,7 +639,7 @@ def convert_markdown_to_blocks_proxy(document_id):
             'content_type': 'markdown',
             'content': markdown_content
         }
-        response = requests.post(url, json=request_data, headers=headers)
+        response = feishu_client.post(url, json=request_data, headers=headers)
         
         # 使用通用函数记录请求响应信息
         log_request_response(url, headers, request_data, response, "转换Markdown")
@@ -481,7 +724,7 @@ def export_markdown_to_document_proxy():
         }
         
         create_request_data = {'title': title}
-        create_response = requests.post(create_url, json=create_request_data, headers=create_headers)
+        create_response = feishu_client.post(create_url, json=create_request_data, headers=create_headers)
         
         # 使用通用函数记录请求响应信息
         log_request_response(create_url, create_headers, create_request_data, create_response, "创建文档")
@@ -516,7 +759,7 @@ def export_markdown_to_document_proxy():
             'content_type': 'markdown',
             'content': markdown_content
         }
-        convert_response = requests.post(convert_url, json=convert_request_data, headers=convert_headers)
+        convert_response = feishu_client.post(convert_url, json=convert_request_data, headers=convert_headers)
         
         # 使用通用函数记录请求响应信息
         log_request_response(convert_url, convert_headers, convert_request_data, convert_response, "转换Markdown")
@@ -566,7 +809,7 @@ def export_markdown_to_document_proxy():
             'descendants': blocks,
             'index': 0
         }
-        write_response = requests.post(write_url, json=write_request_data, headers=write_headers)
+        write_response = feishu_client.post(write_url, json=write_request_data, headers=write_headers)
         
         # 使用通用函数记录请求响应信息
         log_request_response(write_url, write_headers, write_request_data, write_response, "写入文档")
@@ -728,8 +971,8 @@ def write_blocks_to_document_proxy(document_id, block_id):
                 'index': data.get('index', -1)
             }
 
-            # 发送请求
-            response = requests.post(url, json=request_data, headers=headers)
+            # 发送请求（请求头已声明JSON类型，请求体直接编码为字节）
+            response = feishu_client.post(url, data=json_dumps_bytes(request_data), headers=headers)
             log_request_response(url, headers, request_data, response, f"写入文档第{batch_num}批")
             result = safe_json_parse(response, f"写入文档第{batch_num}批")
             
@@ -801,7 +1044,7 @@ def process_image_upload_and_update(document_id, image_block_id, user_access_tok
         # 上传图片素材
         files = {'file': ('placeholder.png', placeholder_image_data, 'image/png')}
         
-        upload_response = requests.post(upload_url, headers=headers, files=files)
+        upload_response = feishu_client.post(upload_url, headers=headers, files=files)
         
         # 使用通用函数记录请求响应信息
         log_request_response(upload_url, headers, None, upload_response, "图片上传")
@@ -830,7 +1073,7 @@ def process_image_upload_and_update(document_id, image_block_id, user_access_tok
             }]
         }
         
-        update_response = requests.patch(update_url, headers=update_headers, json=update_payload)
+        update_response = feishu_client.patch(update_url, headers=update_headers, json=update_payload)
         
         # 使用通用函数记录请求响应信息
         log_request_response(update_url, update_headers, update_payload, update_response, "图片更新")
@@ -910,6 +1153,120 @@ def get_log_status():
         app.logger.error(f"Error getting log status: {e}")
         return jsonify({"error": str(e)}), 500
 
+def check_admin_token():
+    """校验管理接口的Bearer令牌
+
+    Returns:
+        tuple: 校验失败时返回 (错误响应, 状态码)，校验通过返回None
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    token = auth_header.split(' ')[1]
+    if token != os.getenv('ADMIN_TOKEN', 'admin-secret'):
+        return jsonify({"error": "Invalid admin token"}), 401
+    return None
+
+@app.route('/api/admin/feishu/rate_limits', methods=['GET'])
+def get_feishu_rate_limit_status():
+    """获取各接口族/用户限流桶的填充情况，便于发现高频用户"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify({
+            "quotas": {family: {"max_calls": q[0], "per_seconds": q[1], "scope": q[2]} for family, q in feishu_rate_limiters.quotas.items()},
+            "buckets": feishu_rate_limiters.snapshot(),
+            "concurrency": feishu_concurrency.stats() if feishu_concurrency else None
+        })
+    except Exception as e:
+        app.logger.error(f"Error getting feishu rate limit status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admin/feishu/pool', methods=['GET'])
+def get_feishu_pool_status():
+    """获取飞书HTTP连接池状态（复用率、已借出连接数等）"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify(feishu_client.pool_stats())
+    except Exception as e:
+        app.logger.error(f"Error getting feishu pool status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admin/wiki/crawls', methods=['GET'])
+def get_wiki_crawls_status():
+    """获取正在进行的知识空间爬取及其订阅者数量"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify({
+            "crawls": wiki_crawl_coordinator.stats(),
+            "subtree_cache": dict(node_children_cache.stats(), prefetched=subtree_prefetcher.scheduled),
+            "node_resolution": wiki_node_resolution_store.stats()
+        })
+    except Exception as e:
+        app.logger.error(f"Error getting wiki crawl status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admin/wiki/doc_cache', methods=['GET'])
+def get_doc_cache_status():
+    """获取文档内容缓存的命中情况和占用空间"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify(document_content_cache.stats())
+    except Exception as e:
+        app.logger.error(f"Error getting doc cache status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admin/llm/clients', methods=['GET'])
+def get_llm_client_pool_status():
+    """获取LLM客户端池的复用情况"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify(llm_client_pool.stats())
+    except Exception as e:
+        app.logger.error(f"Error getting LLM client pool status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admin/llm/admission', methods=['GET'])
+def get_llm_admission_status():
+    """获取LLM并发准入和排队情况"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify(llm_admission.stats())
+    except Exception as e:
+        app.logger.error(f"Error getting LLM admission status: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admin/llm/response_cache', methods=['GET'])
+def get_llm_response_cache_status():
+    """获取LLM响应缓存的命中情况和占用空间"""
+    auth_error = check_admin_token()
+    if auth_error:
+        return auth_error
+
+    try:
+        return jsonify(llm_response_cache.stats())
+    except Exception as e:
+        app.logger.error(f"Error getting LLM response cache status: {e}")
+        return jsonify({"error": str(e)}), 500
+
 # --- Global Request Logger ---
 
 @app.before_request
@@ -1120,7 +1477,9 @@ def get_user_access_token(code, redirect_uri):
     app.logger.info("="*60)
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        # 授权码只能使用一次，不经过 request_with_backoff 重试，但仍受 auth 接口族限流
+        feishu_rate_limiters.for_request(url, headers).acquire()
+        response = feishu_client.post(url, json=payload, headers=headers)
         app.logger.info("--- Received response from Feishu ---")
         app.logger.info(f"Status Code: {response.status_code}")
         # 只记录响应状态码，不记录完整响应内容，避免敏感信息泄露
@@ -1326,7 +1685,8 @@ def validate_token():
         
         app.logger.info(f"Validating token (length: {len(user_access_token)})")
         
-        response = requests.get(url, headers=headers)
+        feishu_rate_limiters.for_request(url, headers).acquire()
+        response = feishu_client.get(url, headers=headers)
         
         # 检查响应状态
         if response.status_code != 200:
@@ -1461,47 +1821,185 @@ def get_token():
         app.logger.error(f"Unexpected error in get_token: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+# --- 速率限制状态存储 ---
+import sqlite3
+
+# 本地持久化数据（限流状态、缓存等）的存放目录
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+class InMemoryRateLimitBackend:
+    """进程内的限流状态存储（默认），只在单个进程内生效"""
+
+    def __init__(self):
+        self._tats = {}
+        self._lock = threading.Lock()
+
+    def now(self):
+        return time.monotonic()
+
+    def reserve(self, key, emission_interval, burst_tolerance, max_wait):
+        """按GCRA预留一个时间槽，返回需要等待的秒数；超过max_wait时不预留并返回None"""
+        with self._lock:
+            now = self.now()
+            tat = max(self._tats.get(key, 0.0), now)
+            wait_time = tat - burst_tolerance - now
+            if wait_time > 0 and max_wait is not None and wait_time > max_wait:
+                return None
+            self._tats[key] = tat + emission_interval
+            return max(wait_time, 0.0)
+
+    def backlog(self, key):
+        """已预留但尚未到期的排队时间（秒）"""
+        with self._lock:
+            return max(self._tats.get(key, 0.0) - self.now(), 0.0)
+
+    def forget(self, key):
+        with self._lock:
+            self._tats.pop(key, None)
+
+class SQLiteRateLimitBackend:
+    """基于SQLite文件锁的限流状态存储
+
+    同一台机器上的多个WSGI worker共享同一个数据库文件，
+    通过 BEGIN IMMEDIATE 事务保证“读取-预留”操作在进程间互斥。
+    """
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets (key TEXT PRIMARY KEY, tat REAL NOT NULL)")
+        # 清理长时间未使用的桶
+        conn.execute("DELETE FROM rate_limit_buckets WHERE tat < ?", (self.now() - 3600,))
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def now(self):
+        # 进程间需要可比较的时钟，使用墙上时间
+        return time.time()
+
+    def reserve(self, key, emission_interval, burst_tolerance, max_wait):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tat FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+            now = self.now()
+            tat = max(row[0] if row else 0.0, now)
+            wait_time = tat - burst_tolerance - now
+            if wait_time > 0 and max_wait is not None and wait_time > max_wait:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "INSERT INTO rate_limit_buckets (key, tat) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET tat = excluded.tat",
+                (key, tat + emission_interval)
+            )
+            conn.execute("COMMIT")
+            return max(wait_time, 0.0)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def backlog(self, key):
+        row = self._connection().execute("SELECT tat FROM rate_limit_buckets WHERE key = ?", (key,)).fetchone()
+        return max((row[0] if row else 0.0) - self.now(), 0.0)
+
+    def forget(self, key):
+        # 只删除已经过期的状态，其他进程仍在使用的桶不受影响
+        self._connection().execute("DELETE FROM rate_limit_buckets WHERE key = ? AND tat < ?", (key, self.now()))
+
+def create_rate_limit_backend():
+    """根据 RATE_LIMIT_BACKEND 环境变量创建限流状态存储，默认使用进程内存储"""
+    backend_type = os.getenv('RATE_LIMIT_BACKEND', 'memory').lower()
+    if backend_type == 'sqlite':
+        path = os.getenv('RATE_LIMIT_SQLITE_PATH', os.path.join(DATA_DIR, 'rate_limits.db'))
+        app.logger.info(f"Using SQLite rate limit backend: {path}")
+        return SQLiteRateLimitBackend(path)
+    if backend_type != 'memory':
+        app.logger.warning(f"Unknown RATE_LIMIT_BACKEND '{backend_type}', falling back to memory")
+    return InMemoryRateLimitBackend()
+
+rate_limit_backend = create_rate_limit_backend()
+
 # 速率限制器
 class RateLimiter:
-    def __init__(self, max_calls, per_seconds):
+    """线程安全的速率限制器（GCRA，等价于令牌桶）
+
+    只维护一个“理论到达时间”(TAT)，每次获取令牌都是O(1)操作。
+    阻塞获取时先预留时间槽、再在锁外等待，多个线程并发调用也不会一起超发。
+    TAT保存在可替换的存储中，使用SQLite存储时多个进程共享同一个桶。
+    """
+
+    def __init__(self, max_calls, per_seconds, burst=None, backend=None, key='default'):
+        """
+        Args:
+            max_calls: 每个时间窗口内允许的理论最大调用次数
+            per_seconds: 时间窗口长度（秒）
+            burst: 允许的突发调用次数，默认为有效限额的1/10
+            backend: 限流状态存储，默认使用全局的 rate_limit_backend
+            key: 在存储中区分不同桶的键
+        """
         self.max_calls = max_calls
         self.per_seconds = per_seconds
-        self.calls = []
         # 添加安全系数，实际限制比理论值更严格
         self.safety_factor = 0.8  # 只使用80%的理论限制
-        self.effective_max_calls = int(max_calls * self.safety_factor)
+        self.effective_max_calls = max(1, int(max_calls * self.safety_factor))
+        # 相邻两次调用之间的理论间隔
+        self.emission_interval = per_seconds / self.effective_max_calls
+        self.burst = max(1, int(burst) if burst is not None else self.effective_max_calls // 10)
+        self.burst_tolerance = self.emission_interval * (self.burst - 1)
+        self.backend = backend or rate_limit_backend
+        self.key = key
         self.counter = 0  # 用于生成唯一函数名
 
+    def acquire(self, blocking=True, timeout=None):
+        """获取一次调用许可
+
+        Args:
+            blocking: 为False时不等待，没有可用令牌立即返回False
+            timeout: 阻塞模式下的最长等待时间（秒），None表示一直等待
+
+        Returns:
+            bool: 是否获取成功
+        """
+        wait_time = self.backend.reserve(self.key, self.emission_interval, self.burst_tolerance, timeout if blocking else 0)
+        if wait_time is None:
+            return False
+        if wait_time > 0:
+            app.logger.debug(f"Rate limit reached (effective: {self.effective_max_calls}/{self.max_calls}). Sleeping for {wait_time:.3f} seconds.")
+            time.sleep(wait_time)
+        return True
+
+    def available_tokens(self):
+        """当前无需等待即可获取的令牌数"""
+        return self.stats()['available_tokens']
+
+    def stats(self):
+        """返回限制器的配额和当前填充情况"""
+        backlog = self.backend.backlog(self.key)
+        return {
+            "max_calls": self.max_calls,
+            "per_seconds": self.per_seconds,
+            "effective_max_calls": self.effective_max_calls,
+            "burst": self.burst,
+            "available_tokens": max(int((self.burst_tolerance + self.emission_interval - backlog) / self.emission_interval), 0),
+            # 已预留但尚未到期的调用需要的排队时间，越大说明该桶越繁忙
+            "backlog_seconds": round(backlog, 3)
+        }
+
     def __call__(self, f):
         # 为每个装饰的函数生成唯一的wrapped函数名，避免Flask端点冲突
         def wrapped(*args, **kwargs):
-            now = time.time()
-            # 移除指定时间前的调用记录
-            self.calls = [c for c in self.calls if c > now - self.per_seconds]
-            
-            # 使用更严格的有效限制
-            if len(self.calls) >= self.effective_max_calls:
-                # 计算需要等待的时间
-                sleep_time = (self.calls[0] + self.per_seconds) - now
-                if sleep_time > 0:
-                    # 添加额外缓冲时间
-                    buffer_time = 0.5
-                    total_sleep = sleep_time + buffer_time
-                    app.logger.warning(f"Rate limit reached (effective: {self.effective_max_calls}/{self.max_calls}). Sleeping for {total_sleep:.2f} seconds.")
-                    time.sleep(total_sleep)
-            
-            # 记录请求时间
-            self.calls.append(time.time())
-            
-            # 添加小延迟确保请求间隔
-            if len(self.calls) > 1:
-                time_since_last = now - self.calls[-2]
-                min_interval = self.per_seconds / self.effective_max_calls
-                if time_since_last < min_interval:
-                    additional_delay = min_interval - time_since_last
-                    app.logger.debug(f"Adding delay {additional_delay:.3f}s to maintain rate limit")
-                    time.sleep(additional_delay)
-            
+            self.acquire()
             return f(*args, **kwargs)
         
         # 为wrapped函数设置唯一的名称，避免Flask端点冲突
@@ -1509,26 +2007,151 @@ class RateLimiter:
         wrapped.__name__ = f"rate_limited_{f.__name__}_{self.counter}"
         return wrapped
 
+# --- 按接口族和用户划分的速率限制 ---
+
+def token_fingerprint(token):
+    """返回令牌的短哈希，用作缓存/限流键，避免在内存和日志中保存明文令牌"""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+# 接口族 -> (每个时间窗口的最大调用次数, 时间窗口秒数, 限流维度)
+# 限流维度为 'user' 时每个用户令牌单独计数，为 'app' 时整个应用共享一个桶
+# 可通过环境变量 FEISHU_RATE_LIMIT_<接口族大写>=次数/秒数 覆盖，例如 FEISHU_RATE_LIMIT_WIKI_NODES=100/1
+FEISHU_RATE_LIMIT_QUOTAS = {
+    'wiki_nodes': (50, 1, 'user'),
+    'wiki_search': (10, 1, 'user'),
+    'docx_raw_content': (5, 1, 'app'),
+    'docx_meta': (5, 1, 'app'),
+    'docx_blocks': (3, 1, 'app'),
+    'auth': (50, 1, 'app'),
+    'default': (50, 1, 'user'),
+}
+
+# 按URL路径（正则）匹配接口族，按顺序取第一个匹配项
+# 文档基本信息 /docx/v1/documents/<id> 与块接口 /docx/v1/documents/<id>/blocks 的配额不同，需按路径结尾区分
+FEISHU_API_FAMILY_RULES = [
+    (re.compile(r'/wiki/v2/nodes/search'), 'wiki_search'),
+    (re.compile(r'/wiki/v2/spaces'), 'wiki_nodes'),
+    (re.compile(r'/raw_content'), 'docx_raw_content'),
+    (re.compile(r'/docx/v1/documents/[^/]+/?$'), 'docx_meta'),
+    (re.compile(r'/docx/v1/documents'), 'docx_blocks'),
+    (re.compile(r'/authen/'), 'auth'),
+]
+
+def load_rate_limit_quotas():
+    """读取默认配额并应用环境变量覆盖"""
+    quotas = dict(FEISHU_RATE_LIMIT_QUOTAS)
+    for family, (max_calls, per_seconds, scope) in FEISHU_RATE_LIMIT_QUOTAS.items():
+        override = os.getenv(f'FEISHU_RATE_LIMIT_{family.upper()}')
+        if not override:
+            continue
+        try:
+            calls, _, seconds = override.partition('/')
+            quotas[family] = (int(calls), float(seconds or 1), scope)
+        except ValueError:
+            app.logger.warning(f"Invalid rate limit override for {family}: {override}")
+    return quotas
+
+def classify_feishu_api(url):
+    """根据请求URL判断所属的飞书接口族"""
+    path = urlsplit(url).path
+    for pattern, family in FEISHU_API_FAMILY_RULES:
+        if pattern.search(path):
+            return family
+    return 'default'
+
+class RateLimiterRegistry:
+    """按 (接口族, 用户令牌/应用) 管理速率限制器
+
+    一个用户的大规模抓取只会耗尽自己的桶，不会挤占其他用户的搜索配额。
+    长时间未使用的桶会被清理，避免令牌轮换后无限增长。
+    """
+
+    def __init__(self, quotas, idle_ttl=600):
+        self.quotas = quotas
+        self.idle_ttl = idle_ttl
+        self._limiters = {}  # (family, principal) -> [RateLimiter, last_used]
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def get(self, family, principal='app'):
+        if family not in self.quotas:
+            family = 'default'
+        max_calls, per_seconds, scope = self.quotas[family]
+        if scope == 'app':
+            principal = 'app'
+        key = (family, principal)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._limiters.get(key)
+            if entry is None:
+                self._sweep(now)
+                entry = self._limiters[key] = [RateLimiter(max_calls=max_calls, per_seconds=per_seconds, key=f'{family}:{principal}'), now]
+            entry[1] = now
+            return entry[0]
+
+    def for_request(self, url, headers=None):
+        """根据请求URL和Authorization头自动选择速率限制器"""
+        principal = 'app'
+        auth_header = (headers or {}).get('Authorization', '')
+        if auth_header.startswith('Bearer '):
+            principal = token_fingerprint(auth_header[7:])
+        return self.get(classify_feishu_api(url), principal)
+
+    def _sweep(self, now):
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for key in [k for k, (_, last_used) in self._limiters.items() if now - last_used > self.idle_ttl]:
+            limiter, _ = self._limiters.pop(key)
+            limiter.backend.forget(limiter.key)
+
+    def snapshot(self):
+        """返回所有桶当前的填充情况，积压最多的排在最前"""
+        now = time.monotonic()
+        with self._lock:
+            entries = list(self._limiters.items())
+        buckets = []
+        for (family, principal), (limiter, last_used) in entries:
+            stats = limiter.stats()
+            stats.update({
+                "family": family,
+                "principal": principal,
+                "idle_seconds": round(now - last_used, 1)
+            })
+            buckets.append(stats)
+        buckets.sort(key=lambda b: (b['backlog_seconds'], -b['available_tokens']), reverse=True)
+        return buckets
+
+feishu_rate_limiters = RateLimiterRegistry(load_rate_limit_quotas())
+
 # 带有指数退避的请求函数
 def request_with_backoff(url, headers, params=None, json=None, max_retries=5):
     retry_count = 0
     backoff_factor = 1  # 初始退避时间（秒）
     method = 'POST' if json else 'GET'
     
+    # 根据URL和用户令牌自动选择对应的限流桶
+    limiter = feishu_rate_limiters.for_request(url, headers)
+    
     while retry_count <= max_retries:
         try:
+            limiter.acquire()
             if method == 'POST':
-                response = requests.post(url, headers=headers, params=params, json=json)
+                response = feishu_client.post(url, headers=headers, params=params, json=json)
             else:
-                response = requests.get(url, headers=headers, params=params)
+                response = feishu_client.get(url, headers=headers, params=params)
             
             # 检查是否是飞书API频率限制错误（错误码99991400）
             try:
                 response_data = response.json()
                 if response_data.get('code') == 99991400:
                     if retry_count < max_retries:
-                        # 飞书频率限制，使用更长的退避时间
-                        backoff_time = backoff_factor * (3 ** retry_count) + random.uniform(1, 3)  # 更长的退避
+                        # 飞书频率限制，优先遵守服务端给出的等待时间，否则使用更长的退避时间
+                        retry_after = parse_retry_after(response)
+                        if retry_after is not None:
+                            backoff_time = retry_after + random.uniform(0, 1)
+                        else:
+                            backoff_time = backoff_factor * (3 ** retry_count) + random.uniform(1, 3)  # 更长的退避
                         app.logger.warning(f"Feishu rate limit hit (code 99991400). Retrying in {backoff_time:.2f} seconds. Retry count: {retry_count + 1}")
                         time.sleep(backoff_time)
                         retry_count += 1
@@ -1544,8 +2167,12 @@ def request_with_backoff(url, headers, params=None, json=None, max_retries=5):
             # 处理HTTP 429速率限制错误
             if response.status_code == 429:  # 速率限制错误
                 if retry_count < max_retries:
-                    # 计算退避时间
-                    backoff_time = backoff_factor * (2 ** retry_count) + random.uniform(0, 1)
+                    # 计算退避时间，优先遵守 Retry-After
+                    retry_after = parse_retry_after(response)
+                    if retry_after is not None:
+                        backoff_time = retry_after + random.uniform(0, 1)
+                    else:
+                        backoff_time = backoff_factor * (2 ** retry_count) + random.uniform(0, 1)
                     app.logger.warning(f"HTTP rate limit hit. Retrying in {backoff_time:.2f} seconds. Retry count: {retry_count + 1}")
                     time.sleep(backoff_time)
                     retry_count += 1
@@ -1583,12 +2210,11 @@ def request_with_backoff(url, headers, params=None, json=None, max_retries=5):
     # 如果循环结束仍未成功，抛出异常
     raise requests.exceptions.RequestException("Max retries reached without successful response")
 
-# 限制请求频率为 100 次/分钟，防止超频报错
-rate_limiter = RateLimiter(max_calls=50, per_seconds=1)
+# 本地轮询类接口的限流；访问飞书的请求由 feishu_rate_limiters 按接口族限流
+rate_limiter = RateLimiter(max_calls=50, per_seconds=1, key='local_polling')
 
 # 获取知识空间信息接口
 @app.route('/api/wiki/spaces', methods=['GET'])
-@rate_limiter
 def get_wiki_spaces():
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
@@ -1634,197 +2260,1248 @@ def fetch_node_children(space_id, node_token, user_access_token, page_token=None
     if page_token:
         params['page_token'] = page_token
 
-    @rate_limiter
-    def fetch_with_rate_limit():
-        # 使用带有指数退避的请求函数，更好地处理频率限制
-        return request_with_backoff(url, headers, params)
-
-    response = fetch_with_rate_limit()
+    # 使用带有指数退避的请求函数，限流由 request_with_backoff 按接口族自动处理
+    response = request_with_backoff(url, headers, params)
     return response.json().get("data", {})
 
 
 
-def fetch_all_nodes_recursively(space_id, user_access_token, parent_node_token=None, page_token=None, progress_callback=None):
-    nodes = []
-    total_count = 0  # 用于累计节点总数
-    retry_count = 0  # 重试计数器
-    max_retries = 3  # 最大重试次数
-    
-    while True:
-        url = f"https://open.feishu.cn/open-apis/wiki/v2/spaces/{space_id}/nodes?page_size=50"
-        headers = {
-            "Authorization": f"Bearer {user_access_token}"
-        }
-        params = {}
-        if parent_node_token:
-            params['parent_node_token'] = parent_node_token
-        if page_token:
-            params['page_token'] = page_token
+# --- 紧凑节点表示 ---
 
-        try:
-            # 使用带有指数退避的请求函数
-            response = request_with_backoff(url, headers, params)
-            data = response.json().get("data", {})
-            items = data.get("items", [])
-            # 过滤掉缺少node_token的节点
-            valid_items = [item for item in items if item.get('node_token')]
-            nodes.extend(valid_items)
-            
-            # 重置重试计数器
-            retry_count = 0
-            
-            # 更新总节点数并调用进度回调
-            total_count += len(items)
-            if progress_callback:
-                try:
-                    # 调用进度回调函数
-                    progress_callback(total_count)
-                except Exception as e:
-                    # 记录错误但不中断主流程
-                    app.logger.error(f"Progress callback error: {str(e)}")
-
-            # 限制并发数为2，避免触发飞书API频率限制
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                # 为每个子节点请求添加小延迟，避免同时发送大量请求
-                futures = []
-                for item in items:
-                    if item.get('has_child'):
-                        # 添加小延迟避免频率限制
-                        time.sleep(0.1)
-                        future = executor.submit(fetch_all_nodes_recursively, space_id, user_access_token, item['node_token'], None, progress_callback)
-                        futures.append((future, item))
-                
-                for future, item in futures:
-                    try:
-                        children = future.result()
-                        # Find the node in the list and add its children
-                        for n in nodes:
-                            if n['node_token'] == item['node_token']:
-                                n['children'] = children
-                                break
-                    except Exception as exc:
-                        app.logger.error(f'{item["node_token"]} generated an exception: {exc}')
-                        # 继续处理其他节点，不中断整个过程
-                        continue
+import sys
+from json.encoder import encode_basestring_ascii
 
-            if not data.get('has_more'):
-                break
-            page_token = data.get('page_token')
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"Failed to fetch nodes: {str(e)}")
-            # 如果是速率限制错误，重新抛出异常以便上层处理
-            if e.response is not None and e.response.status_code == 429:
-                raise
-            # 如果是网络错误，尝试重试
-            elif isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
-                if retry_count < max_retries:
-                    retry_count += 1
-                    # 计算退避时间
-                    backoff_time = 2 ** retry_count  # 指数退避
-                    app.logger.warning(f"Network error, retrying in {backoff_time} seconds (attempt {retry_count}/{max_retries})")
-                    time.sleep(backoff_time)
-                    continue
-                else:
-                    app.logger.error(f"Max retries reached for network error: {str(e)}")
-                    raise
-            # 对于其他错误，可以选择继续或者抛出异常
-            else:
-                # 如果已经获取了一些数据，继续处理而不是抛出异常
-                if nodes:
-                    app.logger.warning(f"Error occurred but continuing with already fetched data: {str(e)}")
-                    break
-                else:
-                    raise
-        except Exception as e:
-            app.logger.error(f"Unexpected error in fetch_all_nodes_recursively: {str(e)}")
-            # 如果已经获取了一些数据，继续处理而不是抛出异常
-            if nodes:
-                app.logger.warning(f"Unexpected error but continuing with already fetched data: {str(e)}")
-                break
+# 飞书知识空间节点的已知字段，顺序即序列化输出顺序
+WIKI_NODE_FIELDS = (
+    'space_id', 'node_token', 'obj_token', 'obj_type', 'parent_node_token', 'node_type',
+    'origin_node_token', 'origin_space_id', 'has_child', 'title', 'obj_create_time',
+    'obj_edit_time', 'node_create_time', 'creator', 'owner', 'node_creator'
+)
+WIKI_NODE_FIELD_SET = frozenset(WIKI_NODE_FIELDS)
+# 在大量节点间重复出现的字段，驻留后所有节点共享同一个字符串对象
+WIKI_NODE_INTERNED_FIELDS = frozenset((
+    'space_id', 'obj_type', 'parent_node_token', 'node_type', 'origin_space_id',
+    'creator', 'owner', 'node_creator'
+))
+
+class WikiNode:
+    """爬虫和缓存中使用的紧凑节点
+
+    使用 __slots__ 代替飞书返回的原始dict，重复出现的字符串做驻留；
+    未知字段保存在 extra 中，序列化时原样输出。值为None的字段视为不存在。
+    """
+
+    __slots__ = WIKI_NODE_FIELDS + ('children', 'extra')
+
+    @classmethod
+    def from_item(cls, item):
+        """由飞书接口返回的节点dict构造（忽略其中的children）"""
+        node = cls.__new__(cls)
+        for field in WIKI_NODE_FIELDS:
+            value = item.get(field)
+            if type(value) is str and field in WIKI_NODE_INTERNED_FIELDS:
+                value = sys.intern(value)
+            setattr(node, field, value)
+        node.children = None
+        node.extra = {key: value for key, value in item.items() if key not in WIKI_NODE_FIELD_SET and key != 'children'} or None
+        return node
+
+    def copy(self):
+        """不含children的浅拷贝，用于在共享的缓存节点之外组装新的树"""
+        node = WikiNode.__new__(WikiNode)
+        for field in WIKI_NODE_FIELDS:
+            setattr(node, field, getattr(self, field))
+        node.children = None
+        node.extra = self.extra
+        return node
+
+    def to_dict(self):
+        """不含children的节点dict"""
+        record = {field: getattr(self, field) for field in WIKI_NODE_FIELDS if getattr(self, field) is not None}
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    def json_head(self):
+        """节点JSON对象的开头部分（不含children和右括号），直接由字段拼接，不经过中间dict"""
+        parts = []
+        for field in WIKI_NODE_FIELDS:
+            value = getattr(self, field)
+            if value is None:
+                continue
+            if type(value) is str:
+                parts.append(f'"{field}":{encode_basestring_ascii(value)}')
+            elif value is True or value is False:
+                parts.append(f'"{field}":{"true" if value else "false"}')
             else:
-                raise
-    return nodes
+                parts.append(f'"{field}":{json.dumps(value)}')
+        if self.extra:
+            for key, value in self.extra.items():
+                parts.append(f'{encode_basestring_ascii(key)}:{json.dumps(value)}')
+        return '{' + ','.join(parts)
 
-@app.route('/api/wiki/<space_id>/nodes/all', methods=['GET'])
-def get_all_wiki_nodes(space_id):
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer '):
-        return jsonify({"error": "Unauthorized"}), 401
-    user_access_token = auth_header.split(' ')[1]
+def load_wiki_tree(items):
+    """把嵌套的dict节点树（飞书返回或快照中读取）转换为 WikiNode 树"""
+    roots = [WikiNode.from_item(item) for item in items or []]
+    stack = list(zip(items or [], roots))
+    while stack:
+        item, node = stack.pop()
+        children = item.get('children')
+        if children is not None:
+            node.children = [WikiNode.from_item(child) for child in children]
+            stack.extend(zip(children, node.children))
+    return roots
 
-    try:
-        all_nodes = fetch_all_nodes_recursively(space_id, user_access_token)
-        return jsonify(all_nodes)
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Request error: {str(e)}")
-        if e.response is not None:
-            app.logger.error(f"Response status: {e.response.status_code}")
-            app.logger.error(f"Response content: {e.response.text}")
-            # 特别处理速率限制错误
-            if e.response.status_code == 429:
-                return jsonify({"error": "Rate limit exceeded. Please try again later.", "retry_after": 60}), 429
-            try:
-                error_data = e.response.json()
-                return jsonify({"error": error_data}), e.response.status_code
-            except ValueError:
-                return jsonify({"error": e.response.text}), e.response.status_code
-        return jsonify({"error": str(e)}), 500
+def dump_wiki_tree(tree):
+    """把 WikiNode 树直接序列化为JSON文本（非递归），输出与原始dict树一致的结构"""
+    parts = ['[']
+    append = parts.append
+    stack = [[tree or [], 0]]
+    while stack:
+        frame = stack[-1]
+        siblings, index = frame
+        if index == len(siblings):
+            stack.pop()
+            append(']')
+            if stack:
+                append('}')
+            continue
+        frame[1] = index + 1
+        if index:
+            append(',')
+        node = siblings[index]
+        append(node.json_head())
+        if node.children is not None:
+            append(',"children":[')
+            stack.append([node.children, 0])
+        else:
+            append('}')
+    return ''.join(parts)
 
-# 兼容旧版本的API端点，用于导出全量导航数据
-@app.route('/api/wiki/nodes/export', methods=['GET'])
-def export_wiki_nodes():
-    # 从查询参数获取space_id
-    space_id = request.args.get('space_id')
-    if not space_id:
-        return jsonify({"error": "Missing space_id parameter"}), 400
-    
-    # 从查询参数或Authorization头获取token
-    user_access_token = request.args.get('token')
-    if not user_access_token:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            return jsonify({"error": "Unauthorized"}), 401
-        user_access_token = auth_header.split(' ')[1]
+def iter_tree_nodes(tree):
+    """按深度优先顺序遍历嵌套节点树中的所有节点（非递归，避免深树栈溢出）"""
+    stack = list(reversed(tree or []))
+    while stack:
+        node = stack.pop()
+        yield node
+        children = node.children
+        if children:
+            stack.extend(reversed(children))
 
-    app.logger.info(f"SSE export connection attempt started for space_id: {space_id}")
-    
-    # 创建一个队列来传递进度更新
-    import queue
-    progress_queue = queue.Queue()
-    result = []
+# --- JSON 编码 ---
 
-    def generate():
+from flask.json.provider import DefaultJSONProvider
+
+# orjson 为可选依赖，未安装时所有编码回退到标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON编码器：auto（安装了 orjson 时使用）、orjson、stdlib
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'auto').strip().lower()
+if JSON_ENCODER == 'orjson' and orjson is None:
+    app.logger.warning("JSON_ENCODER=orjson but orjson is not installed, falling back to stdlib json")
+FAST_JSON_ENABLED = orjson is not None and JSON_ENCODER != 'stdlib'
+
+def _json_default(obj):
+    """编码器无法直接处理的对象：WikiNode 转为带children的节点dict"""
+    if isinstance(obj, WikiNode):
+        record = obj.to_dict()
+        if obj.children is not None:
+            record['children'] = obj.children
+        return record
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def json_dumps(obj):
+    """编码为紧凑的JSON文本；orjson 不支持的数据（如超过64位的整数）自动回退到标准库"""
+    if FAST_JSON_ENABLED:
         try:
-            app.logger.info(f"SSE export stream generation started for space_id: {space_id}")
-            
-            # 定义进度回调函数
-            def progress_callback(count):
-                progress_queue.put(count)
-            
-            # 在另一个线程中获取所有节点
-            import threading
-            def fetch_nodes():
-                try:
-                    nonlocal result
-                    app.logger.info(f"Starting to fetch all nodes for export, space_id: {space_id}")
-                    all_nodes = fetch_all_nodes_recursively(space_id, user_access_token, progress_callback=progress_callback)
-                    result.extend(all_nodes)
-                    app.logger.info(f"Finished fetching all nodes for export, space_id: {space_id}, node count: {len(result)}")
-                    # 发送完成信号
-                    progress_queue.put(None)
-                except Exception as e:
-                    app.logger.error(f"Error while fetching nodes for export, space_id: {space_id}, error: {str(e)}")
-                    # 发送错误信号
-                    progress_queue.put(e)
-            
-            fetch_thread = threading.Thread(target=fetch_nodes)
-            fetch_thread.start()
-            
-            # 实时发送进度更新
-            while True:
+            return orjson.dumps(obj, default=_json_default).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'), default=_json_default)
+
+def json_dumps_bytes(obj):
+    """编码为UTF-8的JSON字节串，用于响应体和请求体，省去一次字符串到字节的转换"""
+    if FAST_JSON_ENABLED:
+        try:
+            return orjson.dumps(obj, default=_json_default)
+        except TypeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+def encode_wiki_tree(tree):
+    """把 WikiNode 树编码为JSON字节串
+
+    有 orjson 时由其直接遍历节点；否则使用 dump_wiki_tree，比标准库逐节点回调 default 更快。
+    """
+    if FAST_JSON_ENABLED:
+        try:
+            return orjson.dumps(tree, default=_json_default)
+        except TypeError:
+            pass
+    return dump_wiki_tree(tree).encode('utf-8')
+
+class FastJSONProvider(DefaultJSONProvider):
+    """jsonify 使用的JSON provider
+
+    非调试模式下用 orjson 直接生成响应字节；日期、dataclass 等类型仍交给Flask默认的 default 处理，
+    输出与标准库一致。orjson 不可用或编码失败时使用父类实现。
+    """
+
+    def _default(self, obj):
+        if isinstance(obj, WikiNode):
+            return _json_default(obj)
+        return self.default(obj)
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault('default', self._default)
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if not FAST_JSON_ENABLED or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            body = orjson.dumps(obj, default=self._default, option=option)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+app.logger.info(f"JSON encoder: {'orjson' if FAST_JSON_ENABLED else 'stdlib'}")
+
+# 判断子树是否变化时比较的节点字段
+SNAPSHOT_SIGNATURE_FIELDS = ('obj_edit_time', 'node_create_time', 'has_child')
+
+# 流式返回扁平节点记录时保留的字段，客户端据 parent_node_token 自行组装节点树
+STREAM_NODE_FIELDS = ('node_token', 'parent_node_token', 'title', 'has_child', 'obj_token', 'obj_type')
+
+def stream_node_record(node, parent_node_token=None):
+    """提取流式返回用的扁平节点记录"""
+    record = {field: getattr(node, field) for field in STREAM_NODE_FIELDS}
+    if not record['parent_node_token']:
+        record['parent_node_token'] = parent_node_token or ''
+    return record
+
+def iter_stream_records(tree):
+    """按先序把嵌套节点树展开为扁平节点记录"""
+    stack = [(node, '') for node in reversed(tree or [])]
+    while stack:
+        node, parent_node_token = stack.pop()
+        yield stream_node_record(node, parent_node_token)
+        stack.extend((child, node.node_token) for child in reversed(node.children or []))
+
+# 扁平节点流式返回时每个SSE事件最多携带的节点数
+NODE_STREAM_BATCH_SIZE = int(os.getenv('NODE_STREAM_BATCH_SIZE', '500'))
+
+def iter_stream_record_batches(tree, batch_size=None):
+    """把节点树展开为扁平节点记录，每 NODE_STREAM_BATCH_SIZE 个一批产出，不在内存中展开整棵树"""
+    batch_size = max(1, int(batch_size or NODE_STREAM_BATCH_SIZE))
+    batch = []
+    for record in iter_stream_records(tree):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+# 爬取期间长时间没有数据时发送SSE注释行，以便及时发现客户端断开并取消爬取
+SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', '5'))
+
+class NodeStreamBuffer:
+    """在爬取线程和SSE生成器之间传递扁平节点记录
+
+    爬取线程每挂载一页节点就追加到缓冲区，SSE生成器每次取走全部已就绪的节点，
+    按 NODE_STREAM_BATCH_SIZE 分批发送，避免每页一个事件的开销。
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = max(1, int(batch_size or NODE_STREAM_BATCH_SIZE))
+        self.sent_count = 0
+        self._records = []
+        self._lock = threading.Lock()
+
+    def add(self, records):
+        with self._lock:
+            self._records.extend(records)
+
+    def drain_batches(self):
+        """取走缓冲区中的全部节点，返回分批后的列表"""
+        with self._lock:
+            records, self._records = self._records, []
+        self.sent_count += len(records)
+        return [records[i:i + self.batch_size] for i in range(0, len(records), self.batch_size)]
+
+# 爬取引擎配置
+CRAWLER_MAX_WORKERS = int(os.getenv('CRAWLER_MAX_WORKERS', '8'))  # 全局抓取线程数上限
+CRAWLER_STRATEGY = os.getenv('CRAWLER_STRATEGY', 'bfs')  # 遍历顺序：bfs（广度优先）或 dfs（深度优先）
+
+class CrawlCancelled(Exception):
+    """爬取被取消（例如SSE客户端已断开）"""
+    pass
+
+class WikiTreeCrawler:
+    """知识空间节点树爬取引擎
+
+    待抓取的分页请求（父节点token + page_token）放入frontier队列，
+    由一个固定大小的线程池统一消费。并发数不再随树的深度和宽度增长，
+    实际请求速率只受速率限制器约束。
+    """
+
+    def __init__(self, space_id, user_access_token, root_node_token=None, max_workers=None, strategy=None, progress_callback=None, max_retries=3, previous_tree=None, node_callback=None, cancel_event=None, page_callback=None):
+        """
+        Args:
+            space_id: 知识空间ID
+            user_access_token: 用户访问令牌
+            root_node_token: 起始父节点token，为None时从知识空间根部开始
+            max_workers: 并发抓取的线程数，默认使用 CRAWLER_MAX_WORKERS
+            strategy: 'bfs' 或 'dfs'，默认使用 CRAWLER_STRATEGY
+            progress_callback: 每抓取到一页时调用，参数为该页的节点数
+            max_retries: 单页遇到网络错误时的最大重试次数
+            previous_tree: 上一次爬取得到的节点树，提供时对未变化的子树直接复用（增量刷新）
+            node_callback: 新节点挂载到树上后调用，参数为扁平节点记录列表（见 stream_node_record）
+            cancel_event: threading.Event，被set后停止派发新请求并丢弃未开始的请求，run() 抛出 CrawlCancelled
+            page_callback: 每成功抓取一页时调用，参数为 (task, data)，用于写入检查点
+        """
+        self.space_id = space_id
+        self.user_access_token = user_access_token
+        self.root_node_token = root_node_token
+        self.max_workers = max(1, int(max_workers or CRAWLER_MAX_WORKERS))
+        self.strategy = (strategy or CRAWLER_STRATEGY).lower()
+        if self.strategy not in ('bfs', 'dfs'):
+            raise ValueError(f"Unsupported crawl strategy: {self.strategy}")
+        self.progress_callback = progress_callback
+        self.node_callback = node_callback
+        self.cancel_event = cancel_event or threading.Event()
+        self.page_callback = page_callback
+        self.failed_count = 0
+        self.root_failed = False
+        self.max_retries = max_retries
+        self.request_count = 0
+        self.node_count = 0
+        self._frontier = deque()
+        # node_token -> 节点，用于O(1)地把子节点挂载到父节点上
+        self.node_index = {}
+        self.reused_count = 0
+        self._previous_index = {node.node_token: node for node in iter_tree_nodes(previous_tree)} if previous_tree else {}
+
+    def _fetch_page(self, parent_node_token, page_token):
+        """抓取单页子节点，网络错误时进行指数退避重试"""
+        url = f"https://open.feishu.cn/open-apis/wiki/v2/spaces/{self.space_id}/nodes"
+        headers = {"Authorization": f"Bearer {self.user_access_token}"}
+        params = {"page_size": 50}
+        if parent_node_token:
+            params['parent_node_token'] = parent_node_token
+        if page_token:
+            params['page_token'] = page_token
+
+        retry_count = 0
+        while True:
+            try:
+                # 限流由 request_with_backoff 按接口族和用户自动处理
+                response = request_with_backoff(url, headers, params)
+                return response.json().get("data", {})
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if retry_count >= self.max_retries:
+                    app.logger.error(f"Max retries reached for network error: {str(e)}")
+                    raise
+                retry_count += 1
+                backoff_time = 2 ** retry_count  # 指数退避
+                app.logger.warning(f"Network error, retrying in {backoff_time} seconds (attempt {retry_count}/{self.max_retries})")
+                # 等待期间被取消时立即放弃重试
+                if self.cancel_event.wait(backoff_time):
+                    raise CrawlCancelled(f"Crawl cancelled while retrying page of {parent_node_token}")
+
+    def _next_task(self):
+        if self.strategy == 'bfs':
+            return self._frontier.popleft()
+        return self._frontier.pop()
+
+    def _handle_page(self, task, data, root_nodes):
+        """处理一页抓取结果：挂载子节点，并把后续分页和子节点加入frontier"""
+        parent_node_token, _ = task
+        items = data.get("items", [])
+        node_index = self.node_index
+        # 过滤掉缺少node_token的节点，以及分页漂移导致的重复节点
+        valid_items = [WikiNode.from_item(item) for item in items if item.get('node_token') and item['node_token'] not in node_index]
+
+        if parent_node_token == self.root_node_token:
+            target = root_nodes
+        else:
+            parent = node_index.get(parent_node_token)
+            if parent is None:
+                app.logger.warning(f"Parent node {parent_node_token} not found, dropping {len(valid_items)} nodes")
+                return
+            if parent.children is None:
+                parent.children = []
+            target = parent.children
+        for item in valid_items:
+            node_index[item.node_token] = item
+        target.extend(valid_items)
+        self.node_count += len(valid_items)
+
+        if self.progress_callback:
+            try:
+                self.progress_callback(len(items))
+            except Exception as e:
+                # 记录错误但不中断主流程
+                app.logger.error(f"Progress callback error: {str(e)}")
+        if valid_items and self.node_callback:
+            self._emit_nodes([stream_node_record(item, parent_node_token) for item in valid_items])
+
+        # 同一父节点的下一页优先入队，保证分页顺序
+        if data.get('has_more') and data.get('page_token'):
+            self._frontier.append((parent_node_token, data.get('page_token')))
+
+        children_tasks = [(item.node_token, None) for item in valid_items if item.has_child and not self._reuse_subtree(item)]
+        if self.strategy == 'dfs':
+            # 深度优先时从栈顶取任务，逆序入栈使第一个子节点最先被处理
+            children_tasks.reverse()
+        self._frontier.extend(children_tasks)
+
+    def _reuse_subtree(self, item):
+        """节点的编辑时间、创建时间和has_child都未变化时，直接沿用上次快照中的子树"""
+        previous = self._previous_index.get(item.node_token)
+        if previous is None or previous.children is None:
+            return False
+        if any(getattr(previous, field) != getattr(item, field) for field in SNAPSHOT_SIGNATURE_FIELDS):
+            return False
+
+        item.children = previous.children
+        reused = 0
+        records = []
+        # 按先序遍历，保证流式返回的兄弟节点顺序与原树一致
+        stack = [(node, item.node_token) for node in reversed(previous.children)]
+        while stack:
+            node, parent_node_token = stack.pop()
+            if node.node_token in self.node_index:
+                continue
+            self.node_index[node.node_token] = node
+            reused += 1
+            if self.node_callback:
+                records.append(stream_node_record(node, parent_node_token))
+            stack.extend((child, node.node_token) for child in reversed(node.children or []))
+        self.reused_count += reused
+        self.node_count += reused
+        if self.progress_callback and reused:
+            try:
+                self.progress_callback(reused)
+            except Exception as e:
+                app.logger.error(f"Progress callback error: {str(e)}")
+        if records:
+            self._emit_nodes(records)
+        return True
+
+    def _emit_nodes(self, records):
+        if not self.node_callback:
+            return
+        try:
+            self.node_callback(records)
+        except Exception as e:
+            # 记录错误但不中断主流程
+            app.logger.error(f"Node callback error: {str(e)}")
+
+    def _handle_page_error(self, task, exc, root_nodes):
+        parent_node_token, _ = task
+        self.failed_count += 1
+        if parent_node_token == self.root_node_token:
+            # 根层级抓取失败：没有任何数据时向上抛出，否则保留已获取的数据
+            if not root_nodes:
+                raise exc
+            self.root_failed = True
+            app.logger.warning(f"Error occurred but continuing with already fetched data: {str(exc)}")
+        else:
+            app.logger.error(f'{parent_node_token} generated an exception: {exc}')
+            # 子节点列表不完整：标记为未加载，增量刷新时不会沿用，而是重新抓取
+            parent = self.node_index.get(parent_node_token)
+            if parent is not None:
+                parent.children = None
+
+    def cancel(self):
+        """请求取消爬取，正在进行的请求完成后不再派发新请求"""
+        self.cancel_event.set()
+
+    def _abort(self, in_flight):
+        """丢弃frontier和尚未开始的请求，返回因此节省的请求数（不含这些页面下尚未发现的子节点）"""
+        saved = len(self._frontier)
+        self._frontier.clear()
+        for future in in_flight:
+            if future.cancel():
+                saved += 1
+        return saved
+
+    def _replay(self, pages, root_nodes):
+        """按原顺序重放检查点中已抓取的页面，frontier中只保留尚未抓取的分页请求"""
+        fetched = set()
+        for task, data in pages:
+            task = tuple(task)
+            self._handle_page(task, data, root_nodes)
+            fetched.add(task)
+        self._frontier = deque(task for task in self._frontier if task not in fetched)
+        app.logger.info(f"Resumed crawl for space_id: {self.space_id}, replayed pages: {len(fetched)}, nodes: {self.node_count}, pending requests: {len(self._frontier)}")
+
+    def run(self, page_token=None, replay_pages=None):
+        """执行爬取并返回嵌套的节点树（子节点位于 children 字段）
+
+        Args:
+            replay_pages: 检查点中已抓取的 (task, data) 列表，提供时从中断处继续爬取
+        """
+        root_nodes = []
+        self._frontier.append((self.root_node_token, page_token))
+        if replay_pages:
+            self._replay(replay_pages, root_nodes)
+        in_flight = {}
+        cancelled = False
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='wiki-crawler')
+        try:
+            while self._frontier or in_flight:
+                if self.cancel_event.is_set():
+                    cancelled = True
+                    saved = self._abort(in_flight)
+                    app.logger.info(f"Crawl cancelled for space_id: {self.space_id}, requests made: {self.request_count}, pending requests dropped: {saved}, nodes fetched: {self.node_count}")
+                    raise CrawlCancelled(f"Crawl cancelled for space_id: {self.space_id}")
+
+                while self._frontier and len(in_flight) < self.max_workers:
+                    task = self._next_task()
+                    in_flight[executor.submit(self._fetch_page, task[0], task[1])] = task
+                    self.request_count += 1
+
+                # 带超时等待，保证取消能被及时发现
+                done, _ = wait(in_flight, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = in_flight.pop(future)
+                    try:
+                        data = future.result()
+                    except CrawlCancelled:
+                        continue
+                    except Exception as exc:
+                        self._handle_page_error(task, exc, root_nodes)
+                        continue
+                    if self.page_callback:
+                        # 在挂载前回调，此时页面数据尚未被加入children字段
+                        self.page_callback(task, data)
+                    self._handle_page(task, data, root_nodes)
+        finally:
+            self._abort(in_flight)
+            # 取消时不等待正在进行的请求结束，避免阻塞调用方
+            executor.shutdown(wait=not cancelled, cancel_futures=True)
+
+        app.logger.info(f"Crawl finished for space_id: {self.space_id}, requests: {self.request_count}, nodes: {self.node_count}, reused: {self.reused_count}")
+        return root_nodes
+
+def fetch_all_nodes_recursively(space_id, user_access_token, parent_node_token=None, page_token=None, progress_callback=None):
+    """获取指定父节点下的完整节点树，内部使用 WikiTreeCrawler 统一调度"""
+    crawler = WikiTreeCrawler(space_id, user_access_token, root_node_token=parent_node_token, progress_callback=progress_callback)
+    return crawler.run(page_token=page_token)
+
+# --- 用户身份与知识空间快照 ---
+
+USER_SCOPE_TTL = int(os.getenv('USER_SCOPE_TTL', '1800'))
+_user_scope_cache = {}  # 令牌指纹 -> (用户范围, 过期时间)
+_user_scope_lock = threading.Lock()
+
+def resolve_user_scope(user_access_token):
+    """返回用户的稳定身份标识，用于按用户隔离缓存的数据
+
+    user_access_token 会定期轮换，因此通过 user_info 接口换取 open_id 作为缓存键；
+    获取失败时退化为令牌指纹，只在同一令牌内复用数据。
+    """
+    fingerprint = token_fingerprint(user_access_token)
+    now = time.time()
+    with _user_scope_lock:
+        cached = _user_scope_cache.get(fingerprint)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    scope = None
+    try:
+        response = request_with_backoff("https://open.feishu.cn/open-apis/authen/v1/user_info", {"Authorization": f"Bearer {user_access_token}"})
+        data = response.json()
+        if data.get('code') == 0:
+            open_id = data.get('data', {}).get('open_id')
+            if open_id:
+                scope = f"user:{open_id}"
+    except requests.exceptions.RequestException as e:
+        app.logger.warning(f"Failed to resolve user scope, falling back to token fingerprint: {str(e)}")
+
+    # 退化的范围只短暂缓存，下次请求时重新尝试
+    ttl = USER_SCOPE_TTL if scope else 60
+    scope = scope or f"token:{fingerprint}"
+    with _user_scope_lock:
+        if len(_user_scope_cache) > 10000:
+            for key in [k for k, (_, expires_at) in _user_scope_cache.items() if expires_at <= now]:
+                del _user_scope_cache[key]
+        _user_scope_cache[fingerprint] = (scope, now + ttl)
+    return scope
+
+WIKI_SNAPSHOT_MIN_REFRESH_SECONDS = int(os.getenv('WIKI_SNAPSHOT_MIN_REFRESH_SECONDS', '60'))  # 快照在此时间内不刷新
+WIKI_SNAPSHOT_FULL_REFRESH_SECONDS = int(os.getenv('WIKI_SNAPSHOT_FULL_REFRESH_SECONDS', '3600'))  # 超过此时间做一次完整爬取
+
+class WikiSnapshotStore:
+    """知识空间节点树快照的本地存储（SQLite）
+
+    快照按 (space_id, 用户范围) 保存，用户只能读到自己爬取得到的节点树。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS wiki_snapshots ("
+            "space_id TEXT NOT NULL, scope TEXT NOT NULL, tree TEXT NOT NULL, node_count INTEGER NOT NULL, "
+            "fetched_at REAL NOT NULL, full_crawl_at REAL NOT NULL, PRIMARY KEY (space_id, scope))"
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get(self, space_id, scope):
+        row = self._connection().execute(
+            "SELECT tree, node_count, fetched_at, full_crawl_at FROM wiki_snapshots WHERE space_id = ? AND scope = ?",
+            (space_id, scope)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            tree = load_wiki_tree(json.loads(row[0]))
+        except ValueError:
+            app.logger.warning(f"Corrupted wiki snapshot for space_id: {space_id}, ignoring")
+            return None
+        return {"tree": tree, "node_count": row[1], "fetched_at": row[2], "full_crawl_at": row[3]}
+
+    def put(self, space_id, scope, tree, node_count, full_crawl_at):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO wiki_snapshots (space_id, scope, tree, node_count, fetched_at, full_crawl_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (space_id, scope, dump_wiki_tree(tree), node_count, time.time(), full_crawl_at)
+        )
+
+wiki_snapshot_store = WikiSnapshotStore(os.getenv('WIKI_SNAPSHOT_DB_PATH', os.path.join(DATA_DIR, 'wiki_snapshots.db')))
+
+# --- 爬取检查点 ---
+
+CRAWL_CHECKPOINT_TTL = int(os.getenv('CRAWL_CHECKPOINT_TTL', str(24 * 3600)))  # 检查点保留时间（秒）
+CRAWL_CHECKPOINT_FLUSH_PAGES = int(os.getenv('CRAWL_CHECKPOINT_FLUSH_PAGES', '20'))  # 每抓取多少页写入一次
+CRAWL_CHECKPOINT_STALE_SECONDS = int(os.getenv('CRAWL_CHECKPOINT_STALE_SECONDS', '300'))  # 'running' 检查点超过该时间未更新即视为进程已退出，可以恢复
+
+class CrawlCheckpointStore:
+    """爬取检查点的本地存储（SQLite）
+
+    按顺序保存每次爬取已抓取的页面。待抓取的frontier不单独保存，
+    恢复时重放这些页面即可重新得到，二者不会出现不一致。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_checkpoints ("
+            "crawl_id TEXT PRIMARY KEY, space_id TEXT NOT NULL, scope TEXT NOT NULL, status TEXT NOT NULL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_pages ("
+            "crawl_id TEXT NOT NULL, seq INTEGER NOT NULL, task TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (crawl_id, seq))"
+        )
+        self.prune()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def create(self, crawl_id, space_id, scope):
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR IGNORE INTO crawl_checkpoints (crawl_id, space_id, scope, status, created_at, updated_at) VALUES (?, ?, ?, 'running', ?, ?)",
+            (crawl_id, space_id, scope, now, now)
+        )
+
+    def get(self, crawl_id):
+        row = self._connection().execute(
+            "SELECT space_id, scope, status, updated_at FROM crawl_checkpoints WHERE crawl_id = ? AND updated_at > ?",
+            (crawl_id, time.time() - CRAWL_CHECKPOINT_TTL)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"crawl_id": crawl_id, "space_id": row[0], "scope": row[1], "status": row[2], "updated_at": row[3]}
+
+    def latest(self, space_id, scope):
+        """返回该用户在该知识空间最近一次被中断的爬取ID（完整成功的爬取不会留下检查点）
+
+        进程被杀死时检查点停留在 'running'，超过 CRAWL_CHECKPOINT_STALE_SECONDS 未更新的 'running'
+        检查点同样视为中断；仍在更新的属于其他worker中正在进行的爬取，不会被抢走。
+        """
+        now = time.time()
+        row = self._connection().execute(
+            "SELECT crawl_id FROM crawl_checkpoints WHERE space_id = ? AND scope = ? AND updated_at > ? "
+            "AND (status = 'interrupted' OR (status = 'running' AND updated_at < ?)) "
+            "ORDER BY updated_at DESC LIMIT 1",
+            (space_id, scope, now - CRAWL_CHECKPOINT_TTL, now - CRAWL_CHECKPOINT_STALE_SECONDS)
+        ).fetchone()
+        return row[0] if row else None
+
+    def load_pages(self, crawl_id):
+        rows = self._connection().execute(
+            "SELECT task, data FROM crawl_pages WHERE crawl_id = ? ORDER BY seq", (crawl_id,)
+        ).fetchall()
+        return [(tuple(json.loads(task)), json.loads(data)) for task, data in rows]
+
+    def append_pages(self, crawl_id, first_seq, pages, status='running'):
+        """追加已序列化的页面，pages 为 (task_json, data_json) 列表"""
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO crawl_pages (crawl_id, seq, task, data) VALUES (?, ?, ?, ?)",
+                [(crawl_id, first_seq + i, task, data) for i, (task, data) in enumerate(pages)]
+            )
+            conn.execute("UPDATE crawl_checkpoints SET status = ?, updated_at = ? WHERE crawl_id = ?", (status, time.time(), crawl_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def delete(self, crawl_id):
+        conn = self._connection()
+        conn.execute("DELETE FROM crawl_pages WHERE crawl_id = ?", (crawl_id,))
+        conn.execute("DELETE FROM crawl_checkpoints WHERE crawl_id = ?", (crawl_id,))
+
+    def prune(self):
+        """删除过期的检查点"""
+        conn = self._connection()
+        expired = [row[0] for row in conn.execute(
+            "SELECT crawl_id FROM crawl_checkpoints WHERE updated_at <= ?", (time.time() - CRAWL_CHECKPOINT_TTL,)
+        ).fetchall()]
+        for crawl_id in expired:
+            self.delete(crawl_id)
+
+crawl_checkpoint_store = CrawlCheckpointStore(os.getenv('CRAWL_CHECKPOINT_DB_PATH', os.path.join(DATA_DIR, 'crawl_checkpoints.db')))
+
+class CrawlCheckpoint:
+    """一次爬取的检查点写入器：缓存已抓取的页面，每 CRAWL_CHECKPOINT_FLUSH_PAGES 页批量写入"""
+
+    def __init__(self, store, crawl_id, next_seq=0):
+        self.store = store
+        self.crawl_id = crawl_id
+        self.next_seq = next_seq
+        self.disabled = False
+        self._pending = []
+
+    def record(self, task, data):
+        if self.disabled:
+            return
+        # 立即序列化：爬虫随后会在这些节点上挂载children
+        self._pending.append((json.dumps(task), json.dumps(data, ensure_ascii=False)))
+        if len(self._pending) >= CRAWL_CHECKPOINT_FLUSH_PAGES:
+            self.flush()
+
+    def flush(self, status='running'):
+        if self.disabled:
+            return
+        try:
+            self.store.append_pages(self.crawl_id, self.next_seq, self._pending, status=status)
+            self.next_seq += len(self._pending)
+            self._pending = []
+        except sqlite3.Error as e:
+            # 检查点写入失败不影响爬取本身
+            app.logger.error(f"Failed to write crawl checkpoint {self.crawl_id}, disabling checkpoints: {str(e)}")
+            self.disabled = True
+
+# --- 知识库节点解析缓存 ---
+
+WIKI_NODE_RESOLUTION_TTL = int(os.getenv('WIKI_NODE_RESOLUTION_TTL', str(7 * 24 * 3600)))  # 解析结果保留时间（秒），0表示不缓存
+
+class WikiNodeResolutionStore:
+    """知识库节点token -> (obj_type, obj_token, title) 的长期缓存（SQLite）
+
+    节点对应的文档几乎不会变化，爬取节点树和加载子树时顺带写入，
+    之后的 get_node 调用可直接命中。缓存不区分用户，命中的结果没有经过请求者的权限校验，
+    调用方必须先用请求者自己的token成功获取文档内容，才能把 title、obj_token 等字段返回给请求者。
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS wiki_node_objects ("
+            "node_token TEXT PRIMARY KEY, space_id TEXT, obj_type TEXT NOT NULL, obj_token TEXT NOT NULL, "
+            "title TEXT, updated_at REAL NOT NULL)"
+        )
+        self.prune()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get(self, node_token):
+        row = self._connection().execute(
+            "SELECT space_id, obj_type, obj_token, title, updated_at FROM wiki_node_objects WHERE node_token = ?",
+            (node_token,)
+        ).fetchone()
+        with self._lock:
+            if row is None or time.time() - row[4] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {"node_token": node_token, "space_id": row[0], "obj_type": row[1], "obj_token": row[2], "title": row[3]}
+
+    def put_many(self, nodes):
+        """写入 WikiNode 或节点dict，缺少 obj_token/obj_type 的节点跳过"""
+        now = time.time()
+        rows = []
+        for node in nodes:
+            if isinstance(node, WikiNode):
+                row = (node.node_token, node.space_id, node.obj_type, node.obj_token, node.title, now)
+            else:
+                row = (node.get('node_token'), node.get('space_id'), node.get('obj_type'), node.get('obj_token'), node.get('title'), now)
+            if row[0] and row[2] and row[3]:
+                rows.append(row)
+        if not rows:
+            return 0
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO wiki_node_objects (node_token, space_id, obj_type, obj_token, title, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows)
+
+    def prune(self):
+        """删除过期的解析结果"""
+        self._connection().execute("DELETE FROM wiki_node_objects WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def stats(self):
+        entries = self._connection().execute("SELECT COUNT(*) FROM wiki_node_objects").fetchone()[0]
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+wiki_node_resolution_store = WikiNodeResolutionStore(
+    os.getenv('WIKI_NODE_RESOLUTION_DB_PATH', os.path.join(DATA_DIR, 'wiki_nodes.db')),
+    WIKI_NODE_RESOLUTION_TTL
+)
+
+def remember_node_resolutions(nodes):
+    """记录节点的解析结果，写入失败只记录日志"""
+    if WIKI_NODE_RESOLUTION_TTL <= 0:
+        return
+    try:
+        count = wiki_node_resolution_store.put_many(nodes)
+        app.logger.info(f"Recorded {count} wiki node resolutions")
+    except sqlite3.Error as e:
+        app.logger.error(f"Failed to record wiki node resolutions: {str(e)}")
+
+
+# 比较两次快照时，这些字段变化即视为节点被更新
+NODE_DIFF_FIELDS = ('title', 'parent_node_token', 'obj_edit_time', 'node_create_time', 'has_child', 'obj_type', 'obj_token')
+
+def diff_wiki_trees(old_tree, new_tree):
+    """计算两棵节点树之间的差异
+
+    Returns:
+        dict: added（新增节点，父节点在前）、updated（字段变化的节点）、removed（被删除的node_token）
+    """
+    old_index = {node.node_token: node for node in iter_tree_nodes(old_tree)}
+    added = []
+    updated = []
+    seen = set()
+    for node in iter_tree_nodes(new_tree):
+        token = node.node_token
+        seen.add(token)
+        previous = old_index.get(token)
+        if previous is None:
+            added.append(node.to_dict())
+        elif previous is not node and any(getattr(previous, field) != getattr(node, field) for field in NODE_DIFF_FIELDS):
+            updated.append(node.to_dict())
+    removed = [token for token in old_index if token not in seen]
+    return {"added": added, "updated": updated, "removed": removed}
+
+def snapshot_allows_incremental(snapshot):
+    """快照存在且距上次完整爬取未超过 WIKI_SNAPSHOT_FULL_REFRESH_SECONDS 时可以增量刷新"""
+    return snapshot is not None and time.time() - snapshot['full_crawl_at'] < WIKI_SNAPSHOT_FULL_REFRESH_SECONDS
+
+def crawl_space_tree(space_id, user_access_token, scope, progress_callback=None, snapshot=None, node_callback=None, cancel_event=None, crawl_id=None):
+    """爬取知识空间节点树并保存快照
+
+    Args:
+        snapshot: 已有快照，提供且未到完整刷新时间时只重新抓取发生变化的子树
+        node_callback: 透传给 WikiTreeCrawler，用于流式返回扁平节点记录
+        cancel_event: 透传给 WikiTreeCrawler，取消时抛出 CrawlCancelled 且不保存快照
+        crawl_id: 完整爬取时按此ID写入检查点；已有检查点时从中断处继续。爬取全部成功后删除检查点，
+            有页面失败时检查点保留为 'interrupted'，下次完整爬取从中断处继续并重试失败的页面
+
+    Returns:
+        list: 嵌套的节点树
+    """
+    incremental = snapshot_allows_incremental(snapshot)
+    # 增量刷新通常很快，只对完整爬取写检查点
+    checkpoint = None
+    replay_pages = None
+    if crawl_id and not incremental:
+        try:
+            replay_pages = crawl_checkpoint_store.load_pages(crawl_id)
+            crawl_checkpoint_store.create(crawl_id, space_id, scope)
+            checkpoint = CrawlCheckpoint(crawl_checkpoint_store, crawl_id, next_seq=len(replay_pages))
+        except (sqlite3.Error, ValueError) as e:
+            app.logger.error(f"Failed to load crawl checkpoint {crawl_id}, crawling from scratch: {str(e)}")
+            replay_pages = None
+    crawler = WikiTreeCrawler(
+        space_id,
+        user_access_token,
+        progress_callback=progress_callback,
+        previous_tree=snapshot['tree'] if incremental else None,
+        node_callback=node_callback,
+        cancel_event=cancel_event,
+        page_callback=checkpoint.record if checkpoint else None
+    )
+    try:
+        tree = crawler.run(replay_pages=replay_pages)
+    except Exception:
+        if checkpoint:
+            # 保留已抓取的页面，下次从中断处继续
+            checkpoint.flush(status='interrupted')
+            app.logger.info(f"Crawl checkpoint {crawl_id} saved, pages: {checkpoint.next_seq}")
+        raise
+    if crawler.failed_count:
+        app.logger.warning(f"Crawl {crawl_id} of space_id {space_id} finished with {crawler.failed_count} failed pages")
+    if checkpoint:
+        if crawler.failed_count:
+            # 失败的页面没有写入检查点，恢复时会重新抓取
+            checkpoint.flush(status='interrupted')
+        else:
+            try:
+                crawl_checkpoint_store.delete(crawl_id)
+            except sqlite3.Error as e:
+                app.logger.error(f"Failed to delete crawl checkpoint {crawl_id}: {str(e)}")
+    try:
+        if incremental and not crawler.root_failed:
+            # 失败父节点的 children 已置为 None，下次增量刷新会重新抓取
+            full_crawl_at = snapshot['full_crawl_at']
+        elif crawler.failed_count:
+            # 结果不完整，不记为完整爬取：下次刷新直接进行完整爬取（从检查点继续）
+            full_crawl_at = 0
+        else:
+            full_crawl_at = time.time()
+        wiki_snapshot_store.put(space_id, scope, tree, crawler.node_count, full_crawl_at)
+    except sqlite3.Error as e:
+        app.logger.error(f"Failed to save wiki snapshot for space_id: {space_id}, error: {str(e)}")
+    # 爬取结果中已有每个节点的 obj_token/obj_type，顺带供 get_node 解析使用
+    remember_node_resolutions(iter_tree_nodes(tree))
+    return tree
+
+# --- 爬取任务合并（single-flight） ---
+
+class CrawlSubscription:
+    """订阅者在共享爬取任务中的接收端：queue 中放 'nodes' 标记、None（完成）或异常，节点记录在 buffer 中"""
+
+    def __init__(self):
+        import queue
+        self.queue = queue.Queue()
+        self.buffer = NodeStreamBuffer()
+
+class SharedCrawl:
+    """一次正在进行的知识空间爬取，可被多个请求共享
+
+    每页新节点广播给所有订阅者；中途加入的订阅者先收到已爬取节点的回放，
+    之后与其他订阅者收到相同的后续节点和最终结果。
+    """
+
+    def __init__(self, coordinator, key, space_id, user_access_token, scope, snapshot=None, crawl_id=None):
+        self.coordinator = coordinator
+        self.key = key
+        # 客户端断线后可凭此ID重新连接；完整爬取的检查点也以此ID保存
+        self.crawl_id = crawl_id or uuid.uuid4().hex
+        self.space_id = space_id
+        self.user_access_token = user_access_token
+        self.scope = scope
+        self.snapshot = snapshot
+        self.incremental = snapshot_allows_incremental(snapshot)
+        self.cancel_event = threading.Event()
+        self.started_at = time.time()
+        self.finished = False
+        self.result = None
+        self.error = None
+        self._records = []
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f'wiki-crawl-{self.space_id}', daemon=True).start()
+
+    def _run(self):
+        try:
+            tree = crawl_space_tree(
+                self.space_id,
+                self.user_access_token,
+                self.scope,
+                snapshot=self.snapshot,
+                node_callback=self._on_nodes,
+                cancel_event=self.cancel_event,
+                crawl_id=self.crawl_id
+            )
+            self._finish(result=tree)
+        except CrawlCancelled as e:
+            app.logger.info(f"Shared crawl cancelled, space_id: {self.space_id}")
+            self._finish(error=e)
+        except Exception as e:
+            app.logger.error(f"Shared crawl failed, space_id: {self.space_id}, error: {str(e)}")
+            self._finish(error=e)
+
+    def _on_nodes(self, records):
+        with self._lock:
+            self._records.extend(records)
+            for subscription in self._subscriptions:
+                subscription.buffer.add(records)
+                subscription.queue.put('nodes')
+
+    def _finish(self, result=None, error=None):
+        # 先从协调器注销，之后到来的请求会发起新的爬取，而不会加入这个即将结束的爬取
+        self.coordinator._finished(self)
+        with self._lock:
+            self.result = result
+            self.error = error
+            self.finished = True
+            # 最终结果已保存，回放用的节点记录不再需要
+            self._records = []
+            for subscription in self._subscriptions:
+                subscription.queue.put(error)
+
+    def subscribe(self):
+        """加入爬取任务，返回 CrawlSubscription"""
+        subscription = CrawlSubscription()
+        with self._lock:
+            if self.finished:
+                # 回放记录已释放，由最终结果重新展开，避免扁平模式的订阅者收到空树
+                if self.result:
+                    subscription.buffer.add(list(iter_stream_records(self.result)))
+                    subscription.queue.put('nodes')
+                subscription.queue.put(self.error)
+                return subscription
+            if self._records:
+                subscription.buffer.add(list(self._records))
+                subscription.queue.put('nodes')
+            self._subscriptions.append(subscription)
+        return subscription
+
+    def wait(self, subscription):
+        """阻塞直到爬取结束，返回节点树；爬取失败时抛出对应异常"""
+        while True:
+            item = subscription.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                return self.result
+            # 不需要逐批节点，直接丢弃释放内存
+            subscription.buffer.drain_batches()
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+            return len(self._subscriptions)
+
+class WikiCrawlCoordinator:
+    """按 (space_id, 用户身份) 合并并发的爬取请求
+
+    同一用户同时打开同一知识空间时只发起一次爬取，其余请求订阅该爬取的进度和结果。
+    用户身份由 resolve_user_scope 得到，不同用户之间从不共享爬取结果，避免越权看到节点。
+    所有订阅者都离开后取消爬取。
+    """
+
+    def __init__(self):
+        self._crawls = {}
+        self._lock = threading.Lock()
+
+    def _resumable_crawl_id(self, space_id, scope, snapshot, crawl_id, resume):
+        """查找可以恢复的检查点：优先使用客户端重连时指定的crawl_id，否则在 resume 时取该用户最近一次被中断的完整爬取"""
+        if snapshot_allows_incremental(snapshot):
+            return None
+        try:
+            if crawl_id:
+                checkpoint = crawl_checkpoint_store.get(crawl_id)
+                # 只恢复同一用户、同一知识空间的检查点
+                if checkpoint and checkpoint['space_id'] == space_id and checkpoint['scope'] == scope:
+                    return crawl_id
+                return None
+            if not resume:
+                return None
+            return crawl_checkpoint_store.latest(space_id, scope)
+        except sqlite3.Error as e:
+            app.logger.error(f"Failed to look up crawl checkpoints for space_id: {space_id}, error: {str(e)}")
+            return None
+
+    def attach(self, space_id, user_access_token, scope, snapshot=None, crawl_id=None, resume=True):
+        """订阅正在进行的爬取，没有时发起新的爬取（有中断的检查点时从检查点继续）
+
+        Args:
+            crawl_id: 客户端重连时携带的爬取ID
+            resume: 为 False 时（用户要求完整刷新）不自动恢复之前中断的爬取
+
+        Returns:
+            tuple: (SharedCrawl, CrawlSubscription)
+        """
+        key = (space_id, scope)
+        with self._lock:
+            crawl = self._crawls.get(key)
+            # 已取消的爬取不再复用；要求完整刷新的请求不复用增量爬取
+            if crawl is None or crawl.cancel_event.is_set() or (crawl.incremental and not snapshot_allows_incremental(snapshot)):
+                resume_id = self._resumable_crawl_id(space_id, scope, snapshot, crawl_id, resume)
+                crawl = SharedCrawl(self, key, space_id, user_access_token, scope, snapshot=snapshot, crawl_id=resume_id)
+                self._crawls[key] = crawl
+                subscription = crawl.subscribe()
+                crawl.start()
+                app.logger.info(f"Started shared crawl {crawl.crawl_id} for space_id: {space_id}, scope: {scope}, incremental: {crawl.incremental}, resumed: {resume_id is not None}")
+            else:
+                subscription = crawl.subscribe()
+                app.logger.info(f"Attached to in-flight crawl {crawl.crawl_id} for space_id: {space_id}, scope: {scope}, running for {time.time() - crawl.started_at:.1f}s")
+        return crawl, subscription
+
+    def detach(self, crawl, subscription):
+        """取消订阅；最后一个订阅者离开且爬取未完成时取消爬取"""
+        with self._lock:
+            remaining = crawl.unsubscribe(subscription)
+            if remaining == 0 and not crawl.finished:
+                crawl.cancel_event.set()
+                if self._crawls.get(crawl.key) is crawl:
+                    del self._crawls[crawl.key]
+                app.logger.info(f"Last subscriber left, cancelling crawl for space_id: {crawl.space_id}")
+
+    def _finished(self, crawl):
+        with self._lock:
+            if self._crawls.get(crawl.key) is crawl:
+                del self._crawls[crawl.key]
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "crawl_id": crawl.crawl_id,
+                    "space_id": crawl.space_id,
+                    "subscribers": len(crawl._subscriptions),
+                    "incremental": crawl.incremental,
+                    "running_seconds": round(time.time() - crawl.started_at, 1)
+                }
+                for crawl in self._crawls.values()
+            ]
+
+wiki_crawl_coordinator = WikiCrawlCoordinator()
+
+@app.route('/api/wiki/<space_id>/nodes/all', methods=['GET'])
+def get_all_wiki_nodes(space_id):
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Unauthorized"}), 401
+    user_access_token = auth_header.split(' ')[1]
+
+    try:
+        crawl, subscription = wiki_crawl_coordinator.attach(space_id, user_access_token, resolve_user_scope(user_access_token))
+        try:
+            all_nodes = crawl.wait(subscription)
+        finally:
+            wiki_crawl_coordinator.detach(crawl, subscription)
+        return Response(encode_wiki_tree(all_nodes), mimetype='application/json')
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Request error: {str(e)}")
+        if e.response is not None:
+            app.logger.error(f"Response status: {e.response.status_code}")
+            app.logger.error(f"Response content: {e.response.text}")
+            # 特别处理速率限制错误
+            if e.response.status_code == 429:
+                return jsonify({"error": "Rate limit exceeded. Please try again later.", "retry_after": 60}), 429
+            try:
+                error_data = e.response.json()
+                return jsonify({"error": error_data}), e.response.status_code
+            except ValueError:
+                return jsonify({"error": e.response.text}), e.response.status_code
+        return jsonify({"error": str(e)}), 500
+
+# 兼容旧版本的API端点，用于导出全量导航数据
+@app.route('/api/wiki/nodes/export', methods=['GET'])
+def export_wiki_nodes():
+    # 从查询参数获取space_id
+    space_id = request.args.get('space_id')
+    if not space_id:
+        return jsonify({"error": "Missing space_id parameter"}), 400
+    
+    # 从查询参数或Authorization头获取token
+    user_access_token = request.args.get('token')
+    if not user_access_token:
+        auth_header = request.headers.get('Authorization')
+        if not auth_header or not auth_header.startswith('Bearer '):
+            return jsonify({"error": "Unauthorized"}), 401
+        user_access_token = auth_header.split(' ')[1]
+
+    # mode=flat 时边爬取边返回扁平节点记录，由客户端组装节点树
+    flat_mode = request.args.get('mode') == 'flat'
+
+    app.logger.info(f"SSE export connection attempt started for space_id: {space_id}, flat mode: {flat_mode}")
+    
+    import queue
+    scope = resolve_user_scope(user_access_token)
+    # 断线重连时携带上次收到的crawl_id
+    request_crawl_id = request.args.get('crawl_id')
+
+    def generate():
+        crawl = None
+        try:
+            app.logger.info(f"SSE export stream generation started for space_id: {space_id}")
+            
+            # 同一用户正在爬取该知识空间时直接订阅，否则发起新的爬取
+            crawl, subscription = wiki_crawl_coordinator.attach(space_id, user_access_token, scope, crawl_id=request_crawl_id)
+            yield f"data: {json.dumps({'type': 'crawl', 'crawl_id': crawl.crawl_id})}\n\n"
+            last_sent_at = time.time()
+            
+            # 实时发送进度更新
+            while True:
                 try:
                     # 从队列中获取进度更新
-                    item = progress_queue.get(timeout=1)
+                    item = subscription.queue.get(timeout=1)
+                    last_sent_at = time.time()
                     
                     # 检查是否完成
                     if item is None:
@@ -1833,21 +3510,34 @@ def export_wiki_nodes():
                     # 检查是否出错
                     if isinstance(item, Exception):
                         raise item
-                    
-                    # 发送进度更新
-                    yield f"data: {{\"type\": \"progress\", \"count\": {item}}}\n\n"
+
+                    batches = subscription.buffer.drain_batches()
+                    if flat_mode:
+                        for batch in batches:
+                            yield f"data: {json_dumps({'type': 'nodes', 'nodes': batch})}\n\n"
+                    elif batches:
+                        # 发送进度更新
+                        yield f"data: {{\"type\": \"progress\", \"count\": {sum(len(batch) for batch in batches)}}}\n\n"
                 except queue.Empty:
-                    # 检查线程是否还在运行
-                    if not fetch_thread.is_alive():
-                        break
+                    # 写入失败会关闭生成器，从而触发finally中的取消
+                    if time.time() - last_sent_at >= SSE_KEEPALIVE_SECONDS:
+                        last_sent_at = time.time()
+                        yield ": keepalive\n\n"
                     continue
             
-            # 等待线程完成
-            fetch_thread.join()
-            
             # 发送最终结果
-            app.logger.info(f"Sending final export result for space_id: {space_id}, node count: {len(result)}")
-            yield f"data: {{\"type\": \"result\", \"data\": {json.dumps(result)}}}\n\n"
+            result = crawl.result
+            if flat_mode:
+                for batch in subscription.buffer.drain_batches():
+                    yield f"data: {json_dumps({'type': 'nodes', 'nodes': batch})}\n\n"
+                app.logger.info(f"Sending export completion for space_id: {space_id}, streamed nodes: {subscription.buffer.sent_count}")
+                yield f"data: {{\"type\": \"complete\", \"node_count\": {subscription.buffer.sent_count}}}\n\n"
+            else:
+                app.logger.info(f"Sending final export result for space_id: {space_id}, node count: {len(result)}")
+                # 整棵树的编码结果单独作为一个数据块写出，避免再拼接复制一次
+                yield "data: {\"type\": \"result\", \"data\": "
+                yield encode_wiki_tree(result)
+                yield "}\n\n"
             
             # 显式结束流
             app.logger.info(f"SSE export stream ended normally for space_id: {space_id}")
@@ -1876,6 +3566,10 @@ def export_wiki_nodes():
             # 显式结束流
             app.logger.info(f"SSE export stream ended with unexpected error for space_id: {space_id}")
             yield "data: \n\n"
+        finally:
+            # 客户端断开时生成器被关闭，最后一个订阅者离开时后台爬取随之停止
+            if crawl is not None:
+                wiki_crawl_coordinator.detach(crawl, subscription)
     
     app.logger.info(f"SSE export connection established for space_id: {space_id}")
     return Response(generate(), content_type='text/event-stream')
@@ -1890,53 +3584,70 @@ def get_all_wiki_nodes_stream(space_id):
             return jsonify({"error": "Unauthorized"}), 401
         user_access_token = auth_header.split(' ')[1]
 
-    app.logger.info(f"SSE connection attempt started for space_id: {space_id}")
+    # mode=flat 时边爬取边返回扁平节点记录，由客户端组装节点树
+    flat_mode = request.args.get('mode') == 'flat'
+
+    app.logger.info(f"SSE connection attempt started for space_id: {space_id}, flat mode: {flat_mode}")
+
+    # 断线重连时携带上次收到的crawl_id，从该爬取的检查点继续
+    crawl_id = request.args.get('crawl_id')
+
+    # 读取该用户的快照；refresh=full 或重连到尚未结束的爬取时忽略快照
+    scope = resolve_user_scope(user_access_token)
+    snapshot = None
+    full_refresh = request.args.get('refresh') == 'full'
+    if crawl_id:
+        try:
+            checkpoint = crawl_checkpoint_store.get(crawl_id)
+        except sqlite3.Error as e:
+            app.logger.error(f"Failed to look up crawl checkpoint {crawl_id}: {str(e)}")
+            checkpoint = None
+        # 该爬取已经结束（检查点已删除）或不属于该用户时，按普通请求处理
+        if not checkpoint or checkpoint['space_id'] != space_id or checkpoint['scope'] != scope:
+            crawl_id = None
+    if not full_refresh and not crawl_id:
+        try:
+            snapshot = wiki_snapshot_store.get(space_id, scope)
+        except sqlite3.Error as e:
+            app.logger.error(f"Failed to load wiki snapshot for space_id: {space_id}, error: {str(e)}")
     
-    # 创建一个队列来传递进度更新
     import queue
-    progress_queue = queue.Queue()
-    result = []
-    connection_active = True  # 连接状态标志
 
     def generate():
-        nonlocal connection_active
+        crawl = None
         try:
             app.logger.info(f"SSE stream generation started for space_id: {space_id}")
-            
-            # 定义进度回调函数
-            def progress_callback(count):
-                if connection_active:  # 只有在连接活跃时才向队列添加数据
-                    try:
-                        progress_queue.put(count)
-                    except Exception as e:
-                        app.logger.error(f"Error adding progress to queue: {str(e)}")
-            
-            # 在另一个线程中获取所有节点
-            import threading
-            def fetch_nodes():
-                try:
-                    nonlocal result
-                    app.logger.info(f"Starting to fetch all nodes for space_id: {space_id}")
-                    all_nodes = fetch_all_nodes_recursively(space_id, user_access_token, progress_callback=progress_callback)
-                    result.extend(all_nodes)
-                    app.logger.info(f"Finished fetching all nodes for space_id: {space_id}, node count: {len(result)}")
-                    # 发送完成信号
-                    if connection_active:
-                        progress_queue.put(None)
-                except Exception as e:
-                    app.logger.error(f"Error while fetching nodes for space_id: {space_id}, error: {str(e)}")
-                    # 发送错误信号
-                    if connection_active:
-                        progress_queue.put(e)
-            
-            fetch_thread = threading.Thread(target=fetch_nodes)
-            fetch_thread.start()
+
+            # 先立即返回快照，再在后台增量刷新
+            if snapshot:
+                snapshot_age = time.time() - snapshot['fetched_at']
+                app.logger.info(f"Sending wiki snapshot for space_id: {space_id}, node count: {snapshot['node_count']}, age: {snapshot_age:.0f}s")
+                if flat_mode:
+                    # 与爬取时一样分批发送快照节点，最后的 snapshot 事件表示快照已发送完毕
+                    for batch in iter_stream_record_batches(snapshot['tree']):
+                        yield f"data: {json_dumps({'type': 'snapshot_nodes', 'nodes': batch})}\n\n"
+                    yield f"data: {json_dumps({'type': 'snapshot', 'age': round(snapshot_age, 1), 'node_count': snapshot['node_count']})}\n\n"
+                else:
+                    yield f"data: {{\"type\": \"snapshot\", \"age\": {snapshot_age:.1f}, \"node_count\": {snapshot['node_count']}, \"data\": "
+                    yield encode_wiki_tree(snapshot['tree'])
+                    yield "}\n\n"
+                # full_crawl_at 为0表示上次爬取有页面失败，快照不完整，总是继续刷新（从检查点补抓失败的页面）
+                if snapshot_age < WIKI_SNAPSHOT_MIN_REFRESH_SECONDS and snapshot['full_crawl_at']:
+                    yield "data: {\"type\": \"done\", \"refreshed\": false}\n\n"
+                    return
+
+            # 同一用户正在爬取该知识空间时直接订阅，否则发起新的爬取
+            crawl, subscription = wiki_crawl_coordinator.attach(space_id, user_access_token, scope, snapshot=snapshot, crawl_id=crawl_id, resume=not full_refresh)
+            # 重连时会重新收到该爬取已获取的全部节点
+            yield f"data: {json.dumps({'type': 'crawl', 'crawl_id': crawl.crawl_id})}\n\n"
+            last_sent_at = time.time()
             
             # 实时发送进度更新
-            while connection_active:
+            while True:
                 try:
                     # 从队列中获取进度更新，使用更短的超时时间以便更快响应连接关闭
-                    item = progress_queue.get(timeout=0.5)
+                    item = subscription.queue.get(timeout=0.5)
+                    last_sent_at = time.time()
                     
                     # 检查是否完成
                     if item is None:
@@ -1945,157 +3656,1269 @@ def get_all_wiki_nodes_stream(space_id):
                     # 检查是否出错
                     if isinstance(item, Exception):
                         raise item
-                    
-                    # 发送进度更新
-                    yield f"data: {{\"type\": \"progress\", \"count\": {item}}}\n\n"
+
+                    # 一次取走所有已就绪的节点，后续的标记可能已无节点
+                    batches = subscription.buffer.drain_batches()
+                    if snapshot:
+                        # 客户端已持有快照，刷新结束后只发送差异
+                        continue
+                    if flat_mode:
+                        for batch in batches:
+                            yield f"data: {json_dumps({'type': 'nodes', 'nodes': batch})}\n\n"
+                    elif batches:
+                        # 发送进度更新
+                        yield f"data: {{\"type\": \"progress\", \"count\": {sum(len(batch) for batch in batches)}}}\n\n"
                 except queue.Empty:
-                    # 检查线程是否还在运行
-                    if not fetch_thread.is_alive():
-                        break
+                    # 写入失败会关闭生成器，从而触发finally中的取消
+                    if time.time() - last_sent_at >= SSE_KEEPALIVE_SECONDS:
+                        last_sent_at = time.time()
+                        yield ": keepalive\n\n"
                     continue
-                except Exception as e:
-                    app.logger.error(f"Error in stream generation loop: {str(e)}")
-                    break
-            
-            # 等待线程完成
-            fetch_thread.join(timeout=5)  # 添加超时，避免无限等待
             
-            # 如果连接仍然活跃，发送最终结果
-            if connection_active:
+            # 发送最终结果
+            result = crawl.result
+            if snapshot:
+                diff = diff_wiki_trees(snapshot['tree'], result)
+                app.logger.info(f"Sending wiki diff for space_id: {space_id}, added: {len(diff['added'])}, updated: {len(diff['updated'])}, removed: {len(diff['removed'])}")
+                yield f"data: {json_dumps(dict(diff, type='diff'))}\n\n"
+                yield "data: {\"type\": \"done\", \"refreshed\": true}\n\n"
+            elif flat_mode:
+                # 节点已全部以批次发送，只需补发缓冲区中剩余的节点
+                for batch in subscription.buffer.drain_batches():
+                    yield f"data: {json_dumps({'type': 'nodes', 'nodes': batch})}\n\n"
+                app.logger.info(f"Sending completion for space_id: {space_id}, streamed nodes: {subscription.buffer.sent_count}")
+                yield f"data: {{\"type\": \"complete\", \"node_count\": {subscription.buffer.sent_count}}}\n\n"
+            else:
                 app.logger.info(f"Sending final result for space_id: {space_id}, node count: {len(result)}")
-                yield f"data: {{\"type\": \"result\", \"data\": {json.dumps(result)}}}\n\n"
-                
-                # 显式结束流
-                app.logger.info(f"SSE stream ended normally for space_id: {space_id}")
-                yield "data: \n\n"
+                # 整棵树的编码结果单独作为一个数据块写出，避免再拼接复制一次
+                yield "data: {\"type\": \"result\", \"data\": "
+                yield encode_wiki_tree(result)
+                yield "}\n\n"
+            
+            # 显式结束流
+            app.logger.info(f"SSE stream ended normally for space_id: {space_id}")
+            yield "data: \n\n"
+        except requests.exceptions.RequestException as e:
+            app.logger.error(f"Request error: {str(e)}")
+            if e.response is not None:
+                app.logger.error(f"Response status: {e.response.status_code}")
+                app.logger.error(f"Response content: {e.response.text}")
+                # 特别处理速率限制错误
+                if e.response.status_code == 429:
+                    app.logger.info(f"Rate limit exceeded for space_id: {space_id}")
+                    yield f"data: {{\"type\": \"error\", \"message\": \"Rate limit exceeded. Please try again later.\", \"retry_after\": 60}}\n\n"
+                    return
+            app.logger.info(f"Sending request error for space_id: {space_id}")
+            yield f"data: {{\"type\": \"error\", \"message\": \"{str(e)}\"}}\n\n"
+        except Exception as e:
+            app.logger.error(f"Unexpected error: {str(e)}")
+            app.logger.info(f"Sending unexpected error for space_id: {space_id}")
+            yield f"data: {{\"type\": \"error\", \"message\": \"{str(e)}\"}}\n\n"
+        finally:
+            # 客户端断开时生成器被关闭，最后一个订阅者离开时后台爬取随之停止
+            if crawl is not None:
+                wiki_crawl_coordinator.detach(crawl, subscription)
+            app.logger.info(f"SSE stream ended for space_id: {space_id}")
+    
+    app.logger.info(f"SSE connection established for space_id: {space_id}")
+    return Response(generate(), content_type='text/event-stream')
+
+@app.route('/api/wiki/<space_id>/nodes', methods=['GET'])
+def get_wiki_nodes(space_id):
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Unauthorized"}), 401
+    user_access_token = auth_header.split(' ')[1]
+
+    # Get parameters
+    parent_node_token = request.args.get('parent_node_token')
+    page_token = request.args.get('page_token')
+    
+    # Validate parameters
+    if parent_node_token is not None and not isinstance(parent_node_token, str):
+        return jsonify({"error": "Invalid parent_node_token"}), 400
+    if page_token is not None and not isinstance(page_token, str):
+        return jsonify({"error": "Invalid page_token"}), 400
+
+    try:
+        # Fetch nodes with pagination
+        data = fetch_node_children(space_id, parent_node_token, user_access_token, page_token)
+        return jsonify(data)
+
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Request error: {str(e)}")
+        if e.response is not None:
+            app.logger.error(f"Response status: {e.response.status_code}")
+            app.logger.error(f"Response content: {e.response.text}")
+            try:
+                error_data = e.response.json()
+                return jsonify({"error": error_data}), e.response.status_code
+            except ValueError:
+                return jsonify({"error": e.response.text}), e.response.status_code
+        return jsonify({"error": str(e)}), 500
+
+# --- 按需加载的子树与预取 ---
+
+WIKI_SUBTREE_MAX_DEPTH = int(os.getenv('WIKI_SUBTREE_MAX_DEPTH', '3'))  # 子树接口一次最多返回的层数
+WIKI_SUBTREE_CACHE_TTL = float(os.getenv('WIKI_SUBTREE_CACHE_TTL', '60'))  # 子节点缓存有效期（秒）
+WIKI_SUBTREE_CACHE_SIZE = int(os.getenv('WIKI_SUBTREE_CACHE_SIZE', '2000'))  # 最多缓存多少个父节点的子节点列表
+WIKI_SUBTREE_PREFETCH_LIMIT = int(os.getenv('WIKI_SUBTREE_PREFETCH_LIMIT', '10'))  # 每次响应后预取的节点数
+
+class NodeChildrenCache:
+    """父节点 -> 全部直接子节点 的短期缓存
+
+    键中包含用户范围（resolve_user_scope），不同用户看到的子节点不会混用。
+    """
+
+    def __init__(self, ttl, max_entries):
+        from collections import OrderedDict
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.time() - entry[0] <= self.ttl
+
+    def put(self, key, items):
+        with self._lock:
+            self._entries[key] = (time.time(), items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+node_children_cache = NodeChildrenCache(WIKI_SUBTREE_CACHE_TTL, WIKI_SUBTREE_CACHE_SIZE)
+
+def fetch_all_children(space_id, parent_node_token, user_access_token):
+    """获取父节点下的全部直接子节点（自动翻页），返回 WikiNode 列表"""
+    items = []
+    page_token = None
+    while True:
+        data = fetch_node_children(space_id, parent_node_token, user_access_token, page_token)
+        items.extend(WikiNode.from_item(item) for item in data.get('items', []) if item.get('node_token'))
+        if not (data.get('has_more') and data.get('page_token')):
+            return items
+        page_token = data['page_token']
+
+def get_children_cached(space_id, parent_node_token, user_access_token, scope):
+    """优先从短期缓存读取子节点列表，未命中时请求飞书并写入缓存"""
+    key = (scope, space_id, parent_node_token or '')
+    items = node_children_cache.get(key)
+    if items is None:
+        items = fetch_all_children(space_id, parent_node_token, user_access_token)
+        node_children_cache.put(key, items)
+        remember_node_resolutions(items)
+    return items
+
+def fetch_first_children_page(space_id, parent_node_token, user_access_token, scope):
+    """获取父节点下的第一页子节点
+
+    缓存中有完整子节点列表时直接返回；否则只请求一页（page_size 50），
+    这一页已是全部子节点时写入缓存，剩余页由客户端通过"加载更多"按页请求。
+
+    Returns:
+        tuple: (WikiNode 列表, 下一页的 page_token；没有更多时为 None)
+    """
+    key = (scope, space_id, parent_node_token or '')
+    items = node_children_cache.get(key)
+    if items is not None:
+        return items, None
+    data = fetch_node_children(space_id, parent_node_token, user_access_token)
+    items = [WikiNode.from_item(item) for item in data.get('items', []) if item.get('node_token')]
+    remember_node_resolutions(items)
+    page_token = data.get('page_token') if data.get('has_more') else None
+    if not page_token:
+        node_children_cache.put(key, items)
+    return items, page_token
+
+def load_wiki_subtree(space_id, parent_node_token, user_access_token, scope, depth):
+    """加载父节点下 depth 层的嵌套节点树
+
+    每个父节点只取第一页子节点，不会为了组装子树翻完所有页。第一层之外，每层只展开
+    显示顺序靠前的 WIKI_SUBTREE_PREFETCH_LIMIT 个节点，并发请求；子节点不止一页或
+    加载失败的节点不带children返回，由客户端展开时再按页加载。
+
+    Returns:
+        tuple: (嵌套的 WikiNode 列表, 第一层下一页的 page_token, 最底层节点列表)
+    """
+    # 缓存中的节点被多个请求共享，组装时使用拷贝
+    items, page_token = fetch_first_children_page(space_id, parent_node_token, user_access_token, scope)
+    root_nodes = [item.copy() for item in items]
+    level = root_nodes
+
+    def load_children(node):
+        try:
+            children, next_page = fetch_first_children_page(space_id, node.node_token, user_access_token, scope)
         except requests.exceptions.RequestException as e:
-            app.logger.error(f"Request error: {str(e)}")
-            if e.response is not None:
-                app.logger.error(f"Response status: {e.response.status_code}")
-                app.logger.error(f"Response content: {e.response.text}")
-                # 特别处理速率限制错误
-                if e.response.status_code == 429:
-                    app.logger.info(f"Rate limit exceeded for space_id: {space_id}")
-                    yield f"data: {{\"type\": \"error\", \"message\": \"Rate limit exceeded. Please try again later.\", \"retry_after\": 60}}\n\n"
-                    return
-            app.logger.info(f"Sending request error for space_id: {space_id}")
-            yield f"data: {{\"type\": \"error\", \"message\": \"{str(e)}\"}}\n\n"
+            app.logger.warning(f"Failed to load children of {node.node_token} for subtree: {str(e)}")
+            return None
+        return None if next_page else children
+
+    for _ in range(depth - 1):
+        parents = [node for node in level if node.has_child][:WIKI_SUBTREE_PREFETCH_LIMIT]
+        if not parents:
+            break
+        with ThreadPoolExecutor(max_workers=min(CRAWLER_MAX_WORKERS, len(parents))) as executor:
+            results = list(executor.map(load_children, parents))
+        level = []
+        for node, children in zip(parents, results):
+            if children is None:
+                continue
+            node.children = [child.copy() for child in children]
+            level.extend(node.children)
+    return root_nodes, page_token, level
+
+class SubtreePrefetcher:
+    """在后台预取即将被展开的节点的子节点，写入 node_children_cache
+
+    目录树中靠前的节点最先被看到、也最可能被展开，因此按显示顺序取前
+    WIKI_SUBTREE_PREFETCH_LIMIT 个有子节点的节点预取。
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='subtree-prefetch')
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self.scheduled = 0
+
+    def schedule(self, space_id, nodes, user_access_token, scope, limit=None):
+        limit = WIKI_SUBTREE_PREFETCH_LIMIT if limit is None else limit
+        candidates = [node for node in nodes if node.has_child and not node.children][:limit]
+        for node in candidates:
+            key = (scope, space_id, node.node_token)
+            with self._lock:
+                if key in self._in_flight or node_children_cache.contains(key):
+                    continue
+                self._in_flight.add(key)
+                self.scheduled += 1
+            self._executor.submit(self._prefetch, key, space_id, node.node_token, user_access_token, scope)
+
+    def _prefetch(self, key, space_id, node_token, user_access_token, scope):
+        try:
+            get_children_cached(space_id, node_token, user_access_token, scope)
         except Exception as e:
-            app.logger.error(f"Unexpected error: {str(e)}")
-            app.logger.info(f"Sending unexpected error for space_id: {space_id}")
-            yield f"data: {{\"type\": \"error\", \"message\": \"{str(e)}\"}}\n\n"
+            # 预取失败不影响用户请求，展开时会重新加载
+            app.logger.warning(f"Prefetch of {node_token} failed: {str(e)}")
         finally:
-            # 确保连接状态被正确标记为关闭
-            connection_active = False
-            app.logger.info(f"SSE stream ended for space_id: {space_id}")
-    
-    app.logger.info(f"SSE connection established for space_id: {space_id}")
-    return Response(generate(), content_type='text/event-stream')
+            with self._lock:
+                self._in_flight.discard(key)
 
-@app.route('/api/wiki/<space_id>/nodes', methods=['GET'])
-def get_wiki_nodes(space_id):
+subtree_prefetcher = SubtreePrefetcher()
+
+@app.route('/api/wiki/<space_id>/nodes/subtree', methods=['GET'])
+def get_wiki_subtree(space_id):
+    """一次返回 parent_node_token 下 depth 层的节点（每层只取第一页），并在后台预取下一层"""
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith('Bearer '):
         return jsonify({"error": "Unauthorized"}), 401
     user_access_token = auth_header.split(' ')[1]
 
-    # Get parameters
     parent_node_token = request.args.get('parent_node_token')
-    page_token = request.args.get('page_token')
+    try:
+        depth = int(request.args.get('depth', '1'))
+    except ValueError:
+        return jsonify({"error": "Invalid depth"}), 400
+    depth = max(1, min(depth, WIKI_SUBTREE_MAX_DEPTH))
+
+    try:
+        scope = resolve_user_scope(user_access_token)
+        items, page_token, boundary = load_wiki_subtree(space_id, parent_node_token, user_access_token, scope, depth)
+        subtree_prefetcher.schedule(space_id, boundary, user_access_token, scope)
+        tail = {"depth": depth, "has_more": page_token is not None, "page_token": page_token}
+        return Response(b'{"items":' + encode_wiki_tree(items) + b',' + json.dumps(tail)[1:].encode('utf-8'), mimetype='application/json')
+
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Request error: {str(e)}")
+        if e.response is not None:
+            app.logger.error(f"Response status: {e.response.status_code}")
+            app.logger.error(f"Response content: {e.response.text}")
+            try:
+                error_data = e.response.json()
+                return jsonify({"error": error_data}), e.response.status_code
+            except ValueError:
+                return jsonify({"error": e.response.text}), e.response.status_code
+        return jsonify({"error": str(e)}), 500
+
+# --- 文档内容缓存 ---
+
+DOC_CONTENT_CACHE_TTL = int(os.getenv('DOC_CONTENT_CACHE_TTL', str(24 * 3600)))  # 缓存内容保留时间（秒），0表示不缓存
+DOC_CONTENT_CACHE_MEMORY_MB = int(os.getenv('DOC_CONTENT_CACHE_MEMORY_MB', '64'))  # 内存LRU容量
+DOC_CONTENT_CACHE_DISK_MB = int(os.getenv('DOC_CONTENT_CACHE_DISK_MB', '512'))  # 磁盘缓存容量
+
+class DocumentFetchError(Exception):
+    """飞书文档接口返回了非0的业务错误码"""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+class DocumentContentCache:
+    """文档纯文本内容的两级缓存（内存LRU + SQLite）
+
+    键为 (obj_type, obj_token, revision_id)。同一版本的内容不会变化，因此不区分用户；
+    读取缓存前必须先用请求者自己的token查询文档当前版本（fetch_document_revision），
+    查询成功即完成了访问权限校验，缓存不会让用户读到自己无权访问的文档。
+    """
+
+    def __init__(self, path, ttl, memory_bytes, disk_bytes):
+        from collections import OrderedDict
+        self.path = path
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._entries = OrderedDict()  # key -> (stored_at, size, content)
+        self._memory_used = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS doc_contents ("
+            "obj_type TEXT NOT NULL, obj_token TEXT NOT NULL, revision_id INTEGER NOT NULL, content TEXT NOT NULL, "
+            "size INTEGER NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (obj_type, obj_token, revision_id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_doc_contents_accessed ON doc_contents (accessed_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key, stored_at, content):
+        """放入内存LRU，调用方需持有锁；超过容量时淘汰最久未使用的内容"""
+        size = sys.getsizeof(content)
+        if size > self.memory_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._memory_used -= old[1]
+        self._entries[key] = (stored_at, size, content)
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._memory_used -= evicted_size
+
+    def get(self, obj_type, obj_token, revision_id):
+        key = (obj_type, obj_token, revision_id)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[2]
+                del self._entries[key]
+                self._memory_used -= entry[1]
+
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT content, stored_at FROM doc_contents WHERE obj_type = ? AND obj_token = ? AND revision_id = ?",
+            key
+        ).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            with self._lock:
+                self.misses += 1
+            return None
+        conn.execute(
+            "UPDATE doc_contents SET accessed_at = ? WHERE obj_type = ? AND obj_token = ? AND revision_id = ?",
+            (now,) + key
+        )
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, row[1], row[0])
+        return row[0]
+
+    def put(self, obj_type, obj_token, revision_id, content):
+        key = (obj_type, obj_token, revision_id)
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, content)
+        size = len(content.encode('utf-8'))
+        if size > self.disk_bytes:
+            return
+        conn = self._connection()
+        # 文档有了新版本后旧版本的内容不会再被读取
+        conn.execute(
+            "DELETE FROM doc_contents WHERE obj_type = ? AND obj_token = ? AND revision_id != ?",
+            key
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO doc_contents (obj_type, obj_token, revision_id, content, size, stored_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            key + (content, size, now, now)
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        """删除过期内容，总大小仍超过容量时按最近访问时间淘汰"""
+        conn.execute("DELETE FROM doc_contents WHERE stored_at < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM doc_contents").fetchone()[0]
+        if total <= self.disk_bytes:
+            return
+        rows = conn.execute(
+            "SELECT obj_type, obj_token, revision_id, size FROM doc_contents ORDER BY accessed_at"
+        ).fetchall()
+        for obj_type, obj_token, revision_id, size in rows:
+            if total <= self.disk_bytes:
+                break
+            conn.execute(
+                "DELETE FROM doc_contents WHERE obj_type = ? AND obj_token = ? AND revision_id = ?",
+                (obj_type, obj_token, revision_id)
+            )
+            total -= size
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def stats(self):
+        disk_entries, disk_used = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM doc_contents"
+        ).fetchone()
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_entries": len(self._entries),
+                "memory_bytes": self._memory_used,
+                "disk_entries": disk_entries,
+                "disk_bytes": disk_used,
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(hits / total, 3) if total else 0.0
+            }
+
+document_content_cache = DocumentContentCache(
+    os.getenv('DOC_CONTENT_CACHE_DB_PATH', os.path.join(DATA_DIR, 'doc_contents.db')),
+    DOC_CONTENT_CACHE_TTL,
+    DOC_CONTENT_CACHE_MEMORY_MB * 1024 * 1024,
+    DOC_CONTENT_CACHE_DISK_MB * 1024 * 1024
+)
+
+def fetch_document_revision(obj_token, user_access_token):
+    """用请求者的token查询 docx 文档的当前版本号，同时完成访问权限校验"""
+    url = f"https://open.feishu.cn/open-apis/docx/v1/documents/{obj_token}"
+    response = request_with_backoff(url, {"Authorization": f"Bearer {user_access_token}"})
+    response.raise_for_status()
+    data = response.json()
+    if data.get("code") != 0:
+        raise DocumentFetchError(data.get("msg", "Failed to fetch document"), data.get("code"))
+    return data.get("data", {}).get("document", {}).get("revision_id")
+
+def fetch_document_content(obj_type, obj_token, user_access_token):
+    """获取文档的纯文本内容（raw_content），docx 文档经过文档内容缓存
+
+    旧版 doc 文档没有可用的版本号，始终直接请求飞书。
+    飞书返回业务错误时抛出 DocumentFetchError，HTTP错误抛出 requests 异常。
+    """
+    revision_id = None
+    if obj_type == 'docx' and DOC_CONTENT_CACHE_TTL > 0:
+        revision_id = fetch_document_revision(obj_token, user_access_token)
+        if revision_id is not None:
+            content = document_content_cache.get(obj_type, obj_token, revision_id)
+            if content is not None:
+                app.logger.info(f"Document content cache hit for {obj_token} (revision {revision_id}), length: {len(content)}")
+                return content
+    else:
+        document_content_cache.record_bypass()
+
+    if obj_type == 'doc':
+        url = f"https://open.feishu.cn/open-apis/doc/v1/documents/{obj_token}/raw_content"
+    else:
+        url = f"https://open.feishu.cn/open-apis/docx/v1/documents/{obj_token}/raw_content"
+    app.logger.info(f"Fetching document content from Feishu with URL: {url}")
+    response = request_with_backoff(url, {"Authorization": f"Bearer {user_access_token}"})
+    response.raise_for_status()
+    data = response.json()
+    if data.get("code") != 0:
+        raise DocumentFetchError(data.get("msg", "Failed to fetch document content"), data.get("code"))
+
+    content = data.get("data", {}).get('content', '')
+    if revision_id is not None:
+        document_content_cache.put(obj_type, obj_token, revision_id, content)
+    return content
+
+@app.route('/api/wiki/doc/<obj_token>', methods=['GET'])
+def get_wiki_document(obj_token):
+    # 记录请求信息，便于调试
+    app.logger.info(f"=== Incoming /api/wiki/doc/{obj_token} Request ===")
+    app.logger.info(f"Request headers: {dict(request.headers)}")
     
-    # Validate parameters
-    if parent_node_token is not None and not isinstance(parent_node_token, str):
-        return jsonify({"error": "Invalid parent_node_token"}), 400
-    if page_token is not None and not isinstance(page_token, str):
-        return jsonify({"error": "Invalid page_token"}), 400
+    # 支持多种认证方式，增强健壮性
+    user_access_token = None
+    auth_header = request.headers.get('Authorization')
+    user_access_token_header = request.headers.get('user-access-token')
+    
+    # 优先使用 Authorization 头（标准Bearer Token）
+    if auth_header and auth_header.startswith('Bearer '):
+        user_access_token = auth_header.split(' ')[1]
+        app.logger.info("Using Authorization header for authentication")
+    # 兼容 user-access-token 头
+    elif user_access_token_header:
+        user_access_token = user_access_token_header
+        app.logger.info("Using user-access-token header for authentication")
+    
+    # 如果没有找到任何认证信息
+    if not user_access_token:
+        app.logger.error("No valid authentication token found in request headers")
+        app.logger.error(f"Available headers: {list(request.headers.keys())}")
+        return jsonify({"error": "Authentication required. Please provide valid token in Authorization or user-access-token header"}), 401
+    
+    # 记录token信息（脱敏处理）
+    token_preview = user_access_token[:10] + "..." if len(user_access_token) > 10 else user_access_token
+    app.logger.info(f"Authentication successful, token preview: {token_preview}")
+    
+    app.logger.info(f"Document obj_token: {obj_token}")
+
+    try:
+        content = fetch_document_content('docx', obj_token, user_access_token)
+        app.logger.info(f"Successfully fetched document content, length: {len(content)}")
+        return jsonify({"content": content})
+    except DocumentFetchError as e:
+        app.logger.error(f"Feishu API returned error: {e}")
+        app.logger.error(f"Feishu API error code: {e.code}")
+        return jsonify({"error": str(e)}), 500
+    except requests.exceptions.RequestException as e:
+        error_msg = f"Failed to fetch document content: {e}"
+        app.logger.error(error_msg)
+        if e.response is not None:
+            app.logger.error(f"Response status: {e.response.status_code}")
+            app.logger.error(f"Response headers: {dict(e.response.headers)}")
+            app.logger.error(f"Response content: {e.response.text}")
+            try:
+                error_data = e.response.json()
+                return jsonify({"error": error_data}), e.response.status_code
+            except ValueError:
+                return jsonify({"error": e.response.text}), e.response.status_code
+        return jsonify({"error": str(e)}), 500
+
+# --- 批量获取文档 ---
+
+BULK_DOC_MAX_ITEMS = int(os.getenv('BULK_DOC_MAX_ITEMS', '200'))  # 单次请求最多的文档数
+BULK_DOC_MAX_WORKERS = int(os.getenv('BULK_DOC_MAX_WORKERS', '8'))  # 并发获取的线程数，实际速率仍受飞书限流器约束
+BULK_DOC_SUPPORTED_TYPES = ('doc', 'docx')
+
+def resolve_wiki_node(node_token, user_access_token):
+    """获取知识库节点信息（obj_type、obj_token、title 等）
+
+    优先使用节点解析缓存（由爬取和 get_node 结果填充），未命中时调用 get_node 接口。
+    缓存命中的结果未经权限校验：只对 doc/docx 节点使用缓存，调用方随后用同一token获取文档内容时
+    由飞书完成校验，校验通过前不得把节点字段返回给请求者；其他类型的节点总是用请求者的token调用 get_node。
+    """
+    if WIKI_NODE_RESOLUTION_TTL > 0:
+        try:
+            node = wiki_node_resolution_store.get(node_token)
+        except sqlite3.Error as e:
+            app.logger.error(f"Failed to read wiki node resolution for {node_token}: {str(e)}")
+            node = None
+        if node is not None and node.get('obj_type') in BULK_DOC_SUPPORTED_TYPES:
+            app.logger.info(f"Wiki node resolution cache hit for {node_token}")
+            return node
+
+    url = f"https://open.feishu.cn/open-apis/wiki/v2/spaces/get_node?token={node_token}"
+    response = request_with_backoff(url, {"Authorization": f"Bearer {user_access_token}"})
+    response.raise_for_status()
+    data = response.json()
+    if data.get("code") != 0:
+        raise DocumentFetchError(data.get("msg", "Failed to fetch wiki node info"), data.get("code"))
+    node = data.get("data", {}).get("node", {})
+    remember_node_resolutions([node])
+    return node
+
+def fetch_bulk_document(item, user_access_token):
+    """获取批量请求中的一个文档，失败时返回错误记录而不抛出，不影响其他文档
+
+    节点的 title、obj_token 只在文档内容获取成功（即请求者有权访问）后写入记录，错误记录中不包含。
+    """
+    record = {"index": item['index'], "token": item['token'], "token_type": item['token_type']}
+    try:
+        obj_type, obj_token, title = item['token_type'], item['token'], None
+        if obj_type == 'wiki':
+            node = resolve_wiki_node(obj_token, user_access_token)
+            obj_type, obj_token, title = node.get('obj_type'), node.get('obj_token'), node.get('title')
+        if obj_type not in BULK_DOC_SUPPORTED_TYPES or not obj_token:
+            record.update(type='error', error=f"Unsupported document type: {obj_type}")
+            return record
+        content = fetch_document_content(obj_type, obj_token, user_access_token)
+        if item['token_type'] == 'wiki':
+            record['title'] = title
+        record.update(type='document', obj_type=obj_type, obj_token=obj_token, content=content)
+    except DocumentFetchError as e:
+        record.update(type='error', error=str(e), code=e.code)
+    except requests.exceptions.RequestException as e:
+        record.update(type='error', error=str(e), status=e.response.status_code if e.response is not None else None)
+    except Exception as e:
+        app.logger.error(f"Unexpected error fetching document {item['token']}: {e}")
+        record.update(type='error', error=str(e))
+    return record
+
+@app.route('/api/wiki/docs/bulk', methods=['POST'])
+def get_wiki_documents_bulk():
+    """批量获取文档内容
+
+    请求体: {"obj_tokens": [...], "node_tokens": [...], "format": "ndjson" | "sse"}
+    obj_tokens 为 docx 文档token，node_tokens 为知识库节点token（通过 get_node 解析）。
+    文档并发获取，每完成一个立即返回一条记录；单个文档失败只返回该文档的错误记录，
+    最后返回一条 {"type": "done"} 汇总。
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Unauthorized"}), 401
+    user_access_token = auth_header.split(' ')[1]
+
+    data = request.get_json(silent=True) or {}
+    obj_tokens = data.get('obj_tokens') or []
+    node_tokens = data.get('node_tokens') or []
+    output_format = data.get('format', request.args.get('format', 'ndjson'))
+    if not isinstance(obj_tokens, list) or not isinstance(node_tokens, list):
+        return jsonify({"error": "obj_tokens and node_tokens must be lists"}), 400
+    if not all(isinstance(token, str) and token for token in obj_tokens + node_tokens):
+        return jsonify({"error": "Tokens must be non-empty strings"}), 400
+    if output_format not in ('ndjson', 'sse'):
+        return jsonify({"error": "Invalid format"}), 400
+
+    # 去重并保留请求中的顺序，index 用于客户端把乱序到达的结果对应回请求
+    items = []
+    seen = set()
+    for token_type, tokens in (('docx', obj_tokens), ('wiki', node_tokens)):
+        for token in tokens:
+            if (token_type, token) not in seen:
+                seen.add((token_type, token))
+                items.append({"index": len(items), "token": token, "token_type": token_type})
+    if not items:
+        return jsonify({"error": "No tokens provided"}), 400
+    if len(items) > BULK_DOC_MAX_ITEMS:
+        return jsonify({"error": f"Too many documents, at most {BULK_DOC_MAX_ITEMS} per request"}), 400
+
+    def encode(record):
+        if output_format == 'sse':
+            return f"data: {json_dumps(record)}\n\n"
+        return json_dumps(record) + "\n"
+
+    def generate():
+        app.logger.info(f"Bulk document fetch started, documents: {len(items)}")
+        executor = ThreadPoolExecutor(max_workers=max(1, min(BULK_DOC_MAX_WORKERS, len(items))))
+        succeeded = failed = 0
+        try:
+            futures = [executor.submit(fetch_bulk_document, item, user_access_token) for item in items]
+            for future in as_completed(futures):
+                record = future.result()
+                if record['type'] == 'document':
+                    succeeded += 1
+                else:
+                    failed += 1
+                    app.logger.warning(f"Bulk document fetch failed for {record['token']}: {record['error']}")
+                yield encode(record)
+            app.logger.info(f"Bulk document fetch finished, succeeded: {succeeded}, failed: {failed}")
+            yield encode({"type": "done", "total": len(items), "succeeded": succeeded, "failed": failed})
+        finally:
+            # 客户端断开时生成器被关闭，取消尚未开始的获取
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    if output_format == 'sse':
+        return Response(generate(), content_type='text/event-stream')
+    return Response(generate(), content_type='application/x-ndjson')
+
+# --- LLM 客户端池 ---
+
+import httpx
+from openai import DEFAULT_TIMEOUT
+
+LLM_BASE_URL = os.getenv('LLM_BASE_URL', "https://ark.cn-beijing.volces.com/api/v3")
+LLM_CLIENT_POOL_SIZE = int(os.getenv('LLM_CLIENT_POOL_SIZE', '64'))  # 最多缓存的客户端数（每个 base_url + api_key 一个）
+LLM_CLIENT_IDLE_SECONDS = int(os.getenv('LLM_CLIENT_IDLE_SECONDS', '600'))  # 客户端闲置多久后淘汰
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', '100'))  # 到模型服务的最大连接数
+LLM_HTTP_KEEPALIVE_CONNECTIONS = int(os.getenv('LLM_HTTP_KEEPALIVE_CONNECTIONS', '20'))  # 保持的空闲keep-alive连接数
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', '60'))  # 空闲连接保持时间（秒）
+
+class LLMClientPool:
+    """复用 OpenAI 客户端，避免每次分析都新建 httpx 连接池并重新进行 TCP+TLS 握手
+
+    客户端按 (base_url, api_key指纹) 缓存，超过数量上限时淘汰最久未使用的，闲置过久的也会被淘汰。
+    所有客户端共用同一个 httpx.Client，不同 api_key 访问同一个模型服务时也能复用 keep-alive 连接
+    （api_key 随每个请求的请求头发送，与连接无关）。
+    """
+
+    def __init__(self, max_size, idle_seconds):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clients = OrderedDict()  # (base_url, 指纹) -> (client, last_used)
+        self._lock = threading.Lock()
+        self._http_client = httpx.Client(
+            timeout=DEFAULT_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_HTTP_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+
+    def get(self, base_url, api_key):
+        key = (base_url, token_fingerprint(api_key))
+        now = time.monotonic()
+        with self._lock:
+            # 淘汰闲置过久的客户端；共享的 httpx.Client 不随之关闭
+            for idle_key in [k for k, (_, last_used) in self._clients.items() if now - last_used > self.idle_seconds]:
+                del self._clients[idle_key]
+                self.evictions += 1
+            entry = self._clients.get(key)
+            if entry is not None:
+                self.hits += 1
+                client = entry[0]
+            else:
+                self.misses += 1
+                client = OpenAI(base_url=base_url, api_key=api_key, http_client=self._http_client)
+            self._clients[key] = (client, now)
+            self._clients.move_to_end(key)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+            return client
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "clients": len(self._clients),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+llm_client_pool = LLMClientPool(LLM_CLIENT_POOL_SIZE, LLM_CLIENT_IDLE_SECONDS)
+
+# --- LLM 并发准入 ---
+
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))  # 同时进行的模型调用总数上限
+LLM_MAX_CONCURRENCY_PER_KEY = int(os.getenv('LLM_MAX_CONCURRENCY_PER_KEY', '4'))  # 同一 api_key 同时进行的调用数上限
+LLM_QUEUE_MAX_LENGTH = int(os.getenv('LLM_QUEUE_MAX_LENGTH', '200'))  # 排队的调用数上限，超过时直接拒绝
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', '300'))  # 最长排队时间（秒）
+
+class LLMQueueError(Exception):
+    """排队的模型调用过多或等待超时"""
+
+class LLMAdmissionTicket:
+    __slots__ = ('user', 'key', 'enqueued_at', 'granted', 'released')
+
+    def __init__(self, user, key):
+        self.user = user
+        self.key = key
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.released = False
+
+class LLMAdmissionController:
+    """模型调用的并发准入控制
+
+    同时进行的调用数受全局上限和每个 api_key 的上限约束：同一个 api_key 在模型服务端共享限流额度，
+    并发过多只会换来 429。超出上限的调用按用户排队，各用户轮流获得名额（用户内先来先服务），
+    一个用户一次提交的大量批次不会让其他用户一直等待；排队数和排队时间都有上限。
+    """
+
+    def __init__(self, max_concurrency, per_key_limit, max_queue_length, queue_timeout):
+        from collections import OrderedDict
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_key_limit = max(1, per_key_limit)
+        self.max_queue_length = max_queue_length
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.queued_total = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._active_by_key = {}
+        self._queues = OrderedDict()  # user -> deque[ticket]，字典顺序即轮转顺序
+        self._queue_length = 0
+        self._cond = threading.Condition()
+
+    def enqueue(self, user, api_key):
+        """登记一次调用；有空闲名额时立即获准，否则进入该用户的队列。user 为空时按 api_key 区分"""
+        key = token_fingerprint(api_key)
+        ticket = LLMAdmissionTicket(user or f"key:{key}", key)
+        with self._cond:
+            if self._queue_length >= self.max_queue_length:
+                self.rejected += 1
+                raise LLMQueueError("Too many queued LLM requests, please retry later")
+            self._queues.setdefault(ticket.user, deque()).append(ticket)
+            self._queue_length += 1
+            self._dispatch()
+            if not ticket.granted:
+                self.queued_total += 1
+        return ticket
+
+    def wait(self, ticket, timeout):
+        """等待获准，最多 timeout 秒；返回是否已获准。排队超过 queue_timeout 时移出队列并抛出 LLMQueueError"""
+        with self._cond:
+            if self._cond.wait_for(lambda: ticket.granted, timeout):
+                return True
+            if time.monotonic() - ticket.enqueued_at >= self.queue_timeout:
+                self._remove(ticket)
+                self.timed_out += 1
+                raise LLMQueueError(f"Timed out after waiting {self.queue_timeout:g}s for an LLM slot")
+            return False
+
+    def position(self, ticket):
+        """按轮转顺序估算前面还有多少个排队的调用（从1开始），不考虑 api_key 上限"""
+        with self._cond:
+            queue = self._queues.get(ticket.user)
+            if ticket.granted or not queue or ticket not in queue:
+                return 0
+            rank = queue.index(ticket)
+            ahead, before = rank, True
+            for user, other in self._queues.items():
+                if user == ticket.user:
+                    before = False
+                else:
+                    # 轮转顺序在本用户之前的用户，同一轮里排在本调用之前
+                    ahead += min(len(other), rank + 1 if before else rank)
+            return ahead + 1
+
+    def release(self, ticket):
+        """归还名额；尚未获准的调用（客户端断开、被取消）直接移出队列"""
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self.active -= 1
+                remaining = self._active_by_key[ticket.key] - 1
+                if remaining:
+                    self._active_by_key[ticket.key] = remaining
+                else:
+                    del self._active_by_key[ticket.key]
+            else:
+                self._remove(ticket)
+            self._dispatch()
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.user)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            self._queue_length -= 1
+            if not queue:
+                del self._queues[ticket.user]
+
+    def _dispatch(self):
+        """按用户轮流放行队首的调用，直到达到全局上限或剩余的队首都受 api_key 上限限制"""
+        granted = False
+        while self.active < self.max_concurrency:
+            for user, queue in self._queues.items():
+                if self._active_by_key.get(queue[0].key, 0) < self.per_key_limit:
+                    break
+            else:
+                break
+            ticket = queue.popleft()
+            self._queue_length -= 1
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            ticket.granted = True
+            self.active += 1
+            self.admitted += 1
+            self._active_by_key[ticket.key] = self._active_by_key.get(ticket.key, 0) + 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": self.active,
+                "max_concurrency": self.max_concurrency,
+                "per_key_limit": self.per_key_limit,
+                "active_keys": len(self._active_by_key),
+                "queued": self._queue_length,
+                "queued_users": len(self._queues),
+                "max_queue_length": self.max_queue_length,
+                "admitted": self.admitted,
+                "queued_total": self.queued_total,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out
+            }
+
+llm_admission = LLMAdmissionController(LLM_MAX_CONCURRENCY, LLM_MAX_CONCURRENCY_PER_KEY, LLM_QUEUE_MAX_LENGTH, LLM_QUEUE_TIMEOUT)
+
+def current_llm_user():
+    """当前请求在LLM队列中的身份：与分析任务相同，使用 resolve_user_scope 得到的用户范围，
+    令牌轮换后仍是同一用户；没有用户令牌时返回 None（按 api_key 区分）"""
+    user_access_token = get_request_user_token()
+    return resolve_user_scope(user_access_token) if user_access_token else None
+
+# --- LLM 流式输出 ---
+
+LLM_STREAM_FLUSH_INTERVAL = float(os.getenv('LLM_STREAM_FLUSH_INTERVAL', '0.05'))  # 合并输出片段的时间窗口（秒）
+LLM_STREAM_FLUSH_CHARS = int(os.getenv('LLM_STREAM_FLUSH_CHARS', '256'))  # 累计达到该字符数时立即输出
+
+# 预先编码的SSE帧前后缀，每个输出片段只需编码一次内容字符串
+_SSE_DELTA_PREFIXES = {kind: f'data: {{"type": "{kind}", "content": '.encode('utf-8') for kind in ('reasoning', 'content')}
+_SSE_QUEUED_PREFIX = b'data: {"type": "queued", "position": '
+_SSE_ERROR_PREFIX = b'data: {"error": '
+_SSE_FRAME_END = b'}\n\n'
+_SSE_DONE_FRAME = b'data: [DONE]\n\n'
+
+class LLMStreamCancelled(Exception):
+    """流式调用被取消"""
+
+class LLMStream:
+    """一次流式模型调用
+
+    deltas() 逐个产出 (kind, text)，kind 为 reasoning 或 content。模型通常每个token返回一个片段，
+    这里把相邻的同类片段按时间窗口（flush_interval）或累计字符数（flush_chars）合并后再产出，
+    第一个片段立即产出以免推迟首字时间。调用结束后记录首token耗时（TTFT）和输出速率。
+
+    调用前先经过 llm_admission 准入；排队期间产出 ('queued', 位置)，位置变化或每隔 SSE_KEEPALIVE_SECONDS 产出一次。
+    cancel_event 被设置或调用方关闭生成器时立即退出队列或关闭与模型服务的连接，停止生成。
+    """
+
+    def __init__(self, api_key, call_params, label='llm', cancel_event=None, user=None,
+                 flush_interval=LLM_STREAM_FLUSH_INTERVAL, flush_chars=LLM_STREAM_FLUSH_CHARS):
+        self.api_key = api_key
+        self.user = user
+        self.call_params = dict(call_params, stream=True)
+        self.label = label
+        self.cancel_event = cancel_event
+        self.flush_interval = flush_interval
+        self.flush_chars = flush_chars
+        self.status = 'pending'
+        self.chunks = 0
+        self.frames = 0
+        self.completion_tokens = None
+        self.queued_seconds = 0.0
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._content = []
+        self._reasoning = []
+
+    @property
+    def content(self):
+        """目前为止收到的全部正文（不含推理内容）"""
+        return ''.join(self._content)
+
+    @property
+    def reasoning(self):
+        """目前为止收到的全部推理内容"""
+        return ''.join(self._reasoning)
+
+    def deltas(self):
+        ticket = llm_admission.enqueue(self.user, self.api_key)
+        try:
+            if not ticket.granted:
+                self.status = 'queued'
+                last_position, last_notice = None, 0.0
+                while not llm_admission.wait(ticket, 0 if last_position is None else 1.0):
+                    if self.cancel_event is not None and self.cancel_event.is_set():
+                        self.status = 'cancelled'
+                        raise LLMStreamCancelled()
+                    position, now = llm_admission.position(ticket), time.monotonic()
+                    if position and (position != last_position or now - last_notice >= SSE_KEEPALIVE_SECONDS):
+                        last_position, last_notice = position, now
+                        yield 'queued', position
+                self.queued_seconds = time.monotonic() - ticket.enqueued_at
+            yield from self._stream()
+        finally:
+            llm_admission.release(ticket)
+
+    def _stream(self):
+        client = llm_client_pool.get(LLM_BASE_URL, self.api_key)
+        self.started_at = time.monotonic()
+        self.status = 'running'
+        stream = client.chat.completions.create(**self.call_params)
+        pending_kind, pending, pending_chars = None, [], 0
+        last_flush = self.started_at
+        try:
+            for chunk in stream:
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    raise LLMStreamCancelled()
+                usage = getattr(chunk, 'usage', None)
+                if usage is not None:
+                    self.completion_tokens = usage.completion_tokens
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                for kind, text in (('reasoning', getattr(delta, 'reasoning_content', None)), ('content', delta.content)):
+                    if not text:
+                        continue
+                    self.chunks += 1
+                    (self._content if kind == 'content' else self._reasoning).append(text)
+                    if kind != pending_kind and pending:
+                        # 推理内容和正文不合并到同一帧，保持原有顺序
+                        self.frames += 1
+                        yield pending_kind, ''.join(pending)
+                        pending, pending_chars = [], 0
+                    pending_kind = kind
+                    pending.append(text)
+                    pending_chars += len(text)
+                if not pending:
+                    continue
+                now = time.monotonic()
+                if self.first_token_at is None:
+                    self.first_token_at = now
+                elif pending_chars < self.flush_chars and now - last_flush < self.flush_interval:
+                    continue
+                self.frames += 1
+                yield pending_kind, ''.join(pending)
+                pending, pending_chars, last_flush = [], 0, now
+            if pending:
+                self.frames += 1
+                yield pending_kind, ''.join(pending)
+            self.status = 'completed'
+        except (GeneratorExit, LLMStreamCancelled):
+            self.status = 'cancelled'
+            raise
+        except Exception:
+            self.status = 'failed'
+            raise
+        finally:
+            stream.response.close()
+            self.finished_at = time.monotonic()
+            app.logger.info(f"LLM stream [{self.label}] {self.status}: {self.describe()}")
+
+    def describe(self):
+        """返回本次调用的耗时统计；没有usage信息时按片段数估算token数"""
+        end = self.finished_at or time.monotonic()
+        tokens = self.completion_tokens if self.completion_tokens is not None else self.chunks
+        ttft = self.first_token_at - self.started_at if self.first_token_at and self.started_at else None
+        generation_time = end - self.first_token_at if self.first_token_at else 0
+        return {
+            "model": self.call_params.get('model'),
+            "queued": round(self.queued_seconds, 3),
+            "ttft": round(ttft, 3) if ttft is not None else None,
+            "duration": round(end - self.started_at, 3) if self.started_at else None,
+            "tokens": tokens,
+            "tokens_per_second": round(tokens / generation_time, 1) if generation_time > 0 else None,
+            "chunks": self.chunks,
+            "frames": self.frames
+        }
+
+def stream_llm_sse(api_key, call_params, label='llm', user=None, cache_key=None):
+    """流式调用模型并产出SSE帧（bytes）：{"type": reasoning|content, "content": ...}，最后是 [DONE] 或 {"error": ...}
+
+    排队等待时先产出 {"type": "queued", "position": n}。给出 cache_key 时先查响应缓存，
+    命中则直接回放，未命中则在调用正常结束后写入缓存。
+    """
+    try:
+        if cache_key:
+            cached = llm_response_cache.get(cache_key)
+            if cached is not None:
+                app.logger.info(f"LLM response cache hit [{label}]: {cache_key[:16]}")
+                yield from replay_llm_response(*cached)
+                return
+        llm_stream = LLMStream(api_key, call_params, label=label, user=user)
+        for kind, text in llm_stream.deltas():
+            if kind == 'queued':
+                yield _SSE_QUEUED_PREFIX + str(text).encode('ascii') + _SSE_FRAME_END
+                continue
+            yield _SSE_DELTA_PREFIXES[kind] + json_dumps_bytes(text) + _SSE_FRAME_END
+        if cache_key:
+            try:
+                llm_response_cache.put(cache_key, call_params.get('model'), llm_stream.reasoning, llm_stream.content)
+            except sqlite3.Error as e:
+                app.logger.warning(f"Failed to cache LLM response [{label}]: {e}")
+        yield _SSE_DONE_FRAME
+    except Exception as e:
+        app.logger.error(f"LLM request error [{label}]: {e}")
+        yield _SSE_ERROR_PREFIX + json_dumps_bytes(str(e)) + _SSE_FRAME_END
+
+# --- LLM 响应缓存 ---
+
+LLM_RESPONSE_CACHE_TTL = int(os.getenv('LLM_RESPONSE_CACHE_TTL', str(24 * 3600)))  # 缓存结果保留时间（秒），0表示关闭
+LLM_RESPONSE_CACHE_DISK_MB = int(os.getenv('LLM_RESPONSE_CACHE_DISK_MB', '256'))  # 磁盘缓存容量
+LLM_RESPONSE_REPLAY_CHARS = 2048  # 回放缓存结果时每帧的字符数
+
+class LLMResponseCache:
+    """模型完整输出的磁盘缓存（SQLite）
+
+    键为 (api_key 指纹, model, 替换占位符后的 messages, temperature, max_tokens) 的哈希，输入完全相同的分析直接回放上次的结果；
+    不同 api_key 的结果互不复用，无效或他人的 key 不能拿到别人付费得到的输出。
+    只有请求显式带 cache 参数时才使用（见 llm_response_cache_key），只缓存正常结束的调用。
+    """
+
+    def __init__(self, path, ttl, disk_bytes):
+        self.path = path
+        self.ttl = ttl
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_responses ("
+            "cache_key TEXT PRIMARY KEY, model TEXT, reasoning TEXT NOT NULL, content TEXT NOT NULL, "
+            "size INTEGER NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_responses_accessed ON llm_responses (accessed_at)")
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def get(self, cache_key):
+        """返回 (reasoning, content, stored_at)，未命中或已过期时返回 None"""
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT reasoning, content, stored_at FROM llm_responses WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        if row is None or now - row[2] > self.ttl:
+            with self._lock:
+                self.misses += 1
+            return None
+        conn.execute("UPDATE llm_responses SET accessed_at = ? WHERE cache_key = ?", (now, cache_key))
+        with self._lock:
+            self.hits += 1
+        return row
+
+    def put(self, cache_key, model, reasoning, content):
+        now = time.time()
+        size = len(reasoning.encode('utf-8')) + len(content.encode('utf-8'))
+        if size > self.disk_bytes:
+            return
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_responses (cache_key, model, reasoning, content, size, stored_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (cache_key, model, reasoning, content, size, now, now)
+        )
+        self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        """删除过期结果，总大小仍超过容量时按最近访问时间淘汰"""
+        conn.execute("DELETE FROM llm_responses WHERE stored_at < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_responses").fetchone()[0]
+        if total <= self.disk_bytes:
+            return
+        rows = conn.execute("SELECT cache_key, size FROM llm_responses ORDER BY accessed_at").fetchall()
+        for cache_key, size in rows:
+            if total <= self.disk_bytes:
+                break
+            conn.execute("DELETE FROM llm_responses WHERE cache_key = ?", (cache_key,))
+            total -= size
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def stats(self):
+        entries, used = self._connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_responses"
+        ).fetchone()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": self.ttl > 0,
+                "entries": entries,
+                "disk_bytes": used,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0
+            }
+
+llm_response_cache = LLMResponseCache(
+    os.getenv('LLM_RESPONSE_CACHE_DB_PATH', os.path.join(DATA_DIR, 'llm_responses.db')),
+    LLM_RESPONSE_CACHE_TTL,
+    LLM_RESPONSE_CACHE_DISK_MB * 1024 * 1024
+)
 
+def parse_llm_temperature(value):
+    """校验请求中的 temperature：未提供时返回 None，否则返回 0~2 之间的浮点数，无效时抛出 ValueError"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise ValueError("temperature must be a number")
     try:
-        # Fetch nodes with pagination
-        data = fetch_node_children(space_id, parent_node_token, user_access_token, page_token)
-        return jsonify(data)
+        temperature = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("temperature must be a number")
+    # NaN 与任何数比较都为 False，同样会被拒绝
+    if not 0 <= temperature <= 2:
+        raise ValueError("temperature must be between 0 and 2")
+    return temperature
 
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Request error: {str(e)}")
-        if e.response is not None:
-            app.logger.error(f"Response status: {e.response.status_code}")
-            app.logger.error(f"Response content: {e.response.text}")
-            try:
-                error_data = e.response.json()
-                return jsonify({"error": error_data}), e.response.status_code
-            except ValueError:
-                return jsonify({"error": e.response.text}), e.response.status_code
-        return jsonify({"error": str(e)}), 500
+def llm_response_cache_key(cache_mode, call_params, api_key):
+    """根据请求的 cache 参数决定是否使用响应缓存，返回缓存键或 None
 
-@app.route('/api/wiki/doc/<obj_token>', methods=['GET'])
-def get_wiki_document(obj_token):
-    # 记录请求信息，便于调试
-    app.logger.info(f"=== Incoming /api/wiki/doc/{obj_token} Request ===")
-    app.logger.info(f"Request headers: {dict(request.headers)}")
-    
-    # 支持多种认证方式，增强健壮性
-    user_access_token = None
-    auth_header = request.headers.get('Authorization')
-    user_access_token_header = request.headers.get('user-access-token')
-    
-    # 优先使用 Authorization 头（标准Bearer Token）
-    if auth_header and auth_header.startswith('Bearer '):
-        user_access_token = auth_header.split(' ')[1]
-        app.logger.info("Using Authorization header for authentication")
-    # 兼容 user-access-token 头
-    elif user_access_token_header:
-        user_access_token = user_access_token_header
-        app.logger.info("Using user-access-token header for authentication")
-    
-    # 如果没有找到任何认证信息
-    if not user_access_token:
-        app.logger.error("No valid authentication token found in request headers")
-        app.logger.error(f"Available headers: {list(request.headers.keys())}")
-        return jsonify({"error": "Authentication required. Please provide valid token in Authorization or user-access-token header"}), 401
-    
-    # 记录token信息（脱敏处理）
-    token_preview = user_access_token[:10] + "..." if len(user_access_token) > 10 else user_access_token
-    app.logger.info(f"Authentication successful, token preview: {token_preview}")
-    
-    url = f"https://open.feishu.cn/open-apis/docx/v1/documents/{obj_token}/raw_content"
-    headers = {
-        "Authorization": f"Bearer {user_access_token}"
-    }
-    
-    app.logger.info(f"Fetching document content from Feishu with URL: {url}")
-    app.logger.info(f"Document obj_token: {obj_token}")
+    cache 为 true 时只缓存 temperature 为 0 的确定性调用；未指定 temperature 时模型按默认温度采样，
+    同样视为非确定性。cache 为 "force" 时不论 temperature 都使用缓存。
+    call_params 中的 temperature 须已经过 parse_llm_temperature 校验。
+    命中缓存时不会请求模型服务，因此键中包含 api_key 的指纹，只有用同一个 key 发起的调用才能复用结果。
+    """
+    if not cache_mode or LLM_RESPONSE_CACHE_TTL <= 0:
+        return None
+    temperature = call_params.get('temperature')
+    if cache_mode != 'force' and (temperature is None or float(temperature) > 0):
+        llm_response_cache.record_bypass()
+        return None
+    key_source = json.dumps(
+        [token_fingerprint(api_key), call_params.get('model'), call_params.get('messages'), temperature, call_params.get('max_tokens')],
+        ensure_ascii=False, sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
 
-    try:
-        response = requests.get(url, headers=headers)
-        app.logger.info(f"Feishu API response status: {response.status_code}")
-        app.logger.info(f"Feishu API response headers: {dict(response.headers)}")
-        
-        response.raise_for_status()
-        data = response.json()
-        app.logger.info(f"Feishu API response data: {data}")
-        
-        if data.get("code") == 0:
-            document_data = data.get("data", {})
-            content_length = len(document_data.get('content', ''))
-            app.logger.info(f"Successfully fetched document content, length: {content_length}")
-            return jsonify(document_data)
-        else:
-            error_msg = data.get("msg", "Failed to fetch document")
-            app.logger.error(f"Feishu API returned error: {error_msg}")
-            app.logger.error(f"Feishu API error code: {data.get('code')}")
-            return jsonify({"error": error_msg}), 500
-    except requests.exceptions.RequestException as e:
-        error_msg = f"Failed to fetch document content: {e}"
-        app.logger.error(error_msg)
-        if e.response is not None:
-            app.logger.error(f"Response status: {e.response.status_code}")
-            app.logger.error(f"Response headers: {dict(e.response.headers)}")
-            app.logger.error(f"Response content: {e.response.text}")
-            try:
-                error_data = e.response.json()
-                return jsonify({"error": error_data}), e.response.status_code
-            except ValueError:
-                return jsonify({"error": e.response.text}), e.response.status_code
-        return jsonify({"error": str(e)}), 500
+def replay_llm_response(reasoning, content, stored_at):
+    """把缓存的结果回放为与实时调用相同格式的SSE帧，开头附加 {"type": "cached"} 帧"""
+    yield b'data: {"type": "cached", "stored_at": ' + json_dumps_bytes(stored_at) + _SSE_FRAME_END
+    for kind, text in (('reasoning', reasoning), ('content', content)):
+        for start in range(0, len(text), LLM_RESPONSE_REPLAY_CHARS):
+            yield _SSE_DELTA_PREFIXES[kind] + json_dumps_bytes(text[start:start + LLM_RESPONSE_REPLAY_CHARS]) + _SSE_FRAME_END
+    yield _SSE_DONE_FRAME
 
 @app.route('/api/chat/stream', methods=['POST'])
 def chat_stream():
@@ -2107,54 +4930,47 @@ def chat_stream():
     if not all([api_key, messages]):
         return jsonify({"error": "Missing required parameters"}), 400
 
-    def generate():
-        try:
-            # 使用OpenAI SDK进行流式调用
-            client = OpenAI(
-                base_url="https://ark.cn-beijing.volces.com/api/v3",
-                api_key=api_key
-            )
-            
-            stream = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                stream=True,
-            )
-            
-            for chunk in stream:
-                if not chunk.choices:
-                    continue
-                
-                # 处理 reasoning_content
-                reasoning_content = ""
-                if hasattr(chunk.choices[0].delta, 'reasoning_content'):
-                    reasoning_content = chunk.choices[0].delta.reasoning_content or ""
-                if reasoning_content:
-                    # 按照SSE格式返回推理内容，并添加前缀以区分
-                    # 使用 json.dumps 确保内容被正确转义
-                    import json
-                    yield f"data: {{\"type\": \"reasoning\", \"content\": {json.dumps(reasoning_content)}}}\n\n"
-                
-                # 处理 content
-                content = ""
-                if hasattr(chunk.choices[0].delta, 'content'):
-                    content = chunk.choices[0].delta.content or ""
-                if content:
-                    # 按照SSE格式返回内容，并添加前缀以区分
-                    # 使用 json.dumps 确保内容被正确转义
-                    import json
-                    yield f"data: {{\"type\": \"content\", \"content\": {json.dumps(content)}}}\n\n"
-            
-            # 发送结束信号
-            yield "data: [DONE]\n\n"
-        except Exception as e:
-            app.logger.error(f"LLM request error: {e}")
-            # 使用 json.dumps 确保错误信息被正确转义
-            import json
-            yield f"data: {{\"error\": {json.dumps(str(e))}}}\n\n"
+    call_params = {"model": model, "messages": messages}
+    return Response(stream_llm_sse(api_key, call_params, label='chat', user=current_llm_user()), content_type='text/event-stream')
 
-    return Response(generate(), content_type='text/event-stream')
 
+# --- 提示词模板 ---
+
+PROMPT_TEMPLATE_CACHE_SIZE = 128  # 缓存的已编译模板数
+_PLACEHOLDER_PATTERN = re.compile(r'\{([^{}]+)\}')
+
+class CompiledPromptTemplate:
+    """预先解析好 {NAME} 占位符位置的提示词模板
+
+    模板被拆分为交替的字面文本和占位符名，render 一次拼接出结果，不需要对整段提示词反复 str.replace，
+    也不会再扫描替换进去的内容（文档或目录里出现的 {xxx} 文本保持原样）。
+    """
+    __slots__ = ('literals', 'slots', 'names')
+
+    def __init__(self, template):
+        self.literals = []  # 比 slots 多一个，literals[i] 在 slots[i] 之前
+        self.slots = []
+        position = 0
+        for match in _PLACEHOLDER_PATTERN.finditer(template):
+            self.literals.append(template[position:match.start()])
+            self.slots.append(match.group(1))
+            position = match.end()
+        self.literals.append(template[position:])
+        self.names = frozenset(self.slots)
+
+    def render(self, values):
+        """values 为占位符名到字符串的映射，没有提供值的占位符原样保留"""
+        parts = [self.literals[0]]
+        for name, literal in zip(self.slots, self.literals[1:]):
+            value = values.get(name)
+            parts.append(f'{{{name}}}' if value is None else value)
+            parts.append(literal)
+        return ''.join(parts)
+
+@lru_cache(maxsize=PROMPT_TEMPLATE_CACHE_SIZE)
+def compile_prompt_template(prompt_template):
+    """编译提示词模板；同一模板（按内容哈希）只解析一次"""
+    return CompiledPromptTemplate(prompt_template)
 
 def replace_placeholders(prompt_template, placeholders):
     """
@@ -2164,7 +4980,6 @@ def replace_placeholders(prompt_template, placeholders):
     :return: 替换后的提示词
     """
     app.logger.info(f"Starting placeholder replacement with template length: {len(prompt_template) if prompt_template else 0}")
-    app.logger.debug(f"Placeholders to replace: {placeholders}")
     
     if not prompt_template:
         app.logger.warning("Empty prompt_template provided to replace_placeholders")
@@ -2174,38 +4989,33 @@ def replace_placeholders(prompt_template, placeholders):
         app.logger.error(f"Invalid placeholders type: {type(placeholders)}, expected dict")
         return prompt_template
     
-    result = prompt_template
-    replaced_count = 0
-    
+    compiled = compile_prompt_template(prompt_template)
+    values = {}
     for placeholder, value in placeholders.items():
         if not isinstance(placeholder, str):
             app.logger.warning(f"Invalid placeholder type: {type(placeholder)}, skipping")
             continue
-            
-        placeholder_pattern = f'{{{placeholder}}}'
-        if placeholder_pattern in result:
+        if placeholder in compiled.names:
             # 确保占位符被正确替换，即使值为None也替换为空字符串
-            replacement_value = str(value) if value is not None else ''
-            result = result.replace(placeholder_pattern, replacement_value)
-            replaced_count += 1
-            app.logger.debug(f"Replaced placeholder '{placeholder}' with value (length: {len(replacement_value)})")
-        else:
-            app.logger.debug(f"Placeholder '{placeholder}' not found in template")
+            values[placeholder] = str(value) if value is not None else ''
+    app.logger.debug(f"Placeholders to replace: {sorted(values)}, not in template: {sorted(set(placeholders) - compiled.names, key=str)}")
     
-    # 检查是否还有未替换的占位符
-    import re
-    remaining_placeholders = re.findall(r'\{([^}]+)\}', result)
+    result = compiled.render(values)
+    
+    # 检查模板中是否还有未提供值的占位符
+    remaining_placeholders = sorted(compiled.names - values.keys())
     if remaining_placeholders:
         app.logger.warning(f"Found unreplaced placeholders: {remaining_placeholders}")
     
-    app.logger.info(f"Placeholder replacement completed: {replaced_count} placeholders replaced")
+    app.logger.info(f"Placeholder replacement completed: {len(values)} placeholders replaced")
     app.logger.debug(f"Final prompt length after replacement: {len(result)}")
     return result
 
 @app.route('/api/llm/stream_analysis', methods=['POST'])
 def stream_analysis():
     data = request.json
-    app.logger.info(f"Received stream_analysis request with data: {data}")
+    # 请求体中含 api_key 和完整的提示词内容，只记录字段名
+    app.logger.info(f"Received stream_analysis request with fields: {sorted(data or {})}")
     
     api_key = data.get('api_key')
     model = data.get('model', 'doubao-seed-1-6-250615')  # 默认模型参数
@@ -2228,7 +5038,7 @@ def stream_analysis():
         prompt = replace_placeholders(prompt_template, all_placeholders)
         # 使用替换后的提示词
         messages = [{'role': 'user', 'content': prompt}]
-        app.logger.info(f"Prompt after placeholder replacement: {prompt}")
+        app.logger.info(f"Prompt after placeholder replacement, length: {len(prompt)}, placeholders: {sorted(all_placeholders, key=str)}")
     
     # 如果到这里还没有 messages，则报错
     if not messages:
@@ -2238,7 +5048,11 @@ def stream_analysis():
 
     # 处理额外参数
     extra_params = {}
-    temperature = data.get('temperature')
+    try:
+        temperature = parse_llm_temperature(data.get('temperature'))
+    except ValueError as e:
+        app.logger.error(f"Invalid temperature: {str(e)}")
+        return jsonify({"error": str(e)}), 400
     max_tokens = data.get('max_tokens')
 
     if temperature is not None:
@@ -2246,67 +5060,28 @@ def stream_analysis():
     if max_tokens is not None:
         extra_params['max_tokens'] = max_tokens
 
-    def generate():
-        try:
-            # 使用OpenAI SDK进行流式调用
-            client = OpenAI(
-                base_url="https://ark.cn-beijing.volces.com/api/v3",
-                api_key=api_key
-            )
-            
-            # 准备调用参数
-            call_params = {
-                "model": model,
-                "messages": messages,
-                "stream": True,
-                **extra_params  # 展开额外参数
-            }
-            
-            app.logger.info(f"Calling LLM with params: {call_params}")
-            app.logger.info(f"Prompt sent to LLM (first 500 chars): {call_params['messages'][0]['content'][:500]}...")
-            
-            stream = client.chat.completions.create(**call_params)
-            
-            for chunk in stream:
-                if not chunk.choices:
-                    continue
-                
-                # 处理 reasoning_content
-                reasoning_content = ""
-                if hasattr(chunk.choices[0].delta, 'reasoning_content'):
-                    reasoning_content = chunk.choices[0].delta.reasoning_content or ""
-                if reasoning_content:
-                    # 按照SSE格式返回推理内容，并添加前缀以区分
-                    # 使用 json.dumps 确保内容被正确转义
-                    import json
-                    yield f"data: {{\"type\": \"reasoning\", \"content\": {json.dumps(reasoning_content)}}}\n\n"
-                
-                # 处理 content
-                content = ""
-                if hasattr(chunk.choices[0].delta, 'content'):
-                    content = chunk.choices[0].delta.content or ""
-                if content:
-                    # 按照SSE格式返回内容，并添加前缀以区分
-                    # 使用 json.dumps 确保内容被正确转义
-                    import json
-                    yield f"data: {{\"type\": \"content\", \"content\": {json.dumps(content)}}}\n\n"
-            
-            # 发送结束信号
-            yield "data: [DONE]\n\n"
-        except Exception as e:
-            error_msg = f"LLM Request error: {str(e)}"
-            app.logger.error(error_msg)
-            # 使用 json.dumps 确保错误信息被正确转义
-            import json
-            yield f"data: {{\"error\": {json.dumps(str(e))}}}\n\n"
+    call_params = {
+        "model": model,
+        "messages": messages,
+        **extra_params  # 展开额外参数
+    }
+    # 提示词可能包含文档全文，日志只记录长度
+    message_count = len(messages) if isinstance(messages, list) else 1
+    prompt_length = sum(len(str(m.get('content', ''))) for m in messages if isinstance(m, dict)) if isinstance(messages, list) else len(str(messages))
+    app.logger.info(f"Calling LLM, model: {model}, messages: {message_count}, prompt length: {prompt_length}, params: {extra_params}")
+
+    # 请求带 cache 参数时，输入相同的分析直接回放缓存的结果
+    cache_key = llm_response_cache_key(data.get('cache'), call_params, api_key)
 
     app.logger.info("Starting stream response for LLM analysis")
-    return Response(generate(), content_type='text/event-stream')
+    return Response(stream_llm_sse(api_key, call_params, label='stream_analysis', user=current_llm_user(), cache_key=cache_key),
+                    content_type='text/event-stream')
 
 @app.route('/api/llm/doc_import_analysis', methods=['POST'])
 def doc_import_analysis():
     data = request.json
-    app.logger.info(f"Received doc_import_analysis request with data: {data}")
+    # 请求体中含 api_key 和完整的提示词内容，只记录字段名
+    app.logger.info(f"Received doc_import_analysis request with fields: {sorted(data or {})}")
     
     doc_token = data.get('doc_token')
     doc_type = data.get('doc_type', 'docx')  # 获取文档类型，默认为docx
@@ -2325,6 +5100,11 @@ def doc_import_analysis():
         error_msg = "Missing required parameters"
         app.logger.error(error_msg)
         return jsonify({"error": error_msg}), 400
+    try:
+        temperature = parse_llm_temperature(data.get('temperature'))
+    except ValueError as e:
+        app.logger.error(f"Invalid temperature: {str(e)}")
+        return jsonify({"error": str(e)}), 400
 
     # 1. Get document content from Feishu
     doc_content = ''
@@ -2332,86 +5112,48 @@ def doc_import_analysis():
         # 如果是wiki类型，需要先获取实际的obj_type和obj_token
         if doc_type == 'wiki':
             app.logger.info(f"Processing wiki type document with token: {doc_token}")
-            # 调用获取知识空间节点接口
-            node_url = f"https://open.feishu.cn/open-apis/wiki/v2/spaces/get_node?token={doc_token}"
-            headers = {"Authorization": f"Bearer {user_access_token}"}
-            app.logger.info(f"Fetching wiki node info with URL: {node_url}")
-            
-            node_response = requests.get(node_url, headers=headers)
-            node_response.raise_for_status()
-            node_data = node_response.json()
-            app.logger.info(f"Received wiki node info: {node_data}")
-            
-            if node_data.get("code") == 0:
-                node_info = node_data.get("data", {})
-                # 从嵌套的node对象中获取obj_type和obj_token
-                node_detail = node_info.get("node", {})
-                actual_obj_type = node_detail.get("obj_type")
-                actual_obj_token = node_detail.get("obj_token")
-                
-                # 添加详细的调试日志，记录完整的数据结构
-                app.logger.info(f"Wiki node data structure - node_info: {node_info}")
-                app.logger.info(f"Wiki node detail - node_detail: {node_detail}")
-                app.logger.info(f"Wiki node resolved - obj_type: {actual_obj_type}, obj_token: {actual_obj_token}")
-                
-                # 配置化的支持文档类型，便于扩展
-                SUPPORTED_DOC_TYPES = ['doc', 'docx']
-                
-                # 检查obj_type是否为支持的文档类型
-                if not actual_obj_type:
-                    error_msg = f"Failed to extract document type from wiki node. Response structure may have changed."
-                    app.logger.error(error_msg)
-                    app.logger.error(f"Available fields in node_detail: {list(node_detail.keys()) if node_detail else 'None'}")
-                    return jsonify({"error": error_msg}), 400
-                
-                # 检查obj_token是否存在
-                if not actual_obj_token:
-                    error_msg = f"Failed to extract document token from wiki node. Document token is required."
-                    app.logger.error(error_msg)
-                    app.logger.error(f"Document type: {actual_obj_type}, Available fields: {list(node_detail.keys()) if node_detail else 'None'}")
-                    return jsonify({"error": error_msg}), 400
-                
-                if actual_obj_type not in SUPPORTED_DOC_TYPES:
-                    error_msg = f"Unsupported document type: {actual_obj_type}. Only {', '.join(SUPPORTED_DOC_TYPES)} types are supported."
-                    app.logger.error(error_msg)
-                    app.logger.error(f"Document token: {actual_obj_token}, Available types: {list(node_detail.keys()) if node_detail else 'None'}")
-                    return jsonify({"error": error_msg}), 400
-                
-                # 根据文档类型构建不同的API URL，增强可扩展性
-                if actual_obj_type == 'docx':
-                    doc_url = f"https://open.feishu.cn/open-apis/docx/v1/documents/{actual_obj_token}/raw_content"
-                elif actual_obj_type == 'doc':
-                    doc_url = f"https://open.feishu.cn/open-apis/doc/v1/documents/{actual_obj_token}/raw_content"
-                else:
-                    # 理论上不会执行到这里，因为前面已经检查了支持的类型
-                    error_msg = f"Document type {actual_obj_type} not implemented yet."
-                    app.logger.error(error_msg)
-                    return jsonify({"error": error_msg}), 500
-                app.logger.info(f"Fetching document content for wiki with resolved URL: {doc_url}")
-            else:
-                error_msg = node_data.get("msg", "Failed to fetch wiki node info")
+            # 获取知识空间节点信息（优先命中节点解析缓存，否则调用 get_node 接口）
+            node_detail = resolve_wiki_node(doc_token, user_access_token)
+            actual_obj_type = node_detail.get("obj_type")
+            actual_obj_token = node_detail.get("obj_token")
+            app.logger.info(f"Wiki node detail - node_detail: {node_detail}")
+            app.logger.info(f"Wiki node resolved - obj_type: {actual_obj_type}, obj_token: {actual_obj_token}")
+            
+            # 配置化的支持文档类型，便于扩展
+            SUPPORTED_DOC_TYPES = ['doc', 'docx']
+            
+            # 检查obj_type是否为支持的文档类型
+            if not actual_obj_type:
+                error_msg = f"Failed to extract document type from wiki node. Response structure may have changed."
                 app.logger.error(error_msg)
-                return jsonify({"error": error_msg}), 500
+                app.logger.error(f"Available fields in node_detail: {list(node_detail.keys()) if node_detail else 'None'}")
+                return jsonify({"error": error_msg}), 400
+            
+            # 检查obj_token是否存在
+            if not actual_obj_token:
+                error_msg = f"Failed to extract document token from wiki node. Document token is required."
+                app.logger.error(error_msg)
+                app.logger.error(f"Document type: {actual_obj_type}, Available fields: {list(node_detail.keys()) if node_detail else 'None'}")
+                return jsonify({"error": error_msg}), 400
+            
+            if actual_obj_type not in SUPPORTED_DOC_TYPES:
+                error_msg = f"Unsupported document type: {actual_obj_type}. Only {', '.join(SUPPORTED_DOC_TYPES)} types are supported."
+                app.logger.error(error_msg)
+                app.logger.error(f"Document token: {actual_obj_token}, Available types: {list(node_detail.keys()) if node_detail else 'None'}")
+                return jsonify({"error": error_msg}), 400
+            
+            content_obj_type, content_obj_token = actual_obj_type, actual_obj_token
         else:
             # 直接使用doc_token获取文档内容
-            doc_url = f"https://open.feishu.cn/open-apis/docx/v1/documents/{doc_token}/raw_content"
-            app.logger.info(f"Fetching document content from Feishu with URL: {doc_url}")
-        
-        # 获取文档内容
-        headers = {"Authorization": f"Bearer {user_access_token}"}
-        response = requests.get(doc_url, headers=headers)
-        response.raise_for_status()
-        doc_data = response.json()
-        app.logger.info(f"Received response from Feishu: {doc_data}")
+            content_obj_type, content_obj_token = 'docx', doc_token
         
-        if doc_data.get("code") == 0:
-            doc_content = doc_data.get("data", {}).get('content', '')
-            app.logger.info(f"Successfully fetched document content, length: {len(doc_content)}")
-        else:
-            error_msg = doc_data.get("msg", "Failed to fetch document content")
-            app.logger.error(error_msg)
-            return jsonify({"error": error_msg}), 500
+        # 获取文档内容（同一版本的文档重复分析时命中文档内容缓存）
+        doc_content = fetch_document_content(content_obj_type, content_obj_token, user_access_token)
+        app.logger.info(f"Successfully fetched document content, length: {len(doc_content)}")
             
+    except DocumentFetchError as e:
+        app.logger.error(str(e))
+        return jsonify({"error": str(e)}), 500
     except requests.exceptions.RequestException as e:
         error_msg = f"Failed to fetch document content: {e}"
         app.logger.error(error_msg)
@@ -2434,8 +5176,8 @@ def doc_import_analysis():
         app.logger.info(f"  - IMPORTED_DOCUMENT_CONTENT length: {len(doc_content)}")
         app.logger.info(f"  - KNOWLEDGE_BASE_STRUCTURE length: {len(wiki_node_md)}")
         app.logger.info(f"  - WIKI_TITLE: {wiki_title}")
-        app.logger.info(f"  - Received placeholders: {placeholders}")
-        app.logger.info(f"Prompt after placeholder replacement (first 200 chars): {prompt[:200]}...")
+        app.logger.info(f"  - Received placeholders: {sorted(placeholders, key=str)}")
+        app.logger.info(f"Prompt after placeholder replacement, length: {len(prompt)}")
     else:
         prompt = f"""你是一位专业的知识管理专家，具备以下能力：
 1. 深入理解文档内容，分析其主题、关键信息和潜在价值。
@@ -2465,65 +5207,513 @@ def doc_import_analysis():
 综合以上分析，给出是否建议导入该文档的最终决策（建议导入/暂不建议导入），并提供简要说明。"""
         app.logger.info(f"Using default prompt template")
 
-    def generate():
+    # 处理额外参数
+    extra_params = {}
+    if temperature is not None:
+        extra_params['temperature'] = temperature
+    if max_tokens is not None:
+        extra_params['max_tokens'] = max_tokens
+
+    call_params = {
+        "model": model,
+        "messages": [{'role': 'user', 'content': prompt}],
+        **extra_params  # 展开额外参数
+    }
+    app.logger.info(f"Calling LLM, model: {model}, prompt length: {len(prompt)}, params: {extra_params}")
+
+    # 请求带 cache 参数时，输入相同的分析直接回放缓存的结果
+    cache_key = llm_response_cache_key(data.get('cache'), call_params, api_key)
+
+    app.logger.info("Starting stream response for document import analysis")
+    return Response(stream_llm_sse(api_key, call_params, label='doc_import_analysis', user=current_llm_user(), cache_key=cache_key),
+                    content_type='text/event-stream')
+
+# --- 知识库分析任务（map-reduce） ---
+
+ANALYSIS_MAP_CONCURRENCY = int(os.getenv('ANALYSIS_MAP_CONCURRENCY', '4'))  # 单个任务内并发的分批分析数
+ANALYSIS_BATCH_TOKEN_BUDGET = int(os.getenv('ANALYSIS_BATCH_TOKEN_BUDGET', '24000'))  # 每批提示词的目标token数（含模板和文档内容）
+ANALYSIS_BATCH_MIN_STRUCTURE_TOKENS = 1000  # 模板和文档内容占满预算时，目录部分至少保留的token数
+ANALYSIS_JOB_TTL = int(os.getenv('ANALYSIS_JOB_TTL', '3600'))  # 任务结束后保留多久以便重新连接（秒）
+ANALYSIS_MAX_JOBS_PER_USER = int(os.getenv('ANALYSIS_MAX_JOBS_PER_USER', '2'))  # 同一用户同时运行的任务数上限
+ANALYSIS_MAX_FINISHED_JOBS = int(os.getenv('ANALYSIS_MAX_FINISHED_JOBS', '200'))  # 最多保留的已结束任务数，超过时淘汰最早结束的
+# 任务结束后事件日志只保留重绘结果所需的事件，输出片段（*_content、*_reasoning 等）被丢弃
+ANALYSIS_RETAINED_EVENT_TYPES = frozenset(('batches', 'batch_done', 'batch_error', 'done', 'error', 'cancelled'))
+ANALYSIS_DELTA_INTERVAL = float(os.getenv('ANALYSIS_DELTA_INTERVAL', '0.2'))  # 合并模型输出片段的时间窗口（秒）
+
+# 汇总阶段的默认提示词，{BATCH_RESULTS} 替换为各批次的分析结果
+ANALYSIS_SUMMARY_PROMPT = """你是一位知识管理专家，现在需要对前面分批分析的结果进行总结归纳。
+
+## 分批分析结果
+{BATCH_RESULTS}
+
+## 总结要求
+请基于以上分批分析结果，提供一个综合性的总结分析，包括：
+1. 整体评估结论
+2. 主要发现的问题（按根节点分类说明）
+3. 综合优化建议（针对不同根节点的专项建议）
+4. 后续改进方向
+
+请使用Markdown格式输出，确保结构清晰、重点突出。在总结中请明确提及各个根节点的分析结果，便于用户对照查看。"""
+
+class AnalysisCancelled(Exception):
+    """分析任务被取消"""
+
+class AnalysisJobLimitError(Exception):
+    """用户同时运行的分析任务过多"""
+
+def wiki_node_markdown_line(node, level):
+    return f"{'  ' * level}- {node.title} (token: {node.node_token or '[NODE TOKEN MISSING]'})\n"
+
+def format_wiki_tree_markdown(tree, level=0):
+    """把节点树渲染为与前端 formatNodesToMarkdown 相同的Markdown目录（非递归），level 为顶层节点的缩进层级"""
+    lines = []
+    stack = [(node, level) for node in reversed(tree or [])]
+    while stack:
+        node, node_level = stack.pop()
+        lines.append(wiki_node_markdown_line(node, node_level))
+        if node.children:
+            stack.extend((child, node_level + 1) for child in reversed(node.children))
+    return ''.join(lines)
+
+def estimate_tokens(text):
+    """粗略估计文本的token数：非ASCII字符（主要是中文）每字约1个token，ASCII字符每4个约1个
+
+    只用字符数和UTF-8编码长度计算，不逐字符遍历，整段Markdown也能快速估算。
+    """
+    length = len(text)
+    non_ascii = (len(text.encode('utf-8')) - length) // 2
+    return non_ascii + (length - non_ascii + 3) // 4
+
+def _subtree_costs(tree):
+    """后序遍历计算每个节点子树渲染后的 (估计token数, 节点数)，按 id(node) 索引"""
+    costs = {}
+    stack = [(node, 0, False) for node in reversed(tree or [])]
+    while stack:
+        node, level, expanded = stack.pop()
+        if not expanded:
+            stack.append((node, level, True))
+            stack.extend((child, level + 1, False) for child in reversed(node.children or []))
+            continue
+        tokens = estimate_tokens(wiki_node_markdown_line(node, level))
+        count = 1
+        for child in node.children or []:
+            child_tokens, child_count = costs[id(child)]
+            tokens += child_tokens
+            count += child_count
+        costs[id(node)] = (tokens, count)
+    return costs
+
+def _common_prefix(path_a, path_b):
+    size = 0
+    while size < len(path_a) and size < len(path_b) and path_a[size] is path_b[size]:
+        size += 1
+    return size
+
+def build_analysis_batches(tree, token_budget):
+    """按估计token数把节点树打包成分析批次
+
+    按顺序遍历子树，能放进预算的子树整体作为一个单元，超出预算的子树拆到下一层；
+    单元依次装入批次，装不下时开始新批次。拆开的子树在每个批次中都带上其祖先节点行，
+    保留目录层级上下文。整棵树不超过预算时只有一批；空知识库也返回一个目录为空的批次，
+    仍可分析（例如评估文档导入空知识库）。
+    """
+    if not tree:
+        return [{"index": 0, "root_titles": [], "node_count": 0, "estimated_tokens": 0, "markdown": ''}]
+    costs = _subtree_costs(tree)
+
+    # 拆分单元：(祖先路径, 节点, 层级)
+    units = []
+    stack = [((), node, 0) for node in reversed(tree or [])]
+    while stack:
+        path, node, level = stack.pop()
+        if costs[id(node)][0] <= token_budget or not node.children:
+            units.append((path, node, level))
+        else:
+            child_path = path + (node,)
+            stack.extend((child_path, child, level + 1) for child in reversed(node.children))
+
+    def path_tokens(path, start):
+        return sum(estimate_tokens(wiki_node_markdown_line(ancestor, depth)) for depth, ancestor in enumerate(path) if depth >= start)
+
+    groups = []
+    current = None
+    for path, node, level in units:
+        shared = _common_prefix(current['path'], path) if current else 0
+        cost = path_tokens(path, shared) + costs[id(node)][0]
+        if current and current['tokens'] + cost > token_budget:
+            current = None
+            cost = path_tokens(path, 0) + costs[id(node)][0]
+        if current is None:
+            current = {"units": [], "tokens": 0, "path": ()}
+            groups.append(current)
+        current['units'].append((path, node, level))
+        current['tokens'] += cost
+        current['path'] = path
+
+    batches = []
+    for index, group in enumerate(groups):
+        parts = []
+        root_titles = []
+        open_path = ()
+        for path, node, level in group['units']:
+            shared = _common_prefix(open_path, path)
+            parts.extend(wiki_node_markdown_line(path[depth], depth) for depth in range(shared, len(path)))
+            open_path = path
+            parts.append(format_wiki_tree_markdown([node], level))
+            root_title = (path[0] if path else node).title
+            if root_title not in root_titles:
+                root_titles.append(root_title)
+        batches.append({
+            "index": index,
+            "root_titles": root_titles,
+            "node_count": sum(costs[id(node)][1] for _, node, _ in group['units']),
+            "estimated_tokens": group['tokens'],
+            "markdown": ''.join(parts)
+        })
+    return batches
+
+class AnalysisJob:
+    """一次在后台运行的知识库分析任务
+
+    事件按顺序追加到事件日志中，客户端断开后可以用任务ID和已收到的事件序号重新连接，
+    从断点继续接收；任务本身不依赖任何客户端连接。
+    """
+
+    def __init__(self, scope, user_access_token, params):
+        self.job_id = uuid.uuid4().hex
+        self.scope = scope
+        # api_key 与用户令牌一样单独保存，任务结束即丢弃，不随任务保留 ANALYSIS_JOB_TTL
+        self._api_key = params.pop('api_key')
+        self.params = params
+        self.status = 'pending'
+        self.created_at = time.time()
+        self.finished_at = None
+        self.total_batches = 0
+        self.completed_batches = 0
+        self.summary = None
+        self.cancel_event = threading.Event()
+        self._user_access_token = user_access_token
+        self._events = []  # (事件序号, 事件类型, 编码后的JSON)，按序号递增
+        self._next_seq = 0
+        self._condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('completed', 'failed', 'cancelled')
+
+    def emit(self, event):
+        with self._condition:
+            self._events.append((self._next_seq, event['type'], json_dumps(event)))
+            self._next_seq += 1
+            self._condition.notify_all()
+
+    def events_since(self, seq, timeout):
+        """返回序号不小于 seq 的 (序号, 已编码JSON) 列表，没有新事件时最多等待 timeout 秒
+
+        任务结束后事件日志被压缩，序号不再连续，调用方应使用返回的序号。
+        """
+        with self._condition:
+            if self._next_seq <= seq and not self.finished:
+                self._condition.wait(timeout)
+            start = bisect_left(self._events, (seq,))
+            return [(event_seq, encoded) for event_seq, _, encoded in self._events[start:]], self.finished
+
+    def _finish(self, status):
+        with self._condition:
+            self.status = status
+            self.finished_at = time.time()
+            self._user_access_token = None
+            self._api_key = None
+            # 各批次结果已完整包含在 batch_done/done 事件中，结束后丢弃逐段输出，重连的客户端仍能重绘结果
+            self._events = [event for event in self._events if event[1] in ANALYSIS_RETAINED_EVENT_TYPES]
+            self._condition.notify_all()
+
+    def start(self):
+        threading.Thread(target=self._run, name=f"analysis-{self.job_id[:8]}", daemon=True).start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _load_tree(self):
+        """优先使用该用户的节点树快照，没有快照时发起（或加入）一次爬取"""
+        space_id = self.params['space_id']
+        snapshot = wiki_snapshot_store.get(space_id, self.scope)
+        if snapshot:
+            return snapshot['tree']
+        crawl, subscription = wiki_crawl_coordinator.attach(space_id, self._user_access_token, self.scope)
         try:
-            # 使用OpenAI SDK进行流式调用
-            client = OpenAI(
-                base_url="https://ark.cn-beijing.volces.com/api/v3",
-                api_key=api_key
-            )
-            
-            # 处理额外参数
-            extra_params = {}
-            if max_tokens is not None:
-                extra_params['max_tokens'] = max_tokens
-            
-            call_params = {
-                "model": model,
-                "messages": [{'role': 'user', 'content': prompt}],
-                "stream": True,
-                **extra_params  # 展开额外参数
-            }
-            app.logger.info(f"Calling LLM with params: {call_params}")
-            
-            stream = client.chat.completions.create(**call_params)
-            
-            for chunk in stream:
-                if not chunk.choices:
-                    continue
-                
-                # 处理 reasoning_content
-                reasoning_content = ""
-                if hasattr(chunk.choices[0].delta, 'reasoning_content'):
-                    reasoning_content = chunk.choices[0].delta.reasoning_content or ""
-                if reasoning_content:
-                    # 按照SSE格式返回推理内容，并添加前缀以区分
-                    # 使用 json.dumps 确保内容被正确转义
-                    import json
-                    yield f"data: {{\"type\": \"reasoning\", \"content\": {json.dumps(reasoning_content)}}}\n\n"
-                
-                # 处理 content
-                content = ""
-                if hasattr(chunk.choices[0].delta, 'content'):
-                    content = chunk.choices[0].delta.content or ""
-                if content:
-                    # 按照SSE格式返回内容，并添加前缀以区分
-                    # 使用 json.dumps 确保内容被正确转义
-                    import json
-                    yield f"data: {{\"type\": \"content\", \"content\": {json.dumps(content)}}}\n\n"
-            
-            # 发送结束信号
-            yield "data: [DONE]\n\n"
-        except Exception as e:
-            error_msg = f"LLM Request error: {str(e)}"
-            app.logger.error(error_msg)
-            # 使用 json.dumps 确保错误信息被正确转义
-            import json
-            yield f"data: {{\"error\": {json.dumps(str(e))}}}\n\n"
+            return crawl.wait(subscription)
         finally:
-            app.logger.info("Finished stream response for document import analysis")
+            wiki_crawl_coordinator.detach(crawl, subscription)
+
+    def _load_document(self):
+        doc_token, doc_type = self.params.get('doc_token'), self.params.get('doc_type') or 'docx'
+        if doc_type == 'wiki':
+            node = resolve_wiki_node(doc_token, self._user_access_token)
+            doc_type, doc_token = node.get('obj_type'), node.get('obj_token')
+            if doc_type not in ('doc', 'docx') or not doc_token:
+                raise DocumentFetchError(f"Unsupported document type: {doc_type}")
+        return fetch_document_content(doc_type, doc_token, self._user_access_token)
+
+    def _call_llm(self, prompt, event_prefix, **fields):
+        """流式调用模型，按 ANALYSIS_DELTA_INTERVAL 合并输出片段后发出 {event_prefix}_reasoning/_content 事件，
+        排队时发出 {event_prefix}_queued 事件；fields 附加到每个事件中。返回完整输出"""
+        call_params = {
+            "model": self.params['model'],
+            "messages": [{'role': 'user', 'content': prompt}]
+        }
+        if self.params.get('temperature') is not None:
+            call_params['temperature'] = self.params['temperature']
+        if self.params.get('max_tokens') is not None:
+            call_params['max_tokens'] = self.params['max_tokens']
+        llm_stream = LLMStream(self._api_key, call_params, label=f"analysis-{self.job_id[:8]}",
+                               cancel_event=self.cancel_event, user=self.scope, flush_interval=ANALYSIS_DELTA_INTERVAL)
+        try:
+            for kind, value in llm_stream.deltas():
+                if kind == 'queued':
+                    self.emit({"type": f"{event_prefix}_queued", **fields, "position": value})
+                else:
+                    self.emit({"type": f"{event_prefix}_{kind}", **fields, "content": value})
+        except LLMStreamCancelled:
+            raise AnalysisCancelled()
+        return llm_stream.content
+
+    def _map_batch(self, batch, extra_placeholders):
+        index = batch['index']
+        if self.cancel_event.is_set():
+            raise AnalysisCancelled()
+        self.emit({"type": "batch_start", "index": index, "root_titles": batch['root_titles'], "node_count": batch['node_count']})
+        placeholders = dict(extra_placeholders, KNOWLEDGE_BASE_STRUCTURE=batch['markdown'])
+        prompt = replace_placeholders(self.params['prompt_template'], placeholders)
+        return self._call_llm(prompt, 'batch', index=index)
+
+    def _run(self):
+        self.status = 'running'
+        params = self.params
+        app.logger.info(f"Analysis job {self.job_id} started for space_id: {params['space_id']}")
+        try:
+            self.emit({"type": "status", "status": "loading_tree"})
+            tree = self._load_tree()
+            placeholders = dict(params.get('placeholders') or {})
+            placeholders.setdefault('WIKI_TITLE', params.get('wiki_title') or '')
+            if params.get('doc_token'):
+                self.emit({"type": "status", "status": "loading_document"})
+                placeholders['IMPORTED_DOCUMENT_CONTENT'] = self._load_document()
+
+            # 模板本身和文档内容也占用上下文，目录部分只能使用剩余的预算
+            overhead = estimate_tokens(replace_placeholders(params['prompt_template'], dict(placeholders, KNOWLEDGE_BASE_STRUCTURE='')))
+            structure_budget = max(ANALYSIS_BATCH_TOKEN_BUDGET - overhead, ANALYSIS_BATCH_MIN_STRUCTURE_TOKENS)
+            batches = build_analysis_batches(tree, structure_budget)
+            self.total_batches = len(batches)
+            app.logger.info(f"Analysis job {self.job_id} split into {len(batches)} batches, structure budget: {structure_budget} tokens")
+            self.emit({
+                "type": "batches",
+                "total": len(batches),
+                "batches": [{key: b[key] for key in ('index', 'root_titles', 'node_count', 'estimated_tokens')} for b in batches]
+            })
+
+            # map：各批次并发分析，单批失败不影响其他批次
+            results = {}
+            executor = ThreadPoolExecutor(max_workers=max(1, min(ANALYSIS_MAP_CONCURRENCY, len(batches))))
+            try:
+                futures = {executor.submit(self._map_batch, batch, placeholders): batch for batch in batches}
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    try:
+                        results[batch['index']] = future.result()
+                        self.completed_batches += 1
+                        self.emit({"type": "batch_done", "index": batch['index'], "result": results[batch['index']], "completed": self.completed_batches, "total": len(batches)})
+                    except AnalysisCancelled:
+                        raise
+                    except Exception as e:
+                        app.logger.error(f"Analysis job {self.job_id} batch {batch['index']} failed: {str(e)}")
+                        self.emit({"type": "batch_error", "index": batch['index'], "error": str(e)})
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+            if self.cancel_event.is_set():
+                raise AnalysisCancelled()
+            if not results:
+                raise RuntimeError("All analysis batches failed")
+
+            # reduce：只有一批时其结果即最终结果，否则对各批结果做汇总
+            if len(batches) == 1:
+                self.summary = results[0]
+            else:
+                self.emit({"type": "status", "status": "summarizing"})
+                sections = []
+                for batch in batches:
+                    if batch['index'] in results:
+                        sections.append(f"### 第{batch['index'] + 1}批分析结果（根节点：{'、'.join(batch['root_titles'])}）\n\n{results[batch['index']]}")
+                summary_template = params.get('summary_prompt_template') or ANALYSIS_SUMMARY_PROMPT
+                summary_prompt = replace_placeholders(summary_template, {"BATCH_RESULTS": '\n\n'.join(sections), "WIKI_TITLE": placeholders['WIKI_TITLE']})
+                self.summary = self._call_llm(summary_prompt, 'summary')
+            self.emit({"type": "done", "summary": self.summary, "completed": self.completed_batches, "total": len(batches)})
+            self._finish('completed')
+            app.logger.info(f"Analysis job {self.job_id} completed, batches: {self.completed_batches}/{len(batches)}")
+        except AnalysisCancelled:
+            app.logger.info(f"Analysis job {self.job_id} cancelled")
+            self.emit({"type": "cancelled"})
+            self._finish('cancelled')
+        except Exception as e:
+            app.logger.error(f"Analysis job {self.job_id} failed: {str(e)}")
+            self.emit({"type": "error", "error": str(e)})
+            self._finish('failed')
+
+    def describe(self):
+        return {
+            "job_id": self.job_id,
+            "space_id": self.params['space_id'],
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total_batches": self.total_batches,
+            "completed_batches": self.completed_batches,
+            "summary": self.summary
+        }
+
+class AnalysisJobManager:
+    """分析任务注册表；结束的任务保留 ANALYSIS_JOB_TTL 秒（最多 ANALYSIS_MAX_FINISHED_JOBS 个）供客户端重新连接"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        """删除超过 ANALYSIS_JOB_TTL 的已结束任务；已结束任务仍超过 ANALYSIS_MAX_FINISHED_JOBS 时淘汰最早结束的"""
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and now - job.finished_at > ANALYSIS_JOB_TTL]:
+            del self._jobs[job_id]
+        finished = sorted((job for job in self._jobs.values() if job.finished), key=lambda job: job.finished_at)
+        for job in finished[:max(0, len(finished) - ANALYSIS_MAX_FINISHED_JOBS)]:
+            del self._jobs[job.job_id]
+
+    def create(self, scope, user_access_token, params):
+        """创建并启动任务；该用户运行中的任务已达 ANALYSIS_MAX_JOBS_PER_USER 时抛出 AnalysisJobLimitError"""
+        job = AnalysisJob(scope, user_access_token, params)
+        with self._lock:
+            self._prune(time.time())
+            running = sum(1 for existing in self._jobs.values() if existing.scope == scope and not existing.finished)
+            if running >= ANALYSIS_MAX_JOBS_PER_USER:
+                raise AnalysisJobLimitError(f"Too many running analysis jobs, at most {ANALYSIS_MAX_JOBS_PER_USER} per user")
+            self._jobs[job.job_id] = job
+        job.start()
+        return job
+
+    def get(self, job_id, scope):
+        """返回属于该用户的任务，其他用户的任务视为不存在"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or job.scope != scope:
+            return None
+        return job
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            "jobs": len(jobs),
+            "running": sum(1 for job in jobs if not job.finished),
+            "by_status": {status: sum(1 for job in jobs if job.status == status) for status in {job.status for job in jobs}}
+        }
+
+analysis_job_manager = AnalysisJobManager()
+
+def get_request_user_token():
+    """从 Authorization 头或 token 查询参数（EventSource 无法设置请求头）中取出用户令牌"""
+    auth_header = request.headers.get('Authorization')
+    if auth_header and auth_header.startswith('Bearer '):
+        return auth_header.split(' ')[1]
+    return request.args.get('token')
+
+@app.route('/api/llm/analysis_jobs', methods=['POST'])
+def create_analysis_job():
+    """创建知识库分析任务
+
+    请求体: space_id、api_key、prompt_template（必填），model、max_tokens、temperature、wiki_title、placeholders、
+    summary_prompt_template，以及文档导入评估时的 doc_token、doc_type。
+    """
+    user_access_token = get_request_user_token()
+    if not user_access_token:
+        return jsonify({"error": "Unauthorized"}), 401
+    data = request.get_json(silent=True) or {}
+    if not data.get('space_id') or not data.get('api_key') or not data.get('prompt_template'):
+        return jsonify({"error": "Missing space_id, api_key or prompt_template"}), 400
+    if not isinstance(data.get('placeholders') or {}, dict):
+        return jsonify({"error": "placeholders must be an object"}), 400
+    try:
+        temperature = parse_llm_temperature(data.get('temperature'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    params = {
+        "space_id": data['space_id'],
+        "api_key": data['api_key'],
+        "model": data.get('model', 'doubao-seed-1-6-250615'),
+        "max_tokens": data.get('max_tokens'),
+        "temperature": temperature,
+        "prompt_template": data['prompt_template'],
+        "summary_prompt_template": data.get('summary_prompt_template'),
+        "wiki_title": data.get('wiki_title'),
+        "placeholders": data.get('placeholders') or {},
+        "doc_token": data.get('doc_token'),
+        "doc_type": data.get('doc_type')
+    }
+    try:
+        job = analysis_job_manager.create(resolve_user_scope(user_access_token), user_access_token, params)
+    except AnalysisJobLimitError as e:
+        app.logger.warning(f"Rejected analysis job for space_id {params['space_id']}: {str(e)}")
+        return jsonify({"error": str(e)}), 429
+    app.logger.info(f"Created analysis job {job.job_id} for space_id: {params['space_id']}")
+    return jsonify({"job_id": job.job_id, "status": job.status}), 202
+
+@app.route('/api/llm/analysis_jobs/<job_id>', methods=['GET', 'DELETE'])
+def analysis_job_detail(job_id):
+    """GET 查询任务状态和最终结果，DELETE 取消任务"""
+    user_access_token = get_request_user_token()
+    if not user_access_token:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = analysis_job_manager.get(job_id, resolve_user_scope(user_access_token))
+    if job is None:
+        return jsonify({"error": "Analysis job not found"}), 404
+    if request.method == 'DELETE':
+        job.cancel()
+        app.logger.info(f"Analysis job {job_id} cancellation requested")
+    return jsonify(job.describe())
+
+@app.route('/api/llm/analysis_jobs/<job_id>/events', methods=['GET'])
+def analysis_job_events(job_id):
+    """以SSE推送任务事件
+
+    每个事件带 id（事件序号），断线后 EventSource 会带上 Last-Event-ID 自动从断点继续；
+    也可以用 since 参数指定从第几个事件开始。
+    """
+    user_access_token = get_request_user_token()
+    if not user_access_token:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = analysis_job_manager.get(job_id, resolve_user_scope(user_access_token))
+    if job is None:
+        return jsonify({"error": "Analysis job not found"}), 404
+    try:
+        last_event_id = request.headers.get('Last-Event-ID')
+        seq = int(last_event_id) + 1 if last_event_id is not None else int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid event id"}), 400
+
+    def generate():
+        nonlocal seq
+        last_sent_at = time.time()
+        while True:
+            events, finished = job.events_since(seq, timeout=1)
+            for event_seq, event in events:
+                yield f"id: {event_seq}\ndata: {event}\n\n"
+                seq = event_seq + 1
+            if events:
+                last_sent_at = time.time()
+            elif finished:
+                return
+            elif time.time() - last_sent_at >= SSE_KEEPALIVE_SECONDS:
+                last_sent_at = time.time()
+                yield ": keepalive\n\n"
 
-    app.logger.info("Starting stream response for document import analysis")
     return Response(generate(), content_type='text/event-stream')
 
 @app.route('/api/wiki/search', methods=['GET', 'POST'])
@@ -2640,7 +5830,7 @@ def search_wiki():
                     "has_more": current_has_more,
                     "page_token": current_page_token
                 }
-                yield f"data: {json.dumps(initial_response)}\n\n"
+                yield f"data: {json_dumps(initial_response)}\n\n"
                 
                 # 持续加载分页结果
                 while True:
@@ -2700,7 +5890,7 @@ def search_wiki():
                                     "item": space_detail,
                                     "fetched_count": total_fetched_count
                                 }
-                                yield f"data: {json.dumps(detail_response)}\n\n"
+                                yield f"data: {json_dumps(detail_response)}\n\n"
                                 
                                 app.logger.info(f"Successfully fetched details for space {space_id}")
                             else:
@@ -2757,7 +5947,7 @@ def search_wiki():
                     "type": "complete",
                     "fetched_count": total_fetched_count
                 }
-                yield f"data: {json.dumps(final_response)}\n\n"
+                yield f"data: {json_dumps(final_response)}\n\n"
                 yield "data: [DONE]\n\n"
             
             return Response(generate(), content_type='text/event-stream')
@@ -0,0 +1,50 @@
+"""知识库分析分批基准测试
+
+在合成的知识空间节点树上对比两种分批方式：
+- per-root: 旧实现，每个根节点及其子树作为一批（前端按根节点数分批）
+- token-aware: build_analysis_batches，按估计token数打包子树，超大子树拆到下一层
+
+统计批次数（即LLM调用次数）、每批估计token数的分布，以及超出预算的批次数。
+
+用法（在 backend 目录下）:
+    python benchmarks/bench_analysis_batches.py [节点数] [token预算]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import build_analysis_batches, estimate_tokens, format_wiki_tree_markdown  # noqa: E402
+from bench_node_memory import build_compact_tree, build_pages  # noqa: E402
+
+
+def per_root_batches(tree):
+    return [format_wiki_tree_markdown([node]) for node in tree]
+
+
+def describe(name, token_counts, budget, elapsed):
+    over = sum(1 for tokens in token_counts if tokens > budget)
+    print(f"{name:<12}{len(token_counts):>9}{min(token_counts):>10}{max(token_counts):>10}"
+          f"{sum(token_counts) // len(token_counts):>10}{over:>13}{elapsed * 1000:>12.1f}")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+    budget = int(sys.argv[2]) if len(sys.argv) > 2 else 24000
+    tree = build_compact_tree(build_pages(total))
+    print(f"nodes: {total}, roots: {len(tree)}, whole tree: {estimate_tokens(format_wiki_tree_markdown(tree))} tokens, budget: {budget}")
+    print(f"{'mode':<12}{'batches':>9}{'min':>10}{'max':>10}{'mean':>10}{'over budget':>13}{'build(ms)':>12}")
+
+    start = time.perf_counter()
+    markdowns = per_root_batches(tree)
+    describe('per-root', [estimate_tokens(markdown) for markdown in markdowns], budget, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    batches = build_analysis_batches(tree, budget)
+    describe('token-aware', [estimate_tokens(batch['markdown']) for batch in batches], budget, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
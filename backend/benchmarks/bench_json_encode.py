@@ -0,0 +1,76 @@
+"""JSON编码基准测试
+
+在合成的3万节点知识空间上对比整棵节点树的几种编码方式：
+- stdlib-dict: 旧实现，节点保存为dict，用 json.dumps 编码
+- dump_wiki_tree: WikiNode 树按字段直接拼接JSON文本
+- stdlib-default: 标准库 json.dumps，通过 default 回调展开 WikiNode
+- orjson: encode_wiki_tree 的加速路径（需要安装 orjson）
+
+统计编码耗时（取多次中的最小值）、编码过程的峰值内存和输出大小。
+
+用法（在 backend 目录下）:
+    python benchmarks/bench_json_encode.py
+"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import _json_default, dump_wiki_tree  # noqa: E402
+from bench_node_memory import build_compact_tree, build_dict_tree, build_pages  # noqa: E402
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NODE_COUNT = 30000
+REPEAT = 5
+
+
+def measure(encode, tree):
+    gc.collect()
+    tracemalloc.start()
+    payload = encode(tree)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del payload
+
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        payload = encode(tree)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak, len(payload)
+
+
+def main():
+    pages = build_pages(NODE_COUNT)
+    dict_tree = build_dict_tree(pages)
+    compact_tree = build_compact_tree(pages)
+
+    cases = [
+        ('stdlib-dict', dict_tree, json.dumps),
+        ('dump_wiki_tree', compact_tree, dump_wiki_tree),
+        ('stdlib-default', compact_tree, lambda tree: json.dumps(tree, separators=(',', ':'), default=_json_default)),
+    ]
+    if orjson is not None:
+        cases.append(('orjson', compact_tree, lambda tree: orjson.dumps(tree, default=_json_default)))
+    else:
+        print('orjson not installed, skipping the accelerated encoder')
+
+    mb = 1024 * 1024
+    print(f"{'encoder':<16}{'encode(ms)':>12}{'peak(MB)':>10}{'payload(MB)':>13}")
+    for name, tree, encode in cases:
+        elapsed, peak, size = measure(encode, tree)
+        print(f"{name:<16}{elapsed * 1000:>12.1f}{peak / mb:>10.1f}{size / mb:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""LLM流式输出基准测试
+
+用合成的模型输出（每个片段一个token，先推理内容后正文）对比两种SSE输出方式：
+- per-token: 旧实现，每个片段 import json + json.dumps 后单独产出一帧
+- coalesced: stream_llm_sse，相邻片段按时间窗口/字符数合并，帧前缀预先编码
+
+统计产出的帧数（即写socket的次数）、总字节数和每个片段的平均处理耗时。
+片段间隔模拟模型的输出速度，合并效果取决于 LLM_STREAM_FLUSH_INTERVAL / LLM_STREAM_FLUSH_CHARS。
+
+用法（在 backend 目录下）:
+    python benchmarks/bench_llm_stream.py [片段数] [片段间隔毫秒]
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+class FakeStream:
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.response = SimpleNamespace(close=lambda: None)
+
+    def __iter__(self):
+        reasoning = self.total // 4
+        for i in range(self.total):
+            if self.interval:
+                time.sleep(self.interval)
+            text = f'词{i % 10}'
+            delta = SimpleNamespace(reasoning_content=text if i < reasoning else None, content=None if i < reasoning else text)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class FakeClient:
+    def __init__(self, total, interval):
+        self.chat = self.completions = self
+        self.total = total
+        self.interval = interval
+
+    def create(self, **kwargs):
+        return FakeStream(self.total, self.interval)
+
+
+def per_token_frames(stream):
+    """旧的 generate() 循环"""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        reasoning_content = ""
+        if hasattr(chunk.choices[0].delta, 'reasoning_content'):
+            reasoning_content = chunk.choices[0].delta.reasoning_content or ""
+        if reasoning_content:
+            import json
+            yield f"data: {{\"type\": \"reasoning\", \"content\": {json.dumps(reasoning_content)}}}\n\n"
+        content = ""
+        if hasattr(chunk.choices[0].delta, 'content'):
+            content = chunk.choices[0].delta.content or ""
+        if content:
+            import json
+            yield f"data: {{\"type\": \"content\", \"content\": {json.dumps(content)}}}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def run(name, frames, total):
+    start = time.perf_counter()
+    count = size = 0
+    for frame in frames:
+        count += 1
+        size += len(frame.encode('utf-8') if isinstance(frame, str) else frame)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12}{count:>9}{size / 1024:>12.1f}{elapsed * 1e6 / total:>16.2f}")
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    interval = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    client = FakeClient(total, interval)
+    app.llm_client_pool.get = lambda base_url, api_key: client
+    app.app.logger.disabled = True
+
+    print(f"chunks: {total}, interval: {interval * 1000:.1f}ms")
+    print(f"{'mode':<12}{'frames':>9}{'bytes(KB)':>12}{'us per chunk':>16}")
+    run('per-token', per_token_frames(client.create()), total)
+    run('coalesced', app.stream_llm_sse('key', {'model': 'bench', 'messages': []}), total)
+
+
+if __name__ == '__main__':
+    main()
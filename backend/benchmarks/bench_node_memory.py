@@ -0,0 +1,135 @@
+"""节点树内存占用基准测试
+
+在合成的5万节点知识空间上对比两种节点表示：
+- dict: 旧实现，直接保留飞书返回的节点dict，用 json.dumps 序列化
+- compact: WikiNode（__slots__ + 字符串驻留），用 dump_wiki_tree 直接序列化
+
+每页数据先编码成JSON再逐页解析，与真实爬取一样每个节点的字符串都是独立对象。
+统计爬取完成后常驻的内存，以及序列化整棵树时的峰值内存。
+
+用法（在 backend 目录下）:
+    python benchmarks/bench_node_memory.py
+"""
+import gc
+import json
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import WikiNode, dump_wiki_tree  # noqa: E402
+
+PAGE_SIZE = 50
+SPACE_ID = '7034502641455497244'
+
+
+def random_token(rnd, prefix=''):
+    return prefix + ''.join(rnd.choice(string.ascii_letters + string.digits) for _ in range(27 - len(prefix)))
+
+
+def build_pages(total=50000, seed=7):
+    """生成按父节点分页的飞书接口返回（JSON文本），父节点在子节点之前"""
+    rnd = random.Random(seed)
+    users = [random_token(rnd, 'ou_') for _ in range(50)]
+    children = {'': []}
+    tokens = []
+    for i in range(total):
+        token = random_token(rnd)
+        # 前100个节点挂在根下，其余随机挂到已有节点下，形成宽而浅的树
+        parent = '' if i < 100 else rnd.choice(tokens)
+        children.setdefault(parent, []).append(token)
+        tokens.append(token)
+
+    pages = []
+    order = ['']
+    for parent in order:
+        kids = children.get(parent, [])
+        for start in range(0, len(kids), PAGE_SIZE):
+            items = []
+            for token in kids[start:start + PAGE_SIZE]:
+                creator = rnd.choice(users)
+                items.append({
+                    'space_id': SPACE_ID,
+                    'node_token': token,
+                    'obj_token': random_token(rnd),
+                    'obj_type': rnd.choice(['docx', 'docx', 'docx', 'sheet', 'bitable']),
+                    'parent_node_token': parent,
+                    'node_type': 'origin',
+                    'origin_node_token': token,
+                    'origin_space_id': SPACE_ID,
+                    'has_child': token in children,
+                    'title': f'文档标题 {rnd.randint(1, 10 ** 6)}',
+                    'obj_create_time': str(1640000000 + rnd.randint(0, 10 ** 7)),
+                    'obj_edit_time': str(1650000000 + rnd.randint(0, 10 ** 7)),
+                    'node_create_time': str(1640000000 + rnd.randint(0, 10 ** 7)),
+                    'creator': creator,
+                    'owner': creator,
+                    'node_creator': creator,
+                })
+                if token in children:
+                    order.append(token)
+            pages.append((parent, json.dumps({'items': items})))
+    return pages
+
+
+def build_dict_tree(pages):
+    roots, index = [], {}
+    for parent, text in pages:
+        items = json.loads(text)['items']
+        target = roots if not parent else index[parent].setdefault('children', [])
+        for item in items:
+            index[item['node_token']] = item
+        target.extend(items)
+    return roots
+
+
+def build_compact_tree(pages):
+    roots, index = [], {}
+    for parent, text in pages:
+        nodes = [WikiNode.from_item(item) for item in json.loads(text)['items']]
+        if parent:
+            node = index[parent]
+            if node.children is None:
+                node.children = []
+            target = node.children
+        else:
+            target = roots
+        for node in nodes:
+            index[node.node_token] = node
+        target.extend(nodes)
+    return roots
+
+
+def measure(build, serialize, pages):
+    gc.collect()
+    tracemalloc.start()
+    tree = build(pages)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    payload = serialize(tree)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return retained, peak, elapsed, len(payload)
+
+
+def main():
+    pages = build_pages()
+    mb = 1024 * 1024
+    print(f"{'mode':<10}{'retained(MB)':>14}{'serialize peak(MB)':>20}{'serialize(s)':>14}{'payload(MB)':>13}")
+    for name, build, serialize in (
+        ('dict', build_dict_tree, json.dumps),
+        ('compact', build_compact_tree, dump_wiki_tree),
+    ):
+        retained, peak, elapsed, size = measure(build, serialize, pages)
+        print(f"{name:<10}{retained / mb:>14.1f}{peak / mb:>20.1f}{elapsed:>14.3f}{size / mb:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""提示词占位符替换基准测试
+
+用约5MB的知识库目录（KNOWLEDGE_BASE_STRUCTURE）和1MB的导入文档内容渲染文档导入评估提示词，对比：
+- legacy: 旧的 replace_placeholders，每个占位符对整段提示词 str.replace 一次，
+  之后对结果 re.findall 检查未替换的占位符，并格式化整个占位符字典用于debug日志
+- compiled: 编译并缓存模板后一次拼接（replace_placeholders 的当前实现）
+
+统计每次渲染的耗时（取多次中的最小值）和渲染过程的峰值内存（旧实现中整段提示词的副本都会计入）。
+
+用法（在 backend 目录下）:
+    python benchmarks/bench_prompt_template.py [目录MB]
+"""
+import gc
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+REPEAT = 5
+
+TEMPLATE = """你是一位专业的知识管理专家。
+
+**知识库标题**：
+{WIKI_TITLE}
+
+**导入文档内容**：
+{IMPORTED_DOCUMENT_CONTENT}
+
+**当前知识库结构**：
+{KNOWLEDGE_BASE_STRUCTURE}
+
+请综合以上材料，评估文档与知识库 {WIKI_TITLE} 的匹配度，推荐归属节点并给出导入决策。"""
+
+
+def legacy_replace_placeholders(prompt_template, placeholders):
+    """旧实现（去掉了日志输出本身，保留日志参数的格式化开销）"""
+    debug_message = f"Placeholders to replace: {placeholders}"  # noqa: F841
+    result = prompt_template
+    for placeholder, value in placeholders.items():
+        placeholder_pattern = f'{{{placeholder}}}'
+        if placeholder_pattern in result:
+            replacement_value = str(value) if value is not None else ''
+            result = result.replace(placeholder_pattern, replacement_value)
+    re.findall(r'\{([^}]+)\}', result)
+    return result
+
+
+def build_placeholders(structure_mb):
+    line = "  - 产品文档 / 使用指南 / 常见问题 (token: wikcnAbCdEfGhIjKlMnOpQrStUv)\n"
+    structure = line * (structure_mb * 1024 * 1024 // len(line.encode('utf-8')))
+    document = "这是一段导入文档的正文内容，包含 {示例} 花括号。\n" * (1024 * 1024 // 60)
+    return {
+        'WIKI_TITLE': '产品知识库',
+        'IMPORTED_DOCUMENT_CONTENT': document,
+        'KNOWLEDGE_BASE_STRUCTURE': structure,
+    }
+
+
+def measure(render, placeholders):
+    gc.collect()
+    tracemalloc.start()
+    result = render(TEMPLATE, placeholders)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        render(TEMPLATE, placeholders)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak
+
+
+def main():
+    structure_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    placeholders = build_placeholders(structure_mb)
+    app.app.logger.disabled = True
+    prompt_size = len(app.replace_placeholders(TEMPLATE, placeholders).encode('utf-8'))
+
+    mb = 1024 * 1024
+    print(f"prompt: {prompt_size / mb:.1f}MB")
+    print(f"{'mode':<10}{'render(ms)':>12}{'peak(MB)':>10}")
+    for name, render in (('legacy', legacy_replace_placeholders), ('compiled', app.replace_placeholders)):
+        elapsed, peak = measure(render, placeholders)
+        print(f"{name:<10}{elapsed * 1000:>12.1f}{peak / mb:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
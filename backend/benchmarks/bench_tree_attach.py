@@ -0,0 +1,122 @@
+"""节点树挂载性能基准测试
+
+在合成的5万节点知识空间上对比两种子节点挂载方式：
+- legacy: 旧实现，在父节点所在层级中线性查找父节点（每页O(层级宽度)）
+- indexed: WikiTreeCrawler 使用 node_token 索引，O(1) 挂载
+
+两种方式都通过同一个爬取引擎运行，飞书请求由内存中的分页数据替代。
+
+用法（在 backend 目录下）:
+    python benchmarks/bench_tree_attach.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import WikiNode, WikiTreeCrawler  # noqa: E402
+
+PAGE_SIZE = 50
+
+
+def build_children(shape, total=50000):
+    """生成 parent_token -> [child_token] 的合成树"""
+    children = {None: []}
+    if shape == 'wide':
+        # 1个根节点下挂5000个节点，每个节点再挂9个叶子
+        children[None] = ['r0']
+        children['r0'] = [f'w{i}' for i in range(5000)]
+        count = 5001
+        for i in range(5000):
+            leaves = [f'w{i}_{j}' for j in range(9)]
+            children[f'w{i}'] = leaves
+            count += len(leaves)
+    else:
+        # 10 x 100 x 50 的均衡树
+        count = 0
+        for i in range(10):
+            token = f'b{i}'
+            children[None].append(token)
+            children[token] = [f'{token}_{j}' for j in range(100)]
+            count += 1
+            for j in range(100):
+                child = f'{token}_{j}'
+                children[child] = [f'{child}_{k}' for k in range(49)]
+                count += 50
+    return children, count
+
+
+class SyntheticCrawler(WikiTreeCrawler):
+    """用内存数据代替飞书接口的爬虫"""
+
+    def __init__(self, children, **kwargs):
+        super().__init__('bench_space', 'bench_token', max_workers=1, **kwargs)
+        self.children = children
+
+    def _fetch_page(self, parent_node_token, page_token):
+        kids = self.children.get(parent_node_token, [])
+        start = int(page_token or 0)
+        chunk = kids[start:start + PAGE_SIZE]
+        has_more = start + PAGE_SIZE < len(kids)
+        return {
+            'items': [{'node_token': k, 'title': k, 'has_child': k in self.children} for k in chunk],
+            'has_more': has_more,
+            'page_token': str(start + PAGE_SIZE) if has_more else ''
+        }
+
+
+class LegacyScanCrawler(SyntheticCrawler):
+    """复现旧实现的挂载方式：在父节点所在层级中逐个比较 node_token"""
+
+    def __init__(self, children, **kwargs):
+        super().__init__(children, **kwargs)
+        self.level_of = {}
+
+    def _handle_page(self, task, data, root_nodes):
+        parent_node_token, _ = task
+        items = [WikiNode.from_item(item) for item in data.get('items', []) if item.get('node_token')]
+        if parent_node_token == self.root_node_token:
+            target = root_nodes
+        else:
+            target = None
+            for n in self.level_of[parent_node_token]:
+                if n.node_token == parent_node_token:
+                    if n.children is None:
+                        n.children = []
+                    target = n.children
+                    break
+        for item in items:
+            self.level_of[item.node_token] = target
+        target.extend(items)
+        self.node_count += len(items)
+        if data.get('has_more'):
+            self._frontier.append((parent_node_token, data.get('page_token')))
+        self._frontier.extend((item.node_token, None) for item in items if item.has_child)
+
+
+def run(crawler_cls, children, repeat=3):
+    best = None
+    nodes = 0
+    for _ in range(repeat):
+        crawler = crawler_cls(children)
+        start = time.perf_counter()
+        crawler.run()
+        elapsed = time.perf_counter() - start
+        nodes = crawler.node_count
+        best = elapsed if best is None else min(best, elapsed)
+    return best, nodes
+
+
+def main():
+    print(f"{'shape':<10}{'nodes':>8}{'legacy(s)':>12}{'indexed(s)':>12}{'speedup':>10}")
+    for shape in ('wide', 'balanced'):
+        children, _ = build_children(shape)
+        legacy_time, nodes = run(LegacyScanCrawler, children)
+        indexed_time, indexed_nodes = run(SyntheticCrawler, children)
+        assert nodes == indexed_nodes
+        print(f"{shape:<10}{nodes:>8}{legacy_time:>12.3f}{indexed_time:>12.3f}{legacy_time / indexed_time:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
-import { Form, Input, Button, Card, Typography, message, Space, Divider } from 'antd';
+import { Form, Input, Button, Card, Typography, message, Space, Divider, Select } from 'antd';
 import { ArrowLeftOutlined } from '@ant-design/icons';
 import './Config.css';
 
@@ -124,6 +124,10 @@ function Config() {
     const savedApiKey = userConfiguredApiKey || '';
     const savedModel = localStorage.getItem('llm_model') || 'doubao-seed-1-6-thinking-250615';
     const savedMaxTokens = localStorage.getItem('llm_max_tokens') || '4096';
+    const savedTemperature = localStorage.getItem('llm_temperature') || '';
+    // 旧版本保存的是 'true'（始终复用）或 'false'
+    const storedResponseCache = localStorage.getItem('llm_response_cache');
+    const savedResponseCache = storedResponseCache === 'true' ? 'force' : (['deterministic', 'force'].includes(storedResponseCache) ? storedResponseCache : 'off');
     const savedPrompts = {
       wikiAnalysis: localStorage.getItem('prompt_wiki_analysis') || DEFAULT_PROMPTS.wikiAnalysis,
       docAnalysis: localStorage.getItem('prompt_doc_analysis') || DEFAULT_PROMPTS.docAnalysis,
@@ -137,6 +141,8 @@ function Config() {
       apiKey: savedApiKey,
       model: savedModel,
       maxTokens: savedMaxTokens,
+      temperature: savedTemperature,
+      responseCache: savedResponseCache,
       ...savedPrompts
     });
   }, [form]);
@@ -152,6 +158,12 @@ function Config() {
       }
       localStorage.setItem('llm_model', values.model);
       localStorage.setItem('llm_max_tokens', values.maxTokens || '4096');
+      if (values.temperature !== undefined && values.temperature !== null && String(values.temperature).trim() !== '') {
+        localStorage.setItem('llm_temperature', String(values.temperature).trim());
+      } else {
+        localStorage.removeItem('llm_temperature');
+      }
+      localStorage.setItem('llm_response_cache', values.responseCache || 'off');
       localStorage.setItem('prompt_wiki_analysis', values.wikiAnalysis);
       localStorage.setItem('prompt_doc_analysis', values.docAnalysis);
       localStorage.setItem('prompt_doc_import_analysis', values.docImportAnalysis);
@@ -169,6 +181,8 @@ function Config() {
       apiKey: '',
       model: 'doubao-seed-1-6-thinking-250615',
       maxTokens: '4096',
+      temperature: '',
+      responseCache: 'off',
       wikiAnalysis: DEFAULT_PROMPTS.wikiAnalysis,
       docAnalysis: DEFAULT_PROMPTS.docAnalysis,
       docImportAnalysis: DEFAULT_PROMPTS.docImportAnalysis
@@ -220,6 +234,39 @@ function Config() {
               />
             </Form.Item>
             
+            <Form.Item
+              label="温度 (temperature)"
+              name="temperature"
+              rules={[{
+                validator: (_, value) => (value === undefined || value === null || String(value).trim() === '' || (Number(value) >= 0 && Number(value) <= 2))
+                  ? Promise.resolve()
+                  : Promise.reject(new Error('温度需在 0 到 2 之间'))
+              }]}
+              extra="留空时使用模型默认温度；设为 0 时输出基本确定，可配合下方的复用选项"
+            >
+              <Input 
+                type="number" 
+                placeholder="例如: 0" 
+                min="0" 
+                max="2"
+                step="0.1"
+              />
+            </Form.Item>
+            
+            <Form.Item
+              label="复用相同输入的分析结果"
+              name="responseCache"
+              extra="提示词、文档内容和模型参数完全相同的分析直接返回上次的结果，不再调用大模型"
+            >
+              <Select
+                options={[
+                  { value: 'off', label: '关闭' },
+                  { value: 'deterministic', label: '仅温度为 0 时复用' },
+                  { value: 'force', label: '始终复用' }
+                ]}
+              />
+            </Form.Item>
+            
             <Divider>AI 分析提示词配置</Divider>
             
             <Text type="secondary" style={{ display: 'block', marginBottom: '10px' }}>
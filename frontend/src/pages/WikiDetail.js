@@ -8,10 +8,31 @@ import { flushSync } from 'react-dom';
 import AiAnalysisModal from '../components/AiAnalysisModal';
 import DocAnalysisModal from '../components/DocAnalysisModal';
 import DocImportAnalysisModal from '../components/DocImportAnalysisModal';
+import { applyWikiTreeDiff, buildWikiTree } from '../utils/wikiTree';
 import './WikiDetail.css';
 
 const { Title } = Typography;
 
+// 单次请求的提示词token预算，应与后端 ANALYSIS_BATCH_TOKEN_BUDGET 一致；超过时改用后端分析任务分批处理
+const ANALYSIS_TOKEN_BUDGET = parseInt(process.env.REACT_APP_ANALYSIS_TOKEN_BUDGET || '24000', 10);
+
+// 配置页中的温度（留空时使用模型默认温度）与结果复用方式，附加到分析请求中
+const getLlmSamplingOptions = () => {
+  const temperature = localStorage.getItem('llm_temperature');
+  const responseCache = localStorage.getItem('llm_response_cache');
+  return {
+    ...(temperature ? { temperature: parseFloat(temperature) } : {}),
+    // 'deterministic' 只复用温度为 0 的结果；'force'（旧版本保存为 'true'）始终复用
+    cache: responseCache === 'deterministic' ? true : (responseCache === 'force' || responseCache === 'true') ? 'force' : false
+  };
+};
+
+// 与后端 estimate_tokens 相同的粗略估计：非ASCII字符（主要是中文）每字约1个token，ASCII字符每4个约1个
+const estimateTokens = (text) => {
+  const nonAscii = (text.match(/[^\x00-\x7f]/g) || []).length;
+  return nonAscii + Math.ceil((text.length - nonAscii) / 4);
+};
+
 const WikiDetail = () => {
   const { spaceId } = useParams();
   const navigate = useNavigate();
@@ -527,8 +548,17 @@ const WikiDetail = () => {
       const allNodes = await new Promise((resolve, reject) => {
         let isConnectionClosed = false;
         let receivedData = null;
+        let hasSnapshot = false;
+        // 扁平模式下后端逐批推送节点记录，全部收到后在本地组装节点树
+        const streamedNodes = [];
+        // 快照同样分批推送，snapshot 事件表示快照已全部收到
+        const snapshotNodes = [];
+        
+        // 上次完整爬取未完成时带上其crawl_id，服务端从检查点继续，不必从头爬取
+        const crawlIdKey = `wiki_crawl_id_${spaceId}`;
+        const pendingCrawlId = forceRefresh ? null : localStorage.getItem(crawlIdKey);
         
-        const eventSource = new EventSource(`${process.env.REACT_APP_BACKEND_URL}/api/wiki/${spaceId}/nodes/all/stream?token=${encodeURIComponent(userAccessToken)}`);
+        const eventSource = new EventSource(`${process.env.REACT_APP_BACKEND_URL}/api/wiki/${spaceId}/nodes/all/stream?token=${encodeURIComponent(userAccessToken)}&mode=flat${forceRefresh ? '&refresh=full' : ''}${pendingCrawlId ? `&crawl_id=${encodeURIComponent(pendingCrawlId)}` : ''}`);
         
         const handleMessage = async (event) => {
           try {
@@ -538,8 +568,30 @@ const WikiDetail = () => {
             
             const data = JSON.parse(event.data);
             
-            if (data.type === 'progress') {
-              cumulativeCount += data.count;
+            if (data.type === 'snapshot_nodes') {
+              snapshotNodes.push(...data.nodes);
+              return;
+            }
+            
+            if (data.type === 'crawl') {
+              // 只记录完整爬取的ID；已有快照时的后台增量刷新很快，不需要断点续爬
+              if (!hasSnapshot) {
+                localStorage.setItem(crawlIdKey, data.crawl_id);
+              }
+              return;
+            }
+            
+            if (data.type === 'progress' || data.type === 'nodes') {
+              // 快照的后台刷新只推送差异，不再累计进度
+              if (hasSnapshot) {
+                return;
+              }
+              if (data.type === 'nodes') {
+                streamedNodes.push(...data.nodes);
+                cumulativeCount += data.nodes.length;
+              } else {
+                cumulativeCount += data.count;
+              }
               
               // 更新缓存的节点计数
               setFullNavigationCache(prev => ({
@@ -566,8 +618,9 @@ const WikiDetail = () => {
               if (onProgress) {
                 onProgress(cumulativeCount);
               }
-            } else if (data.type === 'result') {
-              receivedData = data.data;
+            } else if (data.type === 'result' || data.type === 'complete') {
+              receivedData = data.type === 'complete' ? buildWikiTree(streamedNodes) : data.data;
+              localStorage.removeItem(crawlIdKey);
               isConnectionClosed = true;
               eventSource.removeEventListener('message', handleMessage);
               eventSource.removeEventListener('error', handleError);
@@ -588,6 +641,51 @@ const WikiDetail = () => {
                 setExporting(false);
               }
               
+              resolve(receivedData);
+            } else if (data.type === 'snapshot') {
+              // 后端已有快照：立即使用快照数据，增量刷新的差异稍后通过diff事件推送
+              receivedData = data.data || buildWikiTree(data.nodes ? snapshotNodes.concat(data.nodes) : snapshotNodes);
+              hasSnapshot = true;
+              cumulativeCount = data.node_count;
+              
+              // 重置对应的状态管理
+              if (source === '知识库AI诊断') {
+                setWikiAnalysisState(prev => ({
+                  ...prev,
+                  isFetchingFullNavigation: false,
+                  fullNavigationNodeCount: cumulativeCount
+                }));
+              } else if (source === '文档导入AI评估') {
+                setDocImportAnalysisState(prev => ({
+                  ...prev,
+                  isFetchingFullNavigation: false,
+                  fullNavigationNodeCount: cumulativeCount
+                }));
+              } else if (source === '获取全量导航按钮') {
+                setExportedCount(cumulativeCount);
+                setExporting(false);
+              }
+              
+              console.log(`[全量导航缓存] 使用服务端快照，快照时长: ${Math.round(data.age)}秒，节点数量: ${cumulativeCount}`);
+              resolve(receivedData);
+            } else if (data.type === 'diff') {
+              // 将增量刷新结果应用到快照上
+              receivedData = applyWikiTreeDiff(receivedData || [], data);
+              cumulativeCount += (data.added || []).length - (data.removed || []).length;
+              setFullNavigationCache(prev => ({
+                ...prev,
+                data: receivedData,
+                lastUpdated: Date.now(),
+                nodeCount: cumulativeCount
+              }));
+              console.log(`[全量导航缓存] 快照已更新，新增: ${data.added.length}，更新: ${data.updated.length}，删除: ${data.removed.length}`);
+            } else if (data.type === 'done') {
+              localStorage.removeItem(crawlIdKey);
+              isConnectionClosed = true;
+              eventSource.removeEventListener('message', handleMessage);
+              eventSource.removeEventListener('error', handleError);
+              eventSource.close();
+              // 快照流程中promise已在snapshot事件时resolve，这里仅兜底
               resolve(receivedData);
             } else if (data.type === 'error') {
               isConnectionClosed = true;
@@ -908,8 +1006,8 @@ const WikiDetail = () => {
         hasAnalysis: false
       }));
 
-      // 使用统一的全量导航数据获取函数（支持缓存机制）
-      const allNodes = await getFullNavigationData({
+      // 使用统一的全量导航数据获取函数（支持缓存机制），同时让后端保存节点树快照供分析任务直接使用
+      await getFullNavigationData({
         onProgress: (count) => {
           // 更新模态窗中的节点计数
           setDocImportAnalysisState(prev => ({
@@ -920,156 +1018,22 @@ const WikiDetail = () => {
         source: '文档导入AI评估'
       });
       
-      // 计算总节点数量以判断是否需要分批处理
-      const countTotalNodes = (nodes) => {
-        let count = 0;
-        const traverse = (nodeList) => {
-          nodeList.forEach(node => {
-            count++;
-            if (node.children && node.children.length > 0) {
-              traverse(node.children);
-            }
-          });
-        };
-        traverse(nodes);
-        return count;
-      };
-      
-      const totalNodeCount = countTotalNodes(allNodes);
-      console.log(`[文档导入AI评估] 总节点数量: ${totalNodeCount}`);
-      
-      // 检查是否需要分批处理（超过2500个节点）
-      if (totalNodeCount > 2500) {
-        console.log(`[文档导入AI评估] 节点数量超过阈值，启用分批处理`);
-        // 使用分批处理逻辑
-        await processLargeKnowledgeBase(
-          allNodes,
-          spaceId,
-          storedApiKey,
-          storedModel,
-          storedMaxTokens,
-          storedPrompt,
-          setDocImportAnalysisState,
-          getSpaceName,
-          handleStreamResponse,
-          {
-            docToken: docToken,
-            docType: docType,
-            userAccessToken: userAccessToken
-          }
-        );
-        return;
-      }
-      
-      console.log(`[文档导入AI评估] 节点数量未超过阈值，使用单次处理`);
-      
-      // 创建请求控制器
-      const { controller, requestId } = analysisRequestManager.current.createController('doc_import_analysis');
-      
-      // 原有的单次处理逻辑（节点数 <= 2500）
-      const wiki_node_md = formatNodesToMarkdown(allNodes);
-      // 获取知识库标题
-      const wikiTitle = await getSpaceName(spaceId);
-      
-      // 定义占位符字典 - 后端会负责替换IMPORTED_DOCUMENT_CONTENT占位符
-      const placeholders = {
-        'KNOWLEDGE_BASE_STRUCTURE': wiki_node_md,
-        'WIKI_TITLE': wikiTitle
-      };
-
-      // 构造请求配置对象
-      const config = {
-        url: '/api/llm/doc_import_analysis',
-        method: 'POST',
-        headers: {
-          'Authorization': `Bearer ${userAccessToken}`,
-          'Content-Type': 'application/json'
-        },
-        data: {
-          doc_token: docToken,
-          doc_type: docType,
-          wiki_node_md: wiki_node_md,
-          api_key: storedApiKey,
-          model: storedModel,
-          max_tokens: parseInt(storedMaxTokens),
-          prompt_template: storedPrompt,
-          placeholders: placeholders,
-          wiki_title: wikiTitle
+      // 导入文档的内容只有后端会获取，前端无法估计完整提示词的大小；
+      // 统一交给后端分析任务，由它扣除模板和文档内容后按剩余预算切分批次（不超过预算时只有一批）
+      await processLargeKnowledgeBase(
+        spaceId,
+        storedApiKey,
+        storedModel,
+        storedMaxTokens,
+        storedPrompt,
+        setDocImportAnalysisState,
+        getSpaceName,
+        {
+          docToken: docToken,
+          docType: docType,
+          userAccessToken: userAccessToken
         }
-      };
-
-      console.log('Sending request to /api/llm/doc_import_analysis with data:', {
-        ...config.data,
-        wiki_node_md: `${config.data.wiki_node_md?.substring(0, 100)}...`, // 只记录前100个字符
-        prompt_template: `${config.data.prompt_template?.substring(0, 100)}...` // 只记录前100个字符
-      });
-
-      // 处理流式响应
-      try {
-        await handleStreamResponse(
-          config,
-          (data) => {
-            // 处理纯文本数据块
-            if (data.text) {
-              setDocImportAnalysisState(prev => ({...prev, result: prev.result + data.text}));
-              return;
-            }
-            
-            // 处理区分后的推理内容和普通内容
-            if (data.type === 'reasoning') {
-              flushSync(() => {
-                setDocImportAnalysisState(prev => ({...prev, reasoningContent: prev.reasoningContent + data.content}));
-              });
-              return;
-            }
-            
-            if (data.type === 'content') {
-              // 检查 content 是否为字符串，如果不是则转换为字符串
-              let content = typeof data.content === 'string' ? data.content : JSON.stringify(data.content);
-              console.log('Processing content chunk:', content);
-              
-              // 直接更新分析结果
-              flushSync(() => {
-                if (!docImportAnalysisState.isReasoningDone) {
-                  setDocImportAnalysisState(prev => ({...prev, isReasoningDone: true}));
-                }
-                setDocImportAnalysisState(prev => ({...prev, result: prev.result + content}));
-              });
-              return;
-            }
-          },
-          () => {
-            // 请求完成，清理控制器
-            analysisRequestManager.current.completeRequest(requestId);
-            
-            console.log('Document import analysis completed successfully');
-            setDocImportAnalysisState(prev => ({...prev, isLoading: false}));
-            // 清除之前的优化建议
-            setDocImportAnalysisState(prev => ({
-              ...prev,
-              suggestions: []
-            }));
-            localStorage.setItem(`doc_import_suggestions_${spaceId}`, JSON.stringify([]));
-          },
-          (error) => {
-            // 请求失败，清理控制器
-            analysisRequestManager.current.completeRequest(requestId);
-            
-            console.error('Stream response error in doc import analysis:', error);
-            throw error;
-          },
-          () => {
-            // 强制更新UI
-            setDocImportAnalysisState(prev => ({...prev, result: prev.result}));
-          },
-          controller // 传入外部AbortController
-        );
-      } catch (error) {
-        // 请求异常，清理控制器
-        analysisRequestManager.current.completeRequest(requestId);
-        throw error; // 重新抛出错误，让外层catch处理
-      }
-
+      );
     } catch (error) {
       console.error('Doc import analysis failed:', error);
       message.error(`文档导入分析失败: ${error.message}`);
@@ -1132,61 +1096,10 @@ const WikiDetail = () => {
     return markdown;
   };
 
-  // 新增：识别根节点并分批处理的工具函数
-  const identifyRootNodes = (nodes) => {
-    console.log(`[识别根节点] 开始分析 ${nodes.length} 个节点`);
-    
-    // 根节点识别逻辑：
-    // 1. 没有parent属性的节点
-    // 2. level为0的节点
-    // 3. 在传入的nodes数组中直接出现的节点（即顶层节点）
-    const rootNodes = nodes.filter(node => {
-      const hasNoParent = !node.parent;
-      const isLevelZero = node.level === 0;
-      const isTopLevel = nodes.some(n => 
-        n.children && n.children.some(child => 
-          child.key === node.key || child.node_token === node.node_token
-        )
-      ) === false; // 不是其他节点的子节点
-      
-      const isRoot = hasNoParent || isLevelZero || isTopLevel;
-      
-      if (isRoot) {
-        console.log(`[识别根节点] 找到根节点: ${node.title} (key: ${node.key || node.node_token})`);
-      }
-      
-      return isRoot;
-    });
-    
-    console.log(`[识别根节点] 识别到 ${rootNodes.length} 个根节点`);
-    return rootNodes;
-  };
-
-  // 新增：构建单个根节点及其子树的Markdown
-  const formatRootNodeToMarkdown = (rootNode, allNodes) => {
-    let markdown = '';
-    
-    // 递归查找并构建指定节点的子树
-    const buildSubtreeMarkdown = (node, level, targetNodeId = null) => {
-      const token = node.key || node.node_token || '[NODE TOKEN MISSING]';
-      const title = node.title.props ? node.title.props.children : node.title;
-      markdown += `${'  '.repeat(level)}- ${title} (token: ${token})\n`;
-      
-      if (node.children && node.children.length > 0) {
-        node.children.forEach(child => {
-          buildSubtreeMarkdown(child, level + 1);
-        });
-      }
-    };
-    
-    // 从根节点开始构建
-    buildSubtreeMarkdown(rootNode, 0);
-    return markdown;
-  };
-
   // 新增：分批处理超大型知识库的核心函数
+  // 由后端分析任务在服务端切分批次、并发分析并汇总，前端只订阅任务事件；
+  // 连接中断时 EventSource 会携带 Last-Event-ID 自动从断点继续接收
   const processLargeKnowledgeBase = async (
-    allNodes, 
     spaceId, 
     storedApiKey, 
     storedModel, 
@@ -1194,481 +1107,227 @@ const WikiDetail = () => {
     storedPrompt, 
     setStateFunction, 
     getSpaceName, 
-    handleStreamResponse,
     docImportOptions = null
   ) => {
-    const {
-      batchSize = 1, // 每批处理的根节点数量，默认为1
-      maxTotalNodes = 2500 // 触发分批处理的节点数量阈值
-    } = {};
-    
     // 判断分析类型
     const isDocImportAnalysis = docImportOptions !== null;
     const analysisType = isDocImportAnalysis ? '文档导入AI评估' : '知识库AI诊断';
+    const userAccessToken = isDocImportAnalysis ? docImportOptions.userAccessToken : localStorage.getItem('user_access_token');
 
     try {
-      // 计算总节点数
-      const countTotalNodes = (nodes) => {
-        let count = 0;
-        const traverse = (nodeList) => {
-          nodeList.forEach(node => {
-            count++;
-            if (node.children && node.children.length > 0) {
-              traverse(node.children);
-            }
-          });
-        };
-        traverse(nodes);
-        return count;
-      };
-
-      const totalNodes = countTotalNodes(allNodes);
-      console.log(`[分批处理] 总节点数量: ${totalNodes}, 阈值: ${maxTotalNodes}`);
-
-      // 如果节点数量未超过阈值，直接返回完整数据
-      if (totalNodes <= maxTotalNodes) {
-        console.log(`[分批处理] 节点数量未超过阈值，使用完整处理模式`);
-        return {
-          shouldBatch: false,
-          data: allNodes,
-          markdown: formatNodesToMarkdown(allNodes)
-        };
-      }
-      
-      // 节点数量超过阈值，继续执行分批处理逻辑
-      console.log(`[分批处理] 节点数量超过阈值，开始分批处理流程`);
-
-      console.log(`[分批处理] 节点数量超过阈值，启用分批处理模式`);
-      
-      // 识别根节点
-      const rootNodes = identifyRootNodes(allNodes);
-      console.log(`[分批处理] 识别到 ${rootNodes.length} 个根节点`);
-      
-      // 验证根节点识别结果
-      if (rootNodes.length === 0) {
-        console.warn(`[分批处理] 警告：未识别到任何根节点，将使用单次处理模式`);
-        return {
-          shouldBatch: false,
-          data: allNodes,
-          markdown: formatNodesToMarkdown(allNodes)
-        };
-      }
-      
-      // 如果根节点数量为1，也使用单次处理模式
-      if (rootNodes.length === 1) {
-        console.log(`[分批处理] 只有1个根节点，使用单次处理模式`);
-        return {
-          shouldBatch: false,
-          data: allNodes,
-          markdown: formatNodesToMarkdown(allNodes)
-        };
-      }
-
-      // 分批处理根节点
-      const batches = [];
-      for (let i = 0; i < rootNodes.length; i += batchSize) {
-        const batch = rootNodes.slice(i, i + batchSize);
-        batches.push(batch);
-      }
-
-      console.log(`[分批处理] 分为 ${batches.length} 批进行处理，每批 ${batchSize} 个根节点`);
-
-      // 为每批数据构建Markdown
-      const batchData = batches.map((batch, index) => {
-        const batchNodes = [];
-        
-        // 为每个根节点构建其子树
-        batch.forEach(rootNode => {
-          // 查找完整的子树结构 - 直接在allNodes中查找
-          const findSubtreeInNodes = (nodes, targetId) => {
-            // 首先在当前层级查找
-            for (let node of nodes) {
-              if (node.key === targetId || node.node_token === targetId) {
-                return node;
-              }
-            }
-            
-            // 如果没找到，递归在子节点中查找
-            for (let node of nodes) {
-              if (node.children && node.children.length > 0) {
-                const result = findSubtreeInNodes(node.children, targetId);
-                if (result) return result;
-              }
-            }
-            
-            return null;
-          };
-
-          const subtree = findSubtreeInNodes(allNodes, rootNode.key || rootNode.node_token);
-          if (subtree) {
-            console.log(`[分批处理] 找到根节点 ${rootNode.title} 的子树，包含 ${countTotalNodes([subtree])} 个节点`);
-            batchNodes.push(subtree);
-          } else {
-            console.warn(`[分批处理] 未找到根节点 ${rootNode.title} 的子树`);
-            // 如果找不到子树，直接使用根节点
-            batchNodes.push(rootNode);
-          }
-        });
+      // 获取知识库标题
+      const wikiTitle = await getSpaceName(spaceId);
 
-        const batchMarkdown = batchNodes.map(node => formatRootNodeToMarkdown(node, allNodes)).join('\n');
-        
-        return {
-          batchIndex: index,
-          rootNodes: batch,
-          nodes: batchNodes,
-          markdown: batchMarkdown,
-          nodeCount: countTotalNodes(batchNodes)
-        };
+      // 创建后端分析任务（任务不使用结果复用，只传温度）
+      const { temperature } = getLlmSamplingOptions();
+      const response = await fetch('/api/llm/analysis_jobs', {
+        method: 'POST',
+        headers: {
+          'Authorization': `Bearer ${userAccessToken}`,
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+          space_id: spaceId,
+          api_key: storedApiKey,
+          model: storedModel,
+          max_tokens: parseInt(storedMaxTokens),
+          ...(temperature !== undefined ? { temperature } : {}),
+          prompt_template: storedPrompt,
+          wiki_title: wikiTitle,
+          placeholders: { 'WIKI_TITLE': wikiTitle },
+          ...(isDocImportAnalysis ? { doc_token: docImportOptions.docToken, doc_type: docImportOptions.docType } : {})
+        })
       });
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}, message: ${await response.text()}`);
+      }
+      const { job_id: jobId } = await response.json();
+      console.log(`[分批处理] ${analysisType} 已创建后端分析任务: ${jobId}`);
 
-      // 计算总批次数和进度
-      const totalBatches = batchData.length;
-      let completedBatches = 0;
-      const batchResults = [];
-      
       // 设置分批处理状态
       setStateFunction(prev => ({
         ...prev,
         isBatchProcessing: true,
         batchProgress: {
           completed: 0,
-          total: totalBatches,
+          total: 0,
           progress: 0,
-          message: '开始分批分析...'
+          message: '正在准备分批分析...'
         },
         batchResults: [],
         currentBatchIndex: 0,
         finalSummary: ''
       }));
-      
-      console.log(`[分批处理] 开始执行 ${totalBatches} 批分析`);
-      
-      // 获取知识库标题
-      const wikiTitle = await getSpaceName(spaceId);
-      
-      // 逐批执行分析
-      for (let i = 0; i < batchData.length; i++) {
-        const batch = batchData[i];
-        console.log(`[分批处理] 开始处理第 ${i + 1}/${totalBatches} 批，包含 ${batch.rootNodes.length} 个根节点`);
-        
-        // 更新进度状态
-        setStateFunction(prev => ({
-          ...prev,
-          currentBatchIndex: i,
-          batchProgress: {
-            completed: i,
-            total: totalBatches,
-            progress: Math.round((i / totalBatches) * 100),
-            message: `正在分析第 ${i + 1}/${totalBatches} 批（${batch.rootNodes.map(n => n.title).join(', ')}）`
-          }
-        }));
-        
-        try {
-          // 构造当前批次的占位符字典
-          const placeholders = {
-            'KNOWLEDGE_BASE_STRUCTURE': batch.markdown,
-            'WIKI_TITLE': wikiTitle
-          };
-          
-          let config;
-          
-          if (isDocImportAnalysis) {
-            // 文档导入AI评估的配置
-            const { docToken, docType, userAccessToken } = docImportOptions;
-            config = {
-              url: '/api/llm/doc_import_analysis',
-              method: 'POST',
-              headers: {
-                'Authorization': `Bearer ${userAccessToken}`,
-                'Content-Type': 'application/json'
-              },
-              data: {
-                doc_token: docToken,
-                doc_type: docType,
-                wiki_node_md: batch.markdown,
-                api_key: storedApiKey,
-                model: storedModel,
-                max_tokens: parseInt(storedMaxTokens),
-                prompt_template: storedPrompt,
-                placeholders: placeholders,
-                wiki_title: wikiTitle
-              }
-            };
-          } else {
-            // 知识库AI诊断的配置
-            config = {
-              url: '/api/llm/stream_analysis',
-              method: 'POST',
-              headers: {
-                'Content-Type': 'application/json'
-              },
-              data: {
-                api_key: storedApiKey,
-                model: storedModel,
-                max_tokens: parseInt(storedMaxTokens),
-                prompt_template: storedPrompt,
-                placeholders: placeholders
-              }
-            };
-          }
-          
-          // 创建当前批次的请求控制器
-          const { controller, requestId } = analysisRequestManager.current.createController(
-            isDocImportAnalysis ? 'doc_import_analysis_batch' : 'wiki_analysis_batch'
-          );
-          
-          // 执行当前批次的分析
-          let batchResult = '';
-          let batchReasoning = '';
-          
-          try {
-            await handleStreamResponse(
-              config,
-              (data) => {
-                // 处理纯文本数据块
-                if (data.text) {
-                  batchResult += data.text;
-                  
-                  // 为当前正在进行的批次结果添加根节点标题前缀
-                  const currentRootTitles = batch.rootNodes.map(node => node.title).join('、');
-                  const currentBatchWithHeader = batchResult ? `## 第${i + 1}批分析结果（根节点：${currentRootTitles}）\n\n${batchResult}` : '';
-                  
-                  setStateFunction(prev => ({
-                    ...prev,
-                    result: prev.batchResults.join('\n\n---\n\n') + (currentBatchWithHeader ? '\n\n---\n\n' + currentBatchWithHeader : '')
-                  }));
-                  return;
+
+      // 创建请求控制器，取消分析时同时取消后端任务
+      const { controller, requestId } = analysisRequestManager.current.createController(
+        isDocImportAnalysis ? 'doc_import_analysis_batch' : 'wiki_analysis_batch'
+      );
+
+      return await new Promise((resolve, reject) => {
+        const batches = [];
+        const batchTexts = [];
+        const finishedBatches = new Set();
+        let reasoning = '';
+        let summary = '';
+        let totalBatches = 0;
+        let completedBatches = 0;
+
+        const batchHeader = (index) => {
+          const rootTitles = batches[index] ? batches[index].root_titles.join('、') : '未知根节点';
+          return `## 第${index + 1}批分析结果（根节点：${rootTitles}）\n\n`;
+        };
+        // 按批次顺序拼接已有的结果（各批次并发执行，完成顺序不固定）
+        const composeResults = () => batchTexts
+          .map((text, index) => (text ? batchHeader(index) + text : ''))
+          .filter(Boolean);
+        const summaryHeader = () => `## 最终总结（涵盖所有根节点：${batches.map(batch => batch.root_titles.join('、')).join('；')}）\n\n`;
+
+        const eventSource = new EventSource(`${process.env.REACT_APP_BACKEND_URL}/api/llm/analysis_jobs/${jobId}/events?token=${encodeURIComponent(userAccessToken)}`);
+        const finish = () => {
+          eventSource.close();
+          analysisRequestManager.current.completeRequest(requestId);
+        };
+        controller.signal.addEventListener('abort', () => {
+          finish();
+          fetch(`/api/llm/analysis_jobs/${jobId}`, {
+            method: 'DELETE',
+            headers: { 'Authorization': `Bearer ${userAccessToken}` }
+          }).catch(error => console.warn(`[分批处理] 取消后端分析任务失败: ${jobId}`, error));
+          console.log(`[分批处理] 分析已取消: ${jobId}`);
+          resolve({ success: false, message: '分析已取消' });
+        });
+
+        eventSource.onmessage = (event) => {
+          const data = JSON.parse(event.data);
+          switch (data.type) {
+            case 'batches':
+              totalBatches = data.total;
+              data.batches.forEach(batch => { batches[batch.index] = batch; });
+              console.log(`[分批处理] 后端分为 ${totalBatches} 批进行处理`);
+              setStateFunction(prev => ({
+                ...prev,
+                batchProgress: {
+                  completed: 0,
+                  total: totalBatches,
+                  progress: 0,
+                  message: '开始分批分析...'
                 }
-                
-                // 处理区分后的推理内容和普通内容
-                if (data.type === 'reasoning') {
-                  batchReasoning += data.content;
-                  setStateFunction(prev => ({
-                    ...prev,
-                    reasoningContent: batchReasoning
-                  }));
-                  return;
+              }));
+              break;
+            case 'batch_start':
+              setStateFunction(prev => ({
+                ...prev,
+                currentBatchIndex: data.index,
+                batchProgress: {
+                  ...prev.batchProgress,
+                  message: `正在分析第 ${data.index + 1}/${totalBatches} 批（${data.root_titles.join(', ')}）`
+                }
+              }));
+              break;
+            case 'batch_queued':
+            case 'summary_queued':
+              setStateFunction(prev => ({
+                ...prev,
+                batchProgress: {
+                  ...prev.batchProgress,
+                  message: `模型调用排队中，前面还有 ${data.position - 1} 个请求`
                 }
-                
-                if (data.type === 'content') {
-                  let content = typeof data.content === 'string' ? data.content : JSON.stringify(data.content);
-                  batchResult += content;
-                  
-                  // 为当前正在进行的批次结果添加根节点标题前缀
-                  const currentRootTitles = batch.rootNodes.map(node => node.title).join('、');
-                  const currentBatchWithHeader = batchResult ? `## 第${i + 1}批分析结果（根节点：${currentRootTitles}）\n\n${batchResult}` : '';
-                  
-                  setStateFunction(prev => ({
-                    ...prev,
-                    result: prev.batchResults.join('\n\n---\n\n') + (currentBatchWithHeader ? '\n\n---\n\n' + currentBatchWithHeader : ''),
-                    isReasoningDone: true
-                  }));
-                  return;
+              }));
+              break;
+            case 'batch_reasoning':
+            case 'summary_reasoning':
+              reasoning += data.content;
+              setStateFunction(prev => ({ ...prev, reasoningContent: reasoning }));
+              break;
+            case 'batch_content':
+              batchTexts[data.index] = (batchTexts[data.index] || '') + data.content;
+              setStateFunction(prev => ({
+                ...prev,
+                result: composeResults().join('\n\n---\n\n'),
+                isReasoningDone: true
+              }));
+              break;
+            case 'batch_done':
+            case 'batch_error':
+              if (data.type === 'batch_done') {
+                batchTexts[data.index] = data.result;
+              } else {
+                batchTexts[data.index] = `第 ${data.index + 1} 批分析失败: ${data.error}`;
+              }
+              // 重新连接时已处理过的批次事件会被跳过，这里按批次去重计数
+              if (!finishedBatches.has(data.index)) {
+                finishedBatches.add(data.index);
+                completedBatches += 1;
+              }
+              console.log(`[分批处理] 第 ${data.index + 1} 批分析${data.type === 'batch_done' ? '完成' : '失败'}`);
+              setStateFunction(prev => ({
+                ...prev,
+                batchResults: composeResults(),
+                result: composeResults().join('\n\n---\n\n'),
+                batchProgress: {
+                  completed: completedBatches,
+                  total: totalBatches,
+                  progress: totalBatches ? Math.round((completedBatches / totalBatches) * 100) : 0,
+                  message: `已完成 ${completedBatches}/${totalBatches} 批分析`
                 }
-              },
-              () => {
-                // 当前批次完成，清理控制器
-                analysisRequestManager.current.completeRequest(requestId);
-                
-                completedBatches++;
-                
-                // 为当前批次结果添加根节点标题前缀，便于区分
-                const rootTitles = batch.rootNodes.map(node => node.title).join('、');
-                const batchResultWithHeader = `## 第${i + 1}批分析结果（根节点：${rootTitles}）\n\n${batchResult}`;
-                batchResults.push(batchResultWithHeader);
-                
+              }));
+              break;
+            case 'status':
+              if (data.status === 'summarizing') {
+                console.log(`[分批处理] 所有批次分析完成，开始最终总结`);
                 setStateFunction(prev => ({
                   ...prev,
-                  batchResults: [...prev.batchResults, batchResultWithHeader],
                   batchProgress: {
-                    completed: completedBatches,
+                    completed: totalBatches,
                     total: totalBatches,
-                    progress: Math.round((completedBatches / totalBatches) * 100),
-                    message: `已完成 ${completedBatches}/${totalBatches} 批分析`
+                    progress: 100,
+                    message: '正在生成最终总结...'
                   }
                 }));
-                
-                console.log(`[分批处理] 第 ${i + 1} 批分析完成（根节点：${rootTitles}）`);
-              },
-              (error) => {
-                // 当前批次失败，清理控制器
-                analysisRequestManager.current.completeRequest(requestId);
-                
-                console.error(`[分批处理] 第 ${i + 1} 批分析失败:`, error);
-                throw error; // 重新抛出错误，让外层catch处理
-              },
-              () => {
-                // 强制更新UI
-                setStateFunction(prev => ({...prev, result: prev.result}));
-              },
-              controller // 传入外部AbortController
-            );
-          } catch (error) {
-            // 请求异常，清理控制器
-            analysisRequestManager.current.completeRequest(requestId);
-            throw error; // 重新抛出错误，让外层catch处理
-          }
-        } catch (error) {
-          console.error(`[分批处理] 第 ${i + 1} 批分析失败:`, error);
-          setStateFunction(prev => ({
-            ...prev,
-            result: prev.result + `\n\n第 ${i + 1} 批分析失败: ${error.message}`,
-            isLoading: false,
-            isBatchProcessing: false
-          }));
-          throw error;
-        }
-      }
-      
-      // 所有批次分析完成，执行最终总结
-      console.log(`[分批处理] 所有批次分析完成，开始最终总结`);
-      setStateFunction(prev => ({
-        ...prev,
-        batchProgress: {
-          completed: totalBatches,
-          total: totalBatches,
-          progress: 100,
-          message: '正在生成最终总结...'
-        }
-      }));
-      
-      try {
-        // 构造总结分析的提示词，包含根节点信息
-        const summaryPrompt = `你是一位知识管理专家，现在需要对前面分批分析的结果进行总结归纳。
-
-## 分批分析结果
-${batchResults.map((result, index) => {
-  // 从batchData中获取对应批次的根节点信息
-  const batchInfo = batchData[index];
-  const rootTitles = batchInfo ? batchInfo.rootNodes.map(node => node.title).join('、') : '未知根节点';
-  return `### 第${index + 1}批分析结果（根节点：${rootTitles}）\n\n${result}`;
-}).join('\n\n')}
-
-## 总结要求
-请基于以上分批分析结果，提供一个综合性的总结分析，包括：
-1. 整体评估结论
-2. 主要发现的问题（按根节点分类说明）
-3. 综合优化建议（针对不同根节点的专项建议）
-4. 后续改进方向
-
-请使用Markdown格式输出，确保结构清晰、重点突出。在总结中请明确提及各个根节点的分析结果，便于用户对照查看。`;
-        
-        // 构造总结分析的配置
-        const summaryConfig = {
-          url: '/api/llm/stream_analysis',
-          method: 'POST',
-          headers: {
-            'Content-Type': 'application/json'
-          },
-          data: {
-            api_key: storedApiKey,
-            model: storedModel,
-            max_tokens: parseInt(storedMaxTokens),
-            prompt_template: summaryPrompt,
-            placeholders: {}
-          }
-        };
-        
-        // 执行最终总结分析
-        await handleStreamResponse(
-          summaryConfig,
-          (data) => {
-            if (data.text) {
-                // 为最终总结添加根节点信息标题（只在第一次添加时显示）
-                setStateFunction(prev => {
-                  let updatedFinalSummary = prev.finalSummary;
-                  if (!prev.finalSummary) {
-                    const allRootTitles = batchData.map(batch => 
-                      batch.rootNodes.map(node => node.title).join('、')
-                    ).join('；');
-                    updatedFinalSummary = `## 最终总结（涵盖所有根节点：${allRootTitles}）\n\n`;
-                  }
-                  
-                  return {
-                    ...prev,
-                    finalSummary: updatedFinalSummary + data.text
-                  };
-                });
-                return;
               }
-            
-            if (data.type === 'reasoning') {
-              setStateFunction(prev => ({
-                ...prev,
-                reasoningContent: prev.reasoningContent + data.content
-              }));
-              return;
-            }
-            
-            if (data.type === 'content') {
-              let content = typeof data.content === 'string' ? data.content : JSON.stringify(data.content);
-              
-              setStateFunction(prev => {
-                // 为最终总结添加根节点信息标题（只在第一次添加时显示）
-                let updatedFinalSummary = prev.finalSummary;
-                if (!prev.finalSummary) {
-                  const allRootTitles = batchData.map(batch => 
-                    batch.rootNodes.map(node => node.title).join('、')
-                  ).join('；');
-                  updatedFinalSummary = `## 最终总结（涵盖所有根节点：${allRootTitles}）\n\n`;
-                }
-                
-                return {
-                  ...prev,
-                  finalSummary: updatedFinalSummary + content,
-                  isReasoningDone: true
-                };
-              });
-              return;
-            }
-          },
-          () => {
-            // 总结分析完成
-            const allRootTitles = batchData.map(batch => 
-              batch.rootNodes.map(node => node.title).join('、')
-            ).join('；');
-            
-            setStateFunction(prev => ({
-              ...prev,
-              isBatchProcessing: false,
-              isLoading: false,
-              hasAnalysis: true,
-              result: prev.batchResults.join('\n\n---\n\n') + '\n\n' + prev.finalSummary
-              }));
-              console.log(`[分批处理] 分批分析流程完成（涵盖根节点：${allRootTitles}）`);
-            },
-            (error) => {
-              console.error(`[分批处理] 最终总结失败:`, error);
+              break;
+            case 'summary_content':
+              summary += data.content;
+              setStateFunction(prev => ({ ...prev, finalSummary: summaryHeader() + summary, isReasoningDone: true }));
+              break;
+            case 'done': {
+              finish();
+              const finalSummary = totalBatches > 1 ? summaryHeader() + data.summary : '';
               setStateFunction(prev => ({
                 ...prev,
-                finalSummary: `总结分析失败: ${error.message}`,
-                isBatchProcessing: false,
-                isLoading: false,
-                hasAnalysis: true
-              }));
-            }
-          );
-          
-        } catch (error) {
-          console.error(`[分批处理] 最终总结失败:`, error);
-          setStateFunction(prev => ({
-            ...prev,
-            finalSummary: `总结分析失败: ${error.message}`,
                 isBatchProcessing: false,
                 isLoading: false,
-                hasAnalysis: true
+                hasAnalysis: true,
+                finalSummary,
+                result: composeResults().join('\n\n---\n\n') + (finalSummary ? '\n\n' + finalSummary : '')
               }));
+              console.log(`[分批处理] 分批处理流程成功完成`);
+              resolve({
+                success: true,
+                message: '分批处理完成',
+                totalBatches: totalBatches
+              });
+              break;
             }
-            
-            // 分批处理成功完成
-            console.log(`[分批处理] 分批处理流程成功完成`);
-            return {
-              success: true,
-              message: '分批处理完成',
-              totalBatches: totalBatches,
-              totalNodes: totalNodes
-            };
+            case 'cancelled':
+            case 'error':
+              finish();
+              reject(new Error(data.error || '分析任务已取消'));
+              break;
+            default:
+              break;
+          }
+        };
 
+        eventSource.onerror = () => {
+          // CONNECTING 状态下浏览器会自动重连并从最后收到的事件继续
+          if (eventSource.readyState === EventSource.CLOSED) {
+            finish();
+            reject(new Error('与分析任务的连接已断开'));
+          }
+        };
+      });
     } catch (error) {
       console.error(`[分批处理] 处理失败:`, error);
       setStateFunction(prev => ({
@@ -1787,52 +1446,33 @@ ${batchResults.map((result, index) => {
         source: '知识库AI诊断'
       });
       
-      // 计算总节点数量以判断是否需要分批处理
-      const countTotalNodes = (nodes) => {
-        let count = 0;
-        const traverse = (nodeList) => {
-          nodeList.forEach(node => {
-            count++;
-            if (node.children && node.children.length > 0) {
-              traverse(node.children);
-            }
-          });
-        };
-        traverse(nodes);
-        return count;
-      };
-      
-      const totalNodeCount = countTotalNodes(allNodes);
-      console.log(`[知识库AI诊断] 总节点数量: ${totalNodeCount}`);
-      
-      // 检查是否需要分批处理（超过2500个节点）
-      if (totalNodeCount > 2500) {
-        console.log(`[知识库AI诊断] 节点数量超过阈值，启用分批处理`);
-        // 使用分批处理逻辑
+      const wiki_node_md = formatNodesToMarkdown(allNodes);
+      // 获取知识库标题
+      const wikiTitle = await getSpaceName(spaceId);
+
+      // 按填充后提示词的估计token数判断是否需要分批处理
+      const estimatedTokens = estimateTokens(storedPrompt) + estimateTokens(wiki_node_md) + estimateTokens(wikiTitle || '');
+      console.log(`[知识库AI诊断] 提示词估计token数: ${estimatedTokens}，预算: ${ANALYSIS_TOKEN_BUDGET}`);
+
+      if (estimatedTokens > ANALYSIS_TOKEN_BUDGET) {
+        console.log(`[知识库AI诊断] 超过单次请求预算，启用分批处理`);
         await processLargeKnowledgeBase(
-          allNodes,
           spaceId,
           storedApiKey,
           storedModel,
           storedMaxTokens,
           storedPrompt,
           setWikiAnalysisState,
-          getSpaceName,
-          handleStreamResponse
+          getSpaceName
         );
         return;
       }
       
-      console.log(`[知识库AI诊断] 节点数量未超过阈值，使用单次处理`);
+      console.log(`[知识库AI诊断] 未超过单次请求预算，使用单次处理`);
       
       // 创建请求控制器
       const { controller, requestId } = analysisRequestManager.current.createController('wiki_analysis');
       
-      // 原有的单次处理逻辑（节点数 <= 2500）
-      const wiki_node_md = formatNodesToMarkdown(allNodes);
-      // 获取知识库标题
-      const wikiTitle = await getSpaceName(spaceId);
-      
       // 定义占位符字典
       const placeholders = {
         'KNOWLEDGE_BASE_STRUCTURE': wiki_node_md,
@@ -1851,7 +1491,8 @@ ${batchResults.map((result, index) => {
           model: storedModel,
           max_tokens: parseInt(storedMaxTokens),
           prompt_template: storedPrompt,
-          placeholders: placeholders
+          placeholders: placeholders,
+          ...getLlmSamplingOptions()
         }
       };
 
@@ -2081,7 +1722,8 @@ ${batchResults.map((result, index) => {
           model: storedModel,
           max_tokens: parseInt(storedMaxTokens),
           prompt_template: storedPrompt,
-          placeholders: placeholders
+          placeholders: placeholders,
+          ...getLlmSamplingOptions()
         }
       };
 
@@ -2162,8 +1804,8 @@ ${batchResults.map((result, index) => {
       const newNode = {
         title: title,
         key: node.node_token,
-        // If node has children, mark it as expandable but don't load children yet
-        children: node.has_child ? [] : [],
+        // 子树接口已带回的子节点直接挂上，其余有子节点的节点展开时再加载
+        children: node.children ? transformData(node.children, suggestions) : [],
         isLeaf: !node.has_child,
         url: `https://feishu.cn/wiki/${node.node_token}?hideSider=1&hideHeader=1`
       };
@@ -2186,7 +1828,7 @@ ${batchResults.map((result, index) => {
       updatePageTitle(decodedTitle);
       
       // 只获取节点数据，不需要获取space name
-      apiClient.get(`/api/wiki/${spaceId}/nodes`, { params: { parent_node_token: undefined } })
+      apiClient.get(`/api/wiki/${spaceId}/nodes/subtree`, { params: { parent_node_token: undefined, depth: 2 } })
         .then(nodesResponse => {
           const items = nodesResponse.data.items;
           const transformed = transformData(items, wikiAnalysisState.suggestions);
@@ -2202,7 +1844,7 @@ ${batchResults.map((result, index) => {
     } else {
       // 如果URL中没有title参数，使用原来的逻辑获取space name
       Promise.all([
-        apiClient.get(`/api/wiki/${spaceId}/nodes`, { params: { parent_node_token: undefined } }),
+        apiClient.get(`/api/wiki/${spaceId}/nodes/subtree`, { params: { parent_node_token: undefined, depth: 2 } }),
         getSpaceName(spaceId)
       ])
         .then(([nodesResponse, spaceName]) => {
@@ -2241,13 +1883,12 @@ ${batchResults.map((result, index) => {
   };
 
   // Load child nodes with pagination support
+  // 首次展开使用子树接口（每层取第一页，同时带回靠前节点的下一层，服务端再在后台预取更深一层）；"加载更多"仍按页请求
   const loadChildNodes = (parentKey, pageToken) => {
-    return apiClient.get(`/api/wiki/${spaceId}/nodes`, { 
-      params: { 
-        parent_node_token: parentKey,
-        page_token: pageToken
-      } 
-    })
+    const request = pageToken
+      ? apiClient.get(`/api/wiki/${spaceId}/nodes`, { params: { parent_node_token: parentKey, page_token: pageToken } })
+      : apiClient.get(`/api/wiki/${spaceId}/nodes/subtree`, { params: { parent_node_token: parentKey, depth: 2 } });
+    return request
       .then(response => {
         const { items, has_more, page_token } = response.data;
         const transformed = transformData(items, wikiAnalysisState.suggestions);
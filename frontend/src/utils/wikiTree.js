@@ -0,0 +1,52 @@
+/**
+ * 知识空间节点树工具
+ * 将嵌套节点树与扁平节点记录互相转换，并应用后端推送的快照差异
+ */
+
+// 将嵌套节点树展开为按先序排列的扁平记录（不含children字段）
+export const flattenWikiTree = (nodes, parentNodeToken = '') => {
+  const records = [];
+  const stack = (nodes || []).map(node => [node, parentNodeToken]).reverse();
+  while (stack.length > 0) {
+    const [node, parentToken] = stack.pop();
+    const { children, ...record } = node;
+    records.push({ ...record, parent_node_token: record.parent_node_token || parentToken });
+    if (children && children.length > 0) {
+      for (let i = children.length - 1; i >= 0; i -= 1) {
+        stack.push([children[i], node.node_token]);
+      }
+    }
+  }
+  return records;
+};
+
+// 根据 parent_node_token 将扁平记录组装为嵌套节点树，父节点不存在的记录作为根节点
+export const buildWikiTree = (records) => {
+  const nodeMap = new Map();
+  records.forEach(record => {
+    nodeMap.set(record.node_token, { ...record });
+  });
+  const roots = [];
+  nodeMap.forEach(node => {
+    const parent = nodeMap.get(node.parent_node_token);
+    if (parent) {
+      if (!parent.children) {
+        parent.children = [];
+      }
+      parent.children.push(node);
+    } else {
+      roots.push(node);
+    }
+  });
+  return roots;
+};
+
+// 将 {added, updated, removed} 差异应用到节点树上，返回新的节点树
+export const applyWikiTreeDiff = (tree, diff) => {
+  const removed = new Set(diff.removed || []);
+  const updated = new Map((diff.updated || []).map(record => [record.node_token, record]));
+  const records = flattenWikiTree(tree)
+    .filter(record => !removed.has(record.node_token))
+    .map(record => (updated.has(record.node_token) ? { ...record, ...updated.get(record.node_token) } : record));
+  return buildWikiTree(records.concat(diff.added || []));
+};